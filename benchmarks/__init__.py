@@ -0,0 +1 @@
+"""Benchmarks of the NetAtmo ingestion and parsing code."""
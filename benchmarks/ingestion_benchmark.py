@@ -0,0 +1,333 @@
+"""End-to-end benchmark of the IngestionService.
+
+Synthetic snapshots are uploaded to a local S3 stand-in and ingested into a
+throwaway local MongoDB server with a number of service configurations. The
+throughput and peak memory of every configuration are reported.
+
+The S3 stand-in is a moto server, so moto[server] must be installed. The
+MongoDB server is started from the mongod executable, unless the host of a
+running server is given. Its database is dropped before every configuration.
+Absolute numbers depend on the stand-ins, compare configurations of a single
+benchmark run.
+
+Usage: python -m benchmarks.ingestion_benchmark --stations 50000 --files 12
+"""
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import tempfile
+from datetime import datetime, timedelta
+from time import sleep, time
+
+import boto3
+import pymongo
+
+from benchmarks.synthetic_snapshots import (
+    REGIONS, SnapshotConfig, generate_snapshots)
+from domain.base import DataRequest
+from domain.ingestion_service import IngestionService
+
+BUCKET = 'netatmo-benchmark'
+
+# Configurations as names and IngestionService attributes.
+CONFIGURATIONS = [
+    ('default', {}),
+    ('no_download_consumers', {'download_consumer_count': 0}),
+    ('station_objects', {'shared_memory': False}),
+    ('more_json_consumers', {'json_consumer_count': 8,
+                             'db_connections': 8}),
+    ('fixed_pools', {'min_file_consumers': 2, 'max_file_consumers': 2,
+                     'min_json_consumers': 4, 'max_json_consumers': 4}),
+    ('hour_buckets', {'time_bucket': 'hour'}),
+    ('day_buckets_binary', {'time_bucket': 'day', 'binary_stations': True})
+]
+
+
+class LocalS3(object):
+    """S3 stand-in on a moto server in a background thread."""
+
+    def __init__(self, bucket=BUCKET):
+        self.bucket = bucket
+        self.endpoint_url = None
+        self._server = None
+        self._client = None
+
+    def __enter__(self):
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            raise ImportError(
+                "The S3 stand-in requires moto, pip install 'moto[server]'.")
+        # The server logs every request.
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        port = _free_port()
+        self._server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+        self._server.start()
+        self.endpoint_url = 'http://127.0.0.1:%d' % port
+        self._client = boto3.client(
+            's3', endpoint_url=self.endpoint_url, region_name='us-east-1',
+            aws_access_key_id='benchmark', aws_secret_access_key='benchmark')
+        self._client.create_bucket(Bucket=self.bucket)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.stop()
+
+    def upload(self, directory, file_names):
+        """Upload files to the data prefix read by the IngestionService."""
+        for file_name in file_names:
+            self._client.upload_file(
+                os.path.join(directory, file_name), self.bucket,
+                'data/' + file_name)
+
+    def write_credentials(self, directory):
+        """Write the config/AWS_key file read by load_aws_keys."""
+        os.makedirs(os.path.join(directory, 'config'), exist_ok=True)
+        with open(os.path.join(directory, 'config', 'AWS_key'), 'w') as fp:
+            fp.write("bucket=%s\nkey=benchmark\nsecret=benchmark\n" %
+                     self.bucket)
+
+
+class LocalMongoDB(object):
+    """Throwaway mongod server with its data in a temporary directory."""
+
+    def __init__(self, mongod='mongod'):
+        self.mongod = mongod
+        self.host = None
+        self._process = None
+        self._db_path = None
+
+    def __enter__(self):
+        if shutil.which(self.mongod) is None:
+            raise IOError(
+                "MongoDB stand-in requires %s, install MongoDB or pass the "
+                "host of a running server." % self.mongod)
+        port = _free_port()
+        self._db_path = tempfile.mkdtemp(prefix='netatmo_mongod_')
+        self._process = subprocess.Popen(
+            [self.mongod, '--dbpath', self._db_path, '--port', str(port),
+             '--bind_ip', '127.0.0.1', '--quiet'],
+            stdout=subprocess.DEVNULL)
+        self.host = 'mongodb://127.0.0.1:%d' % port
+        _wait_for_port(port)
+        return self
+
+    def __exit__(self, *exc):
+        self._process.terminate()
+        self._process.wait()
+        shutil.rmtree(self._db_path, ignore_errors=True)
+
+
+def run_benchmark(snapshot_config, file_count, configurations=CONFIGURATIONS,
+                  mongo_host=None, region=None):
+    """Ingest synthetic snapshots with every configuration.
+
+    parameters
+    ----------
+    snapshot_config: SnapshotConfig, settings of the synthetic snapshots.
+    file_count: int, number of snapshots, 10 minutes apart.
+    configurations: list (optional), of (name, IngestionService attributes)
+        tuples.
+    mongo_host: str (optional), host of a running MongoDB server. By default
+        a LocalMongoDB is started.
+    region: tuple (optional), bounding box of the DataRequest.
+
+    returns
+    -------
+    list of result dictionaries, one for every configuration.
+    """
+    start_datetime = datetime(2016, 5, 1)
+    request = DataRequest()
+    request.start_datetime = start_datetime
+    request.end_datetime = \
+        start_datetime + timedelta(minutes=10 * (file_count - 1))
+    request.time_resolution = 10
+    request.region = region
+
+    work_directory = tempfile.mkdtemp(prefix='netatmo_benchmark_')
+    working_directory = os.getcwd()
+    try:
+        logging.info("Generating %d snapshots of %d stations." %
+                     (file_count, snapshot_config.station_count))
+        snapshot_directory = os.path.join(work_directory, 'snapshots')
+        file_names = generate_snapshots(
+            snapshot_directory, start_datetime, file_count, snapshot_config)
+        snapshot_bytes = sum(
+            os.path.getsize(os.path.join(snapshot_directory, file_name))
+            for file_name in file_names)
+
+        with LocalS3() as s3:
+            s3.upload(snapshot_directory, file_names)
+            s3.write_credentials(work_directory)
+            # Workers read the AWS credentials relative to the working
+            # directory.
+            os.chdir(work_directory)
+            if mongo_host is not None:
+                return _run_configurations(
+                    request, configurations, s3.endpoint_url, mongo_host,
+                    snapshot_bytes)
+            with LocalMongoDB() as mongodb:
+                return _run_configurations(
+                    request, configurations, s3.endpoint_url, mongodb.host,
+                    snapshot_bytes)
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+def log_results(results):
+    """Log a table of benchmark results."""
+    logging.info(
+        "%-24s %8s %8s %10s %10s %12s %12s" %
+        ('configuration', 'files', 'seconds', 'files/s', 'stations/s',
+         'main MB', 'worker MB'))
+    for result in results:
+        logging.info(
+            "%-24s %8d %8.1f %10.2f %10.0f %12.1f %12.1f" %
+            (result['configuration'], result['files'], result['seconds'],
+             result['files_per_second'], result['stations_per_second'],
+             result['peak_rss_main_mb'], result['peak_rss_worker_mb']))
+
+
+def _run_configurations(request, configurations, endpoint_url, mongo_host,
+                        snapshot_bytes):
+    results = []
+    for name, settings in configurations:
+        client = pymongo.MongoClient(mongo_host)
+        client.drop_database('netatmo')
+        client.close()
+        logging.info("Running configuration %s." % name)
+        # Every configuration runs in a fresh process, so that its peak
+        # memory is measured separately.
+        result_queue = mp.Queue()
+        process = mp.Process(
+            target=_run_configuration,
+            args=(request, settings, endpoint_url, mongo_host, result_queue))
+        process.start()
+        result = result_queue.get()
+        process.join()
+        result['configuration'] = name
+        result['settings'] = settings
+        result['snapshot_bytes'] = snapshot_bytes
+        results.append(result)
+    return results
+
+
+def _run_configuration(request, settings, endpoint_url, mongo_host,
+                       result_queue):
+    """Run the IngestionService and put its result on the queue."""
+    logging.getLogger().setLevel(logging.WARNING)
+    service = IngestionService()
+    service.s3_endpoint_url = endpoint_url
+    service.db_host = mongo_host
+    for attribute, value in settings.items():
+        setattr(service, attribute, value)
+
+    start = time()
+    service.run(request)
+    seconds = time() - start
+
+    counters = service.metrics.snapshot(final=True)['counters']
+    files = counters.get('parse.files', 0)
+    stations = counters.get('write.stations', 0)
+    # Peak resident memory in kB on Linux. For the children, that of the
+    # largest worker process.
+    result_queue.put({
+        'files': files,
+        'failed_files': len(service.retry_scheduler.failed),
+        'stations_written': stations,
+        'seconds': seconds,
+        'files_per_second': files / seconds,
+        'stations_per_second': stations / seconds,
+        'peak_rss_main_mb':
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_rss_worker_mb':
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'counters': counters
+    })
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, timeout=30):
+    deadline = time() + timeout
+    while True:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            if time() > deadline:
+                raise
+            sleep(0.1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level='INFO'
+    )
+
+    parser = argparse.ArgumentParser(
+        description="End-to-end benchmark of the IngestionService.")
+    parser.add_argument('--stations', type=int, default=10000,
+                        help="number of stations per snapshot")
+    parser.add_argument('--files', type=int, default=6,
+                        help="number of snapshots")
+    parser.add_argument('--regions', default=None,
+                        help="region mix, e.g. netherlands=0.2,world=0.8, "
+                             "regions are %s" % ', '.join(sorted(REGIONS)))
+    parser.add_argument('--missing-data', type=float, default=None,
+                        help="fraction of records without data")
+    parser.add_argument('--missing-fields', type=float, default=None,
+                        help="probability of a measurement to be missing")
+    parser.add_argument('--request-region', default=None,
+                        help="region of the DataRequest, all by default")
+    parser.add_argument('--configurations', default=None,
+                        help="comma separated names of configurations, "
+                             "all by default")
+    parser.add_argument('--mongo-host', default=None,
+                        help="host of a running MongoDB server")
+    parser.add_argument('--output', default=None,
+                        help="json file to write the results to")
+    arguments = parser.parse_args()
+
+    snapshot_config = SnapshotConfig()
+    snapshot_config.station_count = arguments.stations
+    if arguments.regions is not None:
+        snapshot_config.regions = {
+            name: float(weight) for name, weight in
+            (part.split('=') for part in arguments.regions.split(','))
+        }
+    if arguments.missing_data is not None:
+        snapshot_config.missing_data_fraction = arguments.missing_data
+    if arguments.missing_fields is not None:
+        snapshot_config.missing_field_fraction = arguments.missing_fields
+
+    configurations = CONFIGURATIONS
+    if arguments.configurations is not None:
+        names = arguments.configurations.split(',')
+        configurations = [
+            configuration for configuration in CONFIGURATIONS
+            if configuration[0] in names
+        ]
+    request_region = None
+    if arguments.request_region is not None:
+        request_region = REGIONS[arguments.request_region]
+
+    benchmark_results = run_benchmark(
+        snapshot_config, arguments.files, configurations,
+        arguments.mongo_host, request_region)
+    log_results(benchmark_results)
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
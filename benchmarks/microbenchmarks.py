@@ -0,0 +1,243 @@
+"""Microbenchmarks of the parse, merge, spatial and resample hot paths.
+
+Every benchmark runs on synthetic snapshots at several scales, in stations
+per snapshot. A benchmark is timed a number of times on fresh inputs and the
+fastest time is kept, which is the least sensitive to other load.
+
+Results are compared with a stored baseline and the run fails if any
+benchmark is slower than its baseline by more than the threshold. Baselines
+depend on the machine, so record one on the machine that compares with it.
+
+Usage:
+    python -m benchmarks.microbenchmarks --save-baseline
+    python -m benchmarks.microbenchmarks --threshold 0.2
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import sys
+from datetime import datetime
+from time import perf_counter
+
+from benchmarks.synthetic_snapshots import SnapshotConfig, snapshot_records
+from domain.ingestion_service import (
+    MINIMUM_CHUNK_BYTES, _chunk_bounds, _iter_chunks, _station_bytes)
+from domain.json_parser import parse_stations
+from domain.merge import merge_documents
+from domain.mongodb_engine import _construct_station_upsert_query
+from domain.preprocessing import resample_and_interpolate
+from helpers.utils import select_near
+
+SCALES = (1000, 10000)
+BASELINE_PATH = os.path.join(
+    os.path.dirname(__file__), 'microbenchmark_baseline.json')
+# Number of snapshots parsed into the stations of a benchmark.
+SNAPSHOT_COUNT = 6
+
+
+def bench_parse_stations(snapshots):
+    records = snapshots[0]
+    return lambda: parse_stations(records, {})
+
+
+def bench_merge_documents(snapshots):
+    # Stations as read back from the database, one document per snapshot.
+    documents = []
+    for records in snapshots:
+        data_map = {}
+        parse_stations(records, data_map)
+        for station in data_map.values():
+            station.station_id = {'station_id': station.station_id}
+        documents.extend(data_map.values())
+    return lambda: merge_documents(documents)
+
+
+def bench_select_near(snapshots):
+    data_map = _parse_all(snapshots)
+    return lambda: select_near(data_map, 52.1, 5.2, radius=50000)
+
+
+def bench_split_stations(snapshots):
+    data_map = _parse_all(snapshots)
+
+    def run():
+        bounds = _chunk_bounds(_station_bytes(data_map), MINIMUM_CHUNK_BYTES)
+        for _ in _iter_chunks(data_map, bounds):
+            pass
+    return run
+
+
+def bench_construct_station_upsert_query(snapshots):
+    stations = _thermo_stations(_parse_all(snapshots)).values()
+
+    def run():
+        for station in stations:
+            _construct_station_upsert_query(station)
+    return run
+
+
+def bench_resample_and_interpolate(snapshots):
+    data_map = _thermo_stations(_parse_all(snapshots))
+
+    def run():
+        # Progress is printed per thousand stations.
+        with contextlib.redirect_stdout(io.StringIO()):
+            resample_and_interpolate(data_map)
+    return run
+
+
+# Benchmarks by name. Each takes the station records of the snapshots and
+# returns a function to time. Inputs are prepared again for every timing,
+# since some functions modify them.
+BENCHMARKS = {
+    'parse_stations': bench_parse_stations,
+    'merge_documents': bench_merge_documents,
+    'select_near': bench_select_near,
+    'split_stations': bench_split_stations,
+    '_construct_station_upsert_query': bench_construct_station_upsert_query,
+    'resample_and_interpolate': bench_resample_and_interpolate
+}
+
+
+def run_benchmarks(names=None, scales=SCALES, repeat=5, seed=0):
+    """Time benchmarks at every scale.
+
+    parameters
+    ----------
+    names: list (optional), names of BENCHMARKS to run, all by default.
+    scales: tuple (optional), numbers of stations per snapshot.
+    repeat: int (optional), number of timings of which the fastest is kept.
+    seed: int (optional), seed of the synthetic snapshots.
+
+    returns
+    -------
+    dict, mapping of 'name[scale]' to seconds.
+    """
+    if names is None:
+        names = list(BENCHMARKS)
+    results = {}
+    for scale in scales:
+        config = SnapshotConfig()
+        config.station_count = scale
+        config.seed = seed
+        snapshots = [
+            records for _, records in snapshot_records(
+                datetime(2016, 5, 1), SNAPSHOT_COUNT, config)
+        ]
+        for name in names:
+            timings = []
+            for _ in range(repeat):
+                benchmark = BENCHMARKS[name](snapshots)
+                start = perf_counter()
+                benchmark()
+                timings.append(perf_counter() - start)
+            key = '%s[%d]' % (name, scale)
+            results[key] = min(timings)
+            logging.info("%s: %.4f s" % (key, results[key]))
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    """Benchmarks slower than their baseline by more than threshold.
+
+    returns
+    -------
+    list of (key, seconds, baseline seconds) tuples.
+    """
+    return [
+        (key, seconds, baseline[key])
+        for key, seconds in sorted(results.items())
+        if key in baseline and seconds > baseline[key] * (1 + threshold)
+    ]
+
+
+def load_baseline(baseline_path=BASELINE_PATH):
+    with open(baseline_path, "r") as fp:
+        return json.load(fp)['results']
+
+
+def save_baseline(results, baseline_path=BASELINE_PATH):
+    with open(baseline_path, "w") as fp:
+        json.dump({
+            'machine': platform.node(),
+            'python': platform.python_version(),
+            'time': datetime.utcnow().isoformat(),
+            'results': results
+        }, fp, indent=2, sort_keys=True)
+
+
+def _parse_all(snapshots):
+    data_map = {}
+    for records in snapshots:
+        parse_stations(records, data_map)
+    return data_map
+
+
+def _thermo_stations(data_map):
+    """Stations with thermo observations, which both functions require."""
+    return {
+        station_id: station for station_id, station in data_map.items()
+        if len(station.thermo_module['valid_datetime']) > 0
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level='INFO'
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Microbenchmarks of the ingestion hot paths.")
+    parser.add_argument('--benchmarks', default=None,
+                        help="comma separated names of benchmarks, all by "
+                             "default: %s" % ', '.join(BENCHMARKS))
+    parser.add_argument('--scales', default=None,
+                        help="comma separated stations per snapshot, "
+                             "default %s" % ','.join(map(str, SCALES)))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help="json file with baseline results")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results as baseline")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="allowed relative slowdown, default 0.2")
+    arguments = parser.parse_args()
+
+    benchmark_names = None
+    if arguments.benchmarks is not None:
+        benchmark_names = arguments.benchmarks.split(',')
+    benchmark_scales = SCALES
+    if arguments.scales is not None:
+        benchmark_scales = [
+            int(scale) for scale in arguments.scales.split(',')]
+
+    benchmark_results = run_benchmarks(
+        benchmark_names, benchmark_scales, arguments.repeat)
+    if arguments.save_baseline:
+        if os.path.exists(arguments.baseline):
+            # Keep baselines of benchmarks that did not run.
+            benchmark_results = dict(
+                load_baseline(arguments.baseline), **benchmark_results)
+        save_baseline(benchmark_results, arguments.baseline)
+        logging.info("Baseline written to %s." % arguments.baseline)
+        sys.exit(0)
+
+    if not os.path.exists(arguments.baseline):
+        logging.error("No baseline at %s, run with --save-baseline first." %
+                      arguments.baseline)
+        sys.exit(2)
+    regressions = compare(
+        benchmark_results, load_baseline(arguments.baseline),
+        arguments.threshold)
+    for key, seconds, baseline_seconds in regressions:
+        logging.error("%s regressed: %.4f s, baseline %.4f s (+%.0f%%)." %
+                      (key, seconds, baseline_seconds,
+                       100 * (seconds / baseline_seconds - 1)))
+    if len(regressions) > 0:
+        sys.exit(1)
+    logging.info("No regressions beyond %.0f%%." % (100 * arguments.threshold))
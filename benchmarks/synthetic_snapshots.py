@@ -0,0 +1,198 @@
+"""Generator of synthetic NetAtmo snapshot files for benchmarks."""
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from domain.file_io import datetime_to_file_name, save_file
+
+# Bounding boxes of regions, top left and lower right lat-lon points as used
+# in DataRequest.
+REGIONS = {
+    'netherlands': (53.680, 2.865, 50.740, 7.323),
+    'western_europe': (59.0, -10.0, 42.0, 16.0),
+    'north_america': (50.0, -125.0, 25.0, -67.0),
+    'east_asia': (45.0, 100.0, 20.0, 145.0),
+    'world': (70.0, -180.0, -55.0, 180.0)
+}
+
+
+class SnapshotConfig(object):
+    """Settings of a synthetic set of snapshots."""
+
+    def __init__(self):
+        # Number of stations in every snapshot.
+        self.station_count = 10000
+        # Mapping of REGIONS names to the fraction of stations in them.
+        self.regions = {'netherlands': 0.2, 'western_europe': 0.5,
+                        'world': 0.3}
+        # Fraction of records without data, which the parser skips.
+        self.missing_data_fraction = 0.05
+        # Probability of every measurement to be missing from a record.
+        self.missing_field_fraction = 0.1
+        # Fractions of stations without a thermo module and with a rain
+        # gauge.
+        self.missing_thermo_fraction = 0.05
+        self.rain_gauge_fraction = 0.3
+        # Fraction of stations that did not report since the last snapshot
+        # and repeat their previous observation.
+        self.stale_fraction = 0.2
+        self.seed = 0
+
+
+def generate_snapshots(directory, start_datetime, file_count, config=None,
+                       time_resolution=10):
+    """Write synthetic snapshot files to a directory.
+
+    The files have the names and record layout of the archived snapshots.
+    Stations keep their id and location in all files and their measurements
+    drift between snapshots.
+
+    parameters
+    ----------
+    directory: str, directory to write to, created if it does not exist.
+    start_datetime: datetime.datetime, time of the first snapshot in UTC.
+    file_count: int, number of snapshots.
+    config: SnapshotConfig (optional), settings of the snapshots.
+    time_resolution: int (optional), minutes between snapshots.
+
+    returns
+    -------
+    list of file names, in order of time.
+    """
+    os.makedirs(directory, exist_ok=True)
+    file_names = []
+    for timestamp, records in snapshot_records(
+            start_datetime, file_count, config, time_resolution):
+        file_name = datetime_to_file_name(timestamp)
+        save_file(records, os.path.join(directory, file_name))
+        file_names.append(file_name)
+    return file_names
+
+
+def snapshot_records(start_datetime, file_count, config=None,
+                     time_resolution=10):
+    """Generate the station records of synthetic snapshots in memory.
+
+    See generate_snapshots for the parameters.
+
+    returns
+    -------
+    generator of (timestamp, list of station records) tuples.
+    """
+    if config is None:
+        config = SnapshotConfig()
+    generator = _SnapshotGenerator(config)
+    for index in range(file_count):
+        timestamp = start_datetime + timedelta(minutes=index * time_resolution)
+        yield timestamp, generator.snapshot(timestamp)
+
+
+class _SnapshotGenerator(object):
+    """State of the stations of consecutive snapshots."""
+
+    def __init__(self, config):
+        self.config = config
+        self.random = np.random.default_rng(config.seed)
+        count = config.station_count
+
+        names = sorted(config.regions)
+        weights = np.array([config.regions[name] for name in names],
+                           dtype=np.float64)
+        regions = self.random.choice(
+            len(names), size=count, p=weights / weights.sum())
+        boxes = np.array([REGIONS[name] for name in names])[regions]
+        self.latitudes = np.round(self.random.uniform(
+            boxes[:, 2], boxes[:, 0]), 6)
+        self.longitudes = np.round(self.random.uniform(
+            boxes[:, 1], boxes[:, 3]), 6)
+        serials = self.random.permutation(1 << 24)[:count]
+        self.station_ids = [
+            "70:ee:50:%02x:%02x:%02x" %
+            (serial >> 16, (serial >> 8) & 0xff, serial & 0xff)
+            for serial in serials.tolist()
+        ]
+        self.altitudes = self.random.integers(-5, 500, size=count)
+        self.thermo = \
+            self.random.random(count) >= config.missing_thermo_fraction
+        self.rain_gauge = \
+            self.random.random(count) < config.rain_gauge_fraction
+
+        self.temperatures = 25 - 0.4 * np.abs(self.latitudes) + \
+            self.random.normal(0, 3, count)
+        self.humidities = self.random.uniform(40, 90, count)
+        self.pressures = self.random.normal(1013, 8, count)
+        self.daily_rain = np.zeros(count)
+        self.times = None
+        self.day = None
+
+    def snapshot(self, timestamp):
+        """List of station records of the next snapshot."""
+        config = self.config
+        count = config.station_count
+        epoch = int((timestamp - datetime(1970, 1, 1)).total_seconds())
+
+        reported = self.random.random(count) >= config.stale_fraction
+        if self.times is None:
+            reported[:] = True
+            self.times = np.zeros(count, dtype=np.int64)
+        self.times[reported] = \
+            epoch - self.random.integers(0, 600, size=count)[reported]
+        self.temperatures[reported] += \
+            self.random.normal(0, 0.3, count)[reported]
+        self.humidities[reported] = np.clip(
+            self.humidities[reported] +
+            self.random.normal(0, 1, count)[reported], 5, 100)
+        self.pressures[reported] += self.random.normal(0, 0.2, count)[reported]
+        raining = reported & self.rain_gauge & \
+            (self.random.random(count) < 0.1)
+        if timestamp.date() != self.day:
+            self.daily_rain[:] = 0
+            self.day = timestamp.date()
+        hourly_rain = np.zeros(count)
+        hourly_rain[raining] = np.round(
+            self.random.exponential(0.5, count)[raining], 3)
+        self.daily_rain += hourly_rain
+
+        has_data = self.random.random(count) >= config.missing_data_fraction
+        missing = \
+            self.random.random((3, count)) < config.missing_field_fraction
+        columns = (
+            self.station_ids, self.latitudes.tolist(),
+            self.longitudes.tolist(), self.altitudes.tolist(),
+            self.times.tolist(),
+            np.round(self.temperatures, 1).tolist(),
+            np.round(self.humidities).astype(np.int64).tolist(),
+            np.round(self.pressures, 1).tolist(), hourly_rain.tolist(),
+            np.round(self.daily_rain, 3).tolist(), has_data.tolist(),
+            self.thermo.tolist(), self.rain_gauge.tolist(), missing.T.tolist()
+        )
+
+        records = []
+        for station_id, latitude, longitude, altitude, time_utc, \
+                temperature, humidity, pressure, hourly, daily, data, \
+                thermo, rain_gauge, (no_temperature, no_humidity,
+                                     no_pressure) in zip(*columns):
+            record = {
+                '_id': station_id,
+                'location': [longitude, latitude],
+                'altitude': altitude
+            }
+            if data:
+                station_data = {}
+                if thermo:
+                    station_data['time_utc'] = time_utc
+                    if not no_temperature:
+                        station_data['Temperature'] = temperature
+                    if not no_humidity:
+                        station_data['Humidity'] = humidity
+                    if not no_pressure:
+                        station_data['Pressure'] = pressure
+                if rain_gauge:
+                    station_data['time_day_rain'] = time_utc
+                    station_data['time_hour_rain'] = time_utc
+                    station_data['Rain'] = daily
+                    station_data['sum_rain_1'] = hourly
+                record['data'] = station_data
+            records.append(record)
+        return records
@@ -1,22 +1,54 @@
+import asyncio
+import io
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from time import time
+
 from boto3 import Session
+from botocore.config import Config
 
 
 class S3Bucket(Session):
     """Connector class for a AWS S3 bucket."""
 
-    def __init__(self, bucket, aws_access_key_id, aws_secret_access_key):
-        """Initialize an AWS S3 connector for a specific bucket."""
+    def __init__(self, bucket, aws_access_key_id, aws_secret_access_key,
+                 endpoint_url=None, cache=None):
+        """Initialize an AWS S3 connector for a specific bucket.
+
+        endpoint_url points the connector to an S3 compatible service other
+        than AWS, for example a local stand-in. With an S3ObjectCache, read
+        serves unchanged files from local disk.
+        """
         super(S3Bucket, self).__init__(
             aws_access_key_id,
             aws_secret_access_key,
             region_name='eu-west-1'
         )
-        self.bucket = self.resource('s3').Bucket(bucket)
+        self.bucket = self.resource(
+            's3', endpoint_url=endpoint_url).Bucket(bucket)
+        self.cache = cache
 
     def read(self, file_path):
         """Download a file from S3."""
+        if self.cache is not None:
+            data, _ = self.cache.read(
+                self.bucket.meta.client, self.bucket.name, file_path)
+            return data
         return self.bucket.Object(file_path).get()['Body'].read()
 
+    def open(self, file_path):
+        """Open a file on S3 as a readable stream."""
+        return self.bucket.Object(file_path).get()['Body']
+
+    def list(self, prefix=''):
+        """List (key, size) tuples of files under a prefix."""
+        return [
+            (obj.key, obj.size)
+            for obj in self.bucket.objects.filter(Prefix=prefix)
+        ]
+
     def write(self, file_path, data):
         """Upload a new file to S3.
 
@@ -37,3 +69,255 @@ class S3Bucket(Session):
     def update(self, file_data, *args, **kwargs):
         """Update a file in S3."""
         raise NotImplementedError("Update is not implemented.")
+
+
+class AsyncS3Reader(object):
+    """Concurrent downloader for files of a single S3 bucket.
+
+    A single long-lived client, with a connection pool of max_in_flight
+    connections, serves all downloads. boto3 clients are blocking but thread
+    safe, so every GET runs in a thread pool and is awaited from asyncio.
+    """
+
+    def __init__(self, bucket, aws_access_key_id, aws_secret_access_key,
+                 max_in_flight=32, endpoint_url=None, cache=None):
+        """Initialize a reader.
+
+        parameters
+        ----------
+        bucket: str, name of the S3 bucket.
+        aws_access_key_id: str
+        aws_secret_access_key: str
+        max_in_flight: int (optional), maximum number of concurrent GETs.
+        endpoint_url: str (optional), url of an S3 compatible service.
+        cache: S3ObjectCache (optional), local cache of downloaded files.
+        """
+        session = Session(
+            aws_access_key_id,
+            aws_secret_access_key,
+            region_name='eu-west-1'
+        )
+        self.bucket = bucket
+        self.max_in_flight = max_in_flight
+        self.cache = cache
+        self.client = session.client(
+            's3', endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=max_in_flight))
+        self._executor = ThreadPoolExecutor(max_in_flight)
+
+    async def read(self, file_path):
+        """Download a file from S3, returns its contents and ETag."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._read, file_path)
+
+    def _read(self, file_path):
+        if self.cache is not None:
+            return self.cache.read(self.client, self.bucket, file_path)
+        response = self.client.get_object(Bucket=self.bucket, Key=file_path)
+        return response['Body'].read(), response['ETag']
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamBuffer(io.RawIOBase):
+    """Readable stream of a file that is downloaded in the background.
+
+    A download thread appends chunks while a reader consumes them, so the
+    reader starts on the first bytes and blocks only when it catches up with
+    the download. A failed download raises its error in the reader.
+    """
+
+    def __init__(self, file_path):
+        super(StreamBuffer, self).__init__()
+        self.file_path = file_path
+        # Content length in bytes and ETag of the object, known once the
+        # response arrives.
+        self.size = None
+        self.etag = None
+        # Seconds waiting for a connection, downloading, and blocked in
+        # reads waiting for data.
+        self.connection_wait_seconds = 0.0
+        self.download_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._chunks = deque()
+        self._offset = 0
+        self._done = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        with self._condition:
+            start = time()
+            while len(self._chunks) == 0 and not self._done:
+                self._condition.wait()
+            self.wait_seconds += time() - start
+            if len(self._chunks) == 0:
+                if self._error is not None:
+                    raise self._error
+                return 0
+            chunk = self._chunks[0]
+            count = min(len(b), len(chunk) - self._offset)
+            b[:count] = chunk[self._offset:self._offset + count]
+            self._offset += count
+            if self._offset == len(chunk):
+                self._chunks.popleft()
+                self._offset = 0
+            return count
+
+    def wait_for_size(self):
+        """Block until the response arrives and return the content length."""
+        with self._condition:
+            while self.size is None and not self._done:
+                self._condition.wait()
+            if self.size is None:
+                raise self._error
+            return self.size
+
+    def _start(self, size, etag=None):
+        with self._condition:
+            self.size = size
+            self.etag = etag
+            self._condition.notify_all()
+
+    def _append(self, chunk):
+        with self._condition:
+            self._chunks.append(memoryview(chunk))
+            self._condition.notify_all()
+
+    def _finish(self, error=None):
+        with self._condition:
+            self._done = True
+            self._error = error
+            self._condition.notify_all()
+
+
+class S3Prefetcher(object):
+    """Background downloader of the files of a single S3 bucket.
+
+    Every fetched file is streamed into a StreamBuffer by a thread pool of
+    prefetch_count + 1 threads, so the file being read and the next
+    prefetch_count files download while the current one is parsed. Buffered
+    files are held in memory until they are read.
+    """
+
+    chunk_size = 2 ** 16
+
+    def __init__(self, bucket, aws_access_key_id, aws_secret_access_key,
+                 prefetch_count=2, endpoint_url=None, semaphore=None,
+                 cache=None):
+        """Initialize a prefetcher.
+
+        parameters
+        ----------
+        bucket: str, name of the S3 bucket.
+        aws_access_key_id: str
+        aws_secret_access_key: str
+        prefetch_count: int (optional), number of files downloaded ahead of
+            the file being read.
+        endpoint_url: str (optional), url of an S3 compatible service.
+        semaphore: semaphore (optional), held during every download to
+            limit the number of connections.
+        cache: S3ObjectCache (optional), local cache of downloaded files.
+            Cached files are not streamed, but read at once.
+        """
+        session = Session(
+            aws_access_key_id,
+            aws_secret_access_key,
+            region_name='eu-west-1'
+        )
+        self.bucket = bucket
+        self.prefetch_count = prefetch_count
+        self.semaphore = semaphore
+        self.cache = cache
+        self.client = session.client(
+            's3', endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=prefetch_count + 1))
+        self._executor = ThreadPoolExecutor(prefetch_count + 1)
+
+    def fetch(self, file_path):
+        """Start downloading a file, returns its StreamBuffer."""
+        buffer = StreamBuffer(file_path)
+        self._executor.submit(self._download, buffer)
+        return buffer
+
+    def prefetch(self, file_paths):
+        """Yield a StreamBuffer for every file, in order.
+
+        The next prefetch_count files are downloading while a file is read.
+        """
+        file_paths = iter(file_paths)
+        buffers = deque(
+            self.fetch(file_path)
+            for file_path in islice(file_paths, self.prefetch_count + 1))
+        while len(buffers) > 0:
+            yield buffers.popleft()
+            for file_path in islice(file_paths, 1):
+                buffers.append(self.fetch(file_path))
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _download(self, buffer):
+        try:
+            wait_start = time()
+            if self.semaphore is not None:
+                self.semaphore.acquire()
+            try:
+                start = time()
+                buffer.connection_wait_seconds = start - wait_start
+                if self.cache is None or not self._read_cached(buffer):
+                    self._stream(buffer)
+                buffer.download_seconds = time() - start
+            finally:
+                if self.semaphore is not None:
+                    self.semaphore.release()
+        except Exception as e:
+            # Raised in the reader.
+            buffer._finish(e)
+            return
+        buffer._finish()
+
+    def _read_cached(self, buffer):
+        """Fill a buffer from the cache, returns False if not cached."""
+        etag = self.client.head_object(
+            Bucket=self.bucket, Key=buffer.file_path)['ETag']
+        data = self.cache.get(self.bucket, buffer.file_path, etag)
+        if data is None:
+            return False
+        buffer._start(len(data), etag)
+        buffer._append(data)
+        return True
+
+    def _stream(self, buffer):
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=buffer.file_path)
+        buffer._start(response['ContentLength'], response['ETag'])
+        chunks = []
+        for chunk in response['Body'].iter_chunks(self.chunk_size):
+            if buffer.closed:
+                # The reader has stopped, skip the rest.
+                response['Body'].close()
+                return
+            buffer._append(chunk)
+            if self.cache is not None:
+                chunks.append(chunk)
+        if self.cache is not None:
+            self.cache.put(self.bucket, buffer.file_path, response['ETag'],
+                           b''.join(chunks))
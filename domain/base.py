@@ -1,4 +1,24 @@
 """Module with base objects for NetAtmo data processing."""
+import calendar
+import struct
+from array import array
+from datetime import datetime
+
+import numpy as np
+
+# Observation fields per module, times in the first and values in the second.
+THERMO_TIME_FIELDS = ('valid_datetime',)
+THERMO_VALUE_FIELDS = ('temperature', 'humidity', 'pressure')
+HYDRO_TIME_FIELDS = ('time_day_rain', 'time_hour_rain')
+HYDRO_VALUE_FIELDS = ('daily_rain_sum', 'hourly_rain_sum')
+
+# Packed observations start with the format version and the thermo and hydro
+# observation counts, see Station.to_binary.
+BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct('<BII')
+_THERMO_BASES = struct.Struct('<%dq' % len(THERMO_TIME_FIELDS))
+_HYDRO_BASES = struct.Struct('<%dq' % len(HYDRO_TIME_FIELDS))
+_MAX_EPOCH_DELTA = 2 ** 31 - 1
 
 
 class DataRequest(object):
@@ -13,12 +33,21 @@ class DataRequest(object):
         # None is world-wide, else provide a tuple four entries marking the
         # top left and lower right lat-lon points of the bounding box.
         self.region = None
+        # Number of worker processes used to parse files. None or 1 parses
+        # all files serially in the calling process.
+        self.worker_count = None
+        # Whether to parse into CompactStation instead of Station objects.
+        self.compact_stations = False
+        # Optional list of data file names. When given, only these files are
+        # requested instead of every file in the time range, for example to
+        # replay the files that failed in an ingestion run.
+        self.file_names = None
 
 
 class DataResponse(object):
     """Simple response class as result of querying file system."""
     def __init__(self):
-        # Map from station ids to station objects
+        # Map from station ids to station objects, or a StationTable
         self.data_map = {}
 
 
@@ -56,3 +85,334 @@ class Station(object):
         station.thermo_module = d['thermo_module']
         station.hydro_module = d['hydro_module']
         return station
+
+    def to_binary(self):
+        """Pack the observations in bytes.
+
+        MongoDBConnector stores them as a BSON Binary of binary_subtype.
+        Every time field is stored as the int64 epoch seconds of its first
+        observation followed by int32 differences to the previous one, every
+        value field as float32 with nan for missing values. Station metadata
+        is not included.
+        """
+        thermo_module = self.thermo_module or {}
+        hydro_module = self.hydro_module or {}
+        return _pack_observations(
+            [_to_epochs(thermo_module.get(field, []))
+             for field in THERMO_TIME_FIELDS],
+            [thermo_module.get(field, []) for field in THERMO_VALUE_FIELDS],
+            [_to_epochs(hydro_module.get(field, []))
+             for field in HYDRO_TIME_FIELDS],
+            [hydro_module.get(field, []) for field in HYDRO_VALUE_FIELDS])
+
+    @classmethod
+    def from_binary(cls, binary, station_id=None, lat=None, lon=None):
+        """Create a station from observations packed by to_binary.
+
+        The modules hold numpy arrays instead of lists, datetime64[s] for
+        times and float32 for values.
+        """
+        station = cls(station_id, lat, lon)
+        station.thermo_module, station.hydro_module = \
+            _unpack_observations([binary])
+        return station
+
+    @classmethod
+    def from_binary_document(cls, document):
+        """Create a station from a document with packed observations.
+
+        The packed observations of the document, appended to its series
+        field by every write, are decoded as in from_binary and
+        concatenated in order.
+        """
+        station = cls(document['station_id'], document['latitude'],
+                      document['longitude'])
+        station.elevation = document.get('elevation')
+        station.thermo_module, station.hydro_module = \
+            _unpack_observations(document.get('series', []))
+        return station
+
+
+class CompactStation(object):
+    """Memory efficient variant of Station.
+
+    Observations are stored in typed arrays, with times as UTC epoch seconds.
+    The thermo_module and hydro_module attributes of Station are available as
+    read-only properties, which convert to lists of datetimes when asked.
+    """
+
+    __slots__ = (
+        'station_id', 'latitude', 'longitude', 'elevation', 'alias',
+        '_thermo_times', '_thermo_values', '_hydro_times', '_hydro_values'
+    )
+
+    binary_subtype = Station.binary_subtype
+
+    thermo_time_fields = THERMO_TIME_FIELDS
+    thermo_value_fields = THERMO_VALUE_FIELDS
+    hydro_time_fields = HYDRO_TIME_FIELDS
+    hydro_value_fields = HYDRO_VALUE_FIELDS
+
+    def __init__(self, station_id, lat, lon):
+        self.station_id = station_id
+        self.latitude = lat
+        self.longitude = lon
+        self.elevation = None
+        self.alias = None
+
+        self._thermo_times = {f: array('q') for f in self.thermo_time_fields}
+        self._thermo_values = {f: array('d') for f in self.thermo_value_fields}
+        self._hydro_times = {f: array('q') for f in self.hydro_time_fields}
+        self._hydro_values = {f: array('d') for f in self.hydro_value_fields}
+
+    def add_thermo(self, time_utc, temperature, humidity, pressure):
+        """Append a thermo observation, skipping a duplicate valid time.
+
+        parameters
+        ----------
+        time_utc: int, valid time in UTC epoch seconds.
+        temperature, humidity, pressure: float, nan if missing.
+        """
+        valid_datetime = self._thermo_times['valid_datetime']
+        if len(valid_datetime) > 0 and valid_datetime[-1] == time_utc:
+            return False
+        valid_datetime.append(time_utc)
+        self._thermo_values['temperature'].append(temperature)
+        self._thermo_values['humidity'].append(humidity)
+        self._thermo_values['pressure'].append(pressure)
+        return True
+
+    def add_hydro(self, time_day_rain, time_hour_rain, daily_rain_sum,
+                  hourly_rain_sum):
+        """Append a hydro observation, times in UTC epoch seconds."""
+        self._hydro_times['time_day_rain'].append(time_day_rain)
+        self._hydro_times['time_hour_rain'].append(time_hour_rain)
+        self._hydro_values['daily_rain_sum'].append(daily_rain_sum)
+        self._hydro_values['hourly_rain_sum'].append(hourly_rain_sum)
+
+    def extend(self, other, drop_duplicate=False):
+        """Append the observations of another CompactStation.
+
+        parameters
+        ----------
+        other: CompactStation object
+        drop_duplicate: bool (optional), skip the first thermo observation
+            of other if it has the last valid time of this station.
+
+        returns
+        -------
+        bool, whether a duplicate thermo observation was dropped.
+        """
+        start = 0
+        valid_datetime = self._thermo_times['valid_datetime']
+        other_datetime = other._thermo_times['valid_datetime']
+        if drop_duplicate and len(valid_datetime) > 0 and \
+           len(other_datetime) > 0 and \
+           valid_datetime[-1] == other_datetime[0]:
+            start = 1
+
+        for module, other_module in (
+                (self._thermo_times, other._thermo_times),
+                (self._thermo_values, other._thermo_values)):
+            for field in module:
+                module[field].extend(other_module[field][start:])
+        for module, other_module in (
+                (self._hydro_times, other._hydro_times),
+                (self._hydro_values, other._hydro_values)):
+            for field in module:
+                module[field].extend(other_module[field])
+        return start == 1
+
+    @property
+    def thermo_module(self):
+        return _module_to_lists(self._thermo_times, self._thermo_values)
+
+    @property
+    def hydro_module(self):
+        return _module_to_lists(self._hydro_times, self._hydro_values)
+
+    def thermo_epochs(self, field='valid_datetime'):
+        """Return the thermo times of a field in UTC epoch seconds."""
+        return self._thermo_times[field]
+
+    def hydro_epochs(self, field='time_hour_rain'):
+        """Return the hydro times of a field in UTC epoch seconds."""
+        return self._hydro_times[field]
+
+    def to_station(self):
+        """Convert to a Station object."""
+        station = Station(self.station_id, self.latitude, self.longitude)
+        station.elevation = self.elevation
+        if self.alias is not None:
+            station.alias = self.alias
+        station.thermo_module = self.thermo_module
+        station.hydro_module = self.hydro_module
+        return station
+
+    @classmethod
+    def from_station(cls, station):
+        """Convert a Station object."""
+        compact = cls(station.station_id, station.latitude, station.longitude)
+        compact.elevation = station.elevation
+        compact.alias = getattr(station, 'alias', None)
+        compact._set_modules(station.thermo_module, station.hydro_module)
+        return compact
+
+    def to_binary(self):
+        """Pack the observations as Station.to_binary does."""
+        return _pack_observations(
+            [self._thermo_times[field] for field in THERMO_TIME_FIELDS],
+            [self._thermo_values[field] for field in THERMO_VALUE_FIELDS],
+            [self._hydro_times[field] for field in HYDRO_TIME_FIELDS],
+            [self._hydro_values[field] for field in HYDRO_VALUE_FIELDS])
+
+    @classmethod
+    def from_dict(cls, d):
+        station = cls(d['_id'], d['latitude'], d['longitude'])
+        station.elevation = d['elevation']
+        station._set_modules(d['thermo_module'], d['hydro_module'])
+        return station
+
+    def _set_modules(self, thermo_module, hydro_module):
+        for module, source, typecode, convert in (
+                (self._thermo_times, thermo_module, 'q', _to_epoch),
+                (self._thermo_values, thermo_module, 'd', float),
+                (self._hydro_times, hydro_module, 'q', _to_epoch),
+                (self._hydro_values, hydro_module, 'd', float)):
+            for field in module:
+                module[field] = array(typecode, map(convert, source[field]))
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+
+def _module_to_lists(times, values):
+    module = {
+        field: [datetime.utcfromtimestamp(t) for t in field_times]
+        for field, field_times in times.items()
+    }
+    for field, field_values in values.items():
+        module[field] = field_values.tolist()
+    return module
+
+
+def _to_epoch(timestamp):
+    """Convert a naive UTC datetime to epoch seconds."""
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def _to_epochs(times):
+    """Convert naive UTC datetimes to an int64 array of epoch seconds."""
+    return np.asarray(times, dtype='datetime64[s]').astype(np.int64)
+
+
+def _pack_observations(thermo_times, thermo_values, hydro_times,
+                       hydro_values):
+    """Pack lists of time and value fields per module in bytes.
+
+    Every module with observations is stored as the first epoch of each time
+    field, followed by the deltas of all time fields and the values of all
+    value fields, so it decodes into two matrices.
+    """
+    thermo_count = len(thermo_times[0])
+    hydro_count = len(hydro_times[0])
+    parts = [_BINARY_HEADER.pack(BINARY_VERSION, thermo_count, hydro_count)]
+    for times, values, count in ((thermo_times, thermo_values, thermo_count),
+                                 (hydro_times, hydro_values, hydro_count)):
+        if count == 0:
+            continue
+        epochs = np.array(times, dtype=np.int64)
+        deltas = np.diff(epochs, axis=1, prepend=epochs[:, :1])
+        if np.abs(deltas).max() > _MAX_EPOCH_DELTA:
+            raise ValueError("Observation times too far apart to pack.")
+        parts.append(epochs[:, 0].astype('<i8').tobytes())
+        parts.append(deltas.astype('<i4').tobytes())
+        parts.append(np.array(values, dtype='<f4').tobytes())
+    return b''.join(parts)
+
+
+def _unpack_observations(binaries):
+    """Decode and concatenate packed observations into numpy modules."""
+    thermo_module, hydro_module, _, _ = unpack_binaries(binaries)
+    for module, time_fields in ((thermo_module, THERMO_TIME_FIELDS),
+                                (hydro_module, HYDRO_TIME_FIELDS)):
+        for field in time_fields:
+            module[field] = module[field].view('datetime64[s]')
+    return thermo_module, hydro_module
+
+
+def unpack_binaries(binaries):
+    """Decode observations packed by Station.to_binary in a single pass.
+
+    The module blocks of all binaries are gathered first and decoded at
+    once, which is much faster than decoding binaries one by one when there
+    are many small ones.
+
+    parameters
+    ----------
+    binaries: iterable of bytes or BSON Binary objects.
+
+    returns
+    -------
+    tuple of the thermo and hydro modules, mappings of fields to arrays
+    concatenated over all binaries with times in int64 epoch seconds and
+    values as float32, and arrays with the thermo and hydro observation
+    counts of every binary.
+    """
+    layouts = ((THERMO_TIME_FIELDS, THERMO_VALUE_FIELDS, _THERMO_BASES),
+               (HYDRO_TIME_FIELDS, HYDRO_VALUE_FIELDS, _HYDRO_BASES))
+    counts = ([], [])
+    bases = ([], [])
+    blocks = ([], [])
+    for data in binaries:
+        version, thermo_count, hydro_count = \
+            _BINARY_HEADER.unpack_from(data)
+        if version != BINARY_VERSION:
+            raise ValueError(
+                "Unknown packed observation version %d." % version)
+        offset = _BINARY_HEADER.size
+        for module, count in enumerate((thermo_count, hydro_count)):
+            counts[module].append(count)
+            if count == 0:
+                continue
+            time_fields, value_fields, base_struct = layouts[module]
+            bases[module].extend(base_struct.unpack_from(data, offset))
+            offset += base_struct.size
+            # Deltas are int32 and values float32, both of 4 bytes.
+            end = offset + 4 * count * (len(time_fields) + len(value_fields))
+            blocks[module].append(data[offset:end])
+            offset = end
+
+    modules = []
+    for module, (time_fields, value_fields, _) in enumerate(layouts):
+        module_counts = np.array(counts[module], dtype=np.int64)
+        sizes = module_counts[module_counts > 0]
+        field_count = len(time_fields) + len(value_fields)
+        words = np.frombuffer(b''.join(blocks[module]), dtype='<i4')
+        # Every block holds the observations of one field after another.
+        block_starts = np.zeros(len(sizes), dtype=np.int64)
+        np.cumsum(sizes[:-1] * field_count, out=block_starts[1:])
+        starts = np.zeros(len(sizes), dtype=np.int64)
+        np.cumsum(sizes[:-1], out=starts[1:])
+        index = np.arange(int(sizes.sum())) + \
+            np.repeat(block_starts - starts, sizes)
+        field_stride = np.repeat(sizes, sizes)
+        module_bases = np.array(bases[module], dtype=np.int64).reshape(
+            len(sizes), len(time_fields))
+
+        arrays = {}
+        for i, field in enumerate(time_fields):
+            deltas = words[index + i * field_stride]
+            # The first delta of every binary is zero, so subtracting the
+            # running sum at its start restarts the sum in every binary.
+            epochs = np.cumsum(deltas, dtype=np.int64)
+            epochs += np.repeat(module_bases[:, i] - epochs[starts], sizes)
+            arrays[field] = epochs
+        for i, field in enumerate(value_fields, len(time_fields)):
+            arrays[field] = words[index + i * field_stride].view(np.float32)
+        modules.append((arrays, module_counts))
+    return modules[0][0], modules[1][0], modules[0][1], modules[1][1]
@@ -0,0 +1,149 @@
+"""Module with a size bounded on-disk cache, shared by the caches."""
+import logging
+import os
+import tempfile
+import threading
+
+
+class DiskCache(object):
+    """Size bounded on-disk cache of entry files.
+
+    When the total size exceeds max_bytes, least recently used entries are
+    evicted until it is below low_water times max_bytes, so that a scan of
+    the cache directory makes room for many entries. Recency is tracked with
+    the modification time of entry files. Entries are written atomically, so
+    multiple processes can share a cache directory.
+
+    The total size is counted in memory between scans. Entries that other
+    processes write or evict are only accounted for in the next scan.
+
+    Subclasses define the suffix of entry files, the name in log messages
+    and how entries are read and written, see _read_entry and _write_entry.
+    """
+
+    suffix = '.entry'
+    name = 'Disk cache'
+    # Errors of reading an entry, besides OSError, that count as a miss.
+    read_errors = ()
+    # Fraction of max_bytes that eviction frees the cache down to.
+    low_water = 0.8
+
+    def __init__(self, directory, max_bytes):
+        """Initialize a cache.
+
+        parameters
+        ----------
+        directory: str, cache directory, created if it does not exist.
+        max_bytes: int, maximum total size of cache entries.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Total size of entries, None until the directory is scanned.
+        self._total_bytes = None
+        # Entries may be read and written from several threads of a process.
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def evict(self):
+        """Remove least recently used entries if the cache is full.
+
+        Entries are removed until the total size is within low_water times
+        max_bytes.
+        """
+        with self._lock:
+            self._total_bytes = self._evict()
+
+    def _evict(self):
+        """Scan the cache directory and evict, returns the total size."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_bytes = sum(entry[1] for entry in entries)
+        if total_bytes <= self.max_bytes:
+            return total_bytes
+        entries.sort()
+        for _, size, name in entries:
+            if total_bytes <= self.low_water * self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                # Already evicted by another process.
+                pass
+            total_bytes -= size
+        return total_bytes
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def log_stats(self):
+        logging.info("%s: %d hits, %d misses (%.1f%% hit ratio)." %
+                     (self.name, self.hits, self.misses,
+                      100 * self.hit_ratio()))
+
+    def _read_entry(self, key, read):
+        """Read an entry with read(fp), None if it is not cached."""
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'rb') as fp:
+                entry = read(fp)
+            # Mark entry as recently used.
+            os.utime(entry_path)
+        except (OSError,) + self.read_errors:
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return entry
+
+    def _write_entry(self, key, write):
+        """Store an entry with write(fp) and evict entries if full."""
+        entry_path = self._entry_path(key)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                write(fp)
+                size = fp.tell()
+            try:
+                # A replaced entry no longer counts.
+                size -= os.path.getsize(entry_path)
+            except OSError:
+                pass
+            os.replace(temp_path, entry_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size
+            if self._total_bytes is None or \
+               self._total_bytes > self.max_bytes:
+                self._total_bytes = self._evict()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
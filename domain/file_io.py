@@ -1,11 +1,21 @@
+import codecs
 import gzip
 import json
+import multiprocessing as mp
 import os
+import re
 from datetime import timedelta, datetime
+from itertools import islice
+from time import time
 
-from domain.aws_engine import S3Bucket
-from domain.base import DataRequest, DataResponse
-from domain.json_parser import parse_stations, log_parse_stats
+import numpy as np
+
+from domain.aws_engine import S3Bucket, S3Prefetcher
+from domain.base import DataRequest, DataResponse, Station, CompactStation
+from domain.json_parser import (
+    parse_stations, parse_stations_table, log_parse_stats, region_mask)
+from domain.merge import merge_data_maps
+from domain.station_table import concat_tables
 from helpers import utils
 
 
@@ -28,9 +38,9 @@ def save_file_aws(obj, file_path, aws_credentials):
     bucket_engine.write(file_path, data)
 
 
-def load_file_aws(file_path, aws_credentials):
-    """Load a compressed json file from S3."""
-    bucket_engine = S3Bucket(*aws_credentials)
+def load_file_aws(file_path, aws_credentials, cache=None):
+    """Load a compressed json file from S3, through an optional cache."""
+    bucket_engine = S3Bucket(*aws_credentials, cache=cache)
     return json.loads(
         gzip.decompress(
             bucket_engine.read(file_path)
@@ -38,6 +48,159 @@ def load_file_aws(file_path, aws_credentials):
     )
 
 
+def load_raw_file_aws(file_path, aws_credentials, endpoint_url=None,
+                      cache=None):
+    """Download a compressed json file from S3 without decompressing it."""
+    bucket_engine = S3Bucket(
+        *aws_credentials, endpoint_url=endpoint_url, cache=cache)
+    return bucket_engine.read(file_path)
+
+
+def stream_file(file_path, region=None):
+    """Open a compressed json file on disk as a stream of station records."""
+    return SnapshotReader(open(file_path, "rb"), region)
+
+
+def stream_file_aws(file_path, aws_credentials, region=None):
+    """Open a compressed json file on S3 as a stream of station records."""
+    bucket_engine = S3Bucket(*aws_credentials)
+    return SnapshotReader(bucket_engine.open(file_path), region)
+
+
+def stream_files_aws(file_paths, aws_credentials, region=None,
+                     prefetch_count=2, endpoint_url=None, cache=None):
+    """Open compressed json files on S3 as streams of station records.
+
+    Files are downloaded in the background, prefetch_count files ahead of
+    the one being read, so downloading, decompression and parsing overlap.
+    Files in the optional S3ObjectCache are read from local disk.
+
+    returns
+    -------
+    generator of (file path, SnapshotReader) tuples, in order of file_paths.
+    """
+    with S3Prefetcher(*aws_credentials, prefetch_count=prefetch_count,
+                      endpoint_url=endpoint_url, cache=cache) as prefetcher:
+        for buffer in prefetcher.prefetch(file_paths):
+            yield buffer.file_path, SnapshotReader(buffer, region)
+
+
+class SnapshotReader(object):
+    """Iterator over the station records in a compressed json list.
+
+    The compressed data is decompressed and decoded incrementally, so that
+    only a batch of station records is held in memory at a time. Records
+    outside of the requested region are dropped per batch, with a single
+    vectorized test, and counted in out_of_region.
+    """
+
+    chunk_size = 2 ** 16
+    batch_size = 1024
+    _separators = re.compile(r'[\s,]*')
+
+    def __init__(self, fp, region=None):
+        """Initialize a reader.
+
+        parameters
+        ----------
+        fp: binary file object, yields gzip compressed json data.
+        region: tuple (optional), bounding box as used in DataRequest.
+        """
+        self.fp = fp
+        self.region = region
+        self.out_of_region = 0
+        # Time spent reading and decompressing the file in seconds.
+        self.decompress_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.fp.close()
+
+    def __iter__(self):
+        records = self._decode_records()
+        if self.region is None:
+            yield from records
+            return
+
+        while True:
+            batch = list(islice(records, self.batch_size))
+            if not batch:
+                return
+            complete, in_region = region_mask(batch, self.region)
+            self.out_of_region += int(np.count_nonzero(complete & ~in_region))
+            # Incomplete records are left to parse_stations, which skips
+            # them without counting them as out of region.
+            for record, keep in zip(batch, in_region | ~complete):
+                if keep:
+                    yield record
+
+    def _decode_records(self):
+        """Yield all records of the json list."""
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        with gzip.GzipFile(fileobj=self.fp, mode="rb") as stream:
+            buffer = ''
+            position = 0
+            list_opened = False
+            while True:
+                position = self._separators.match(buffer, position).end()
+                if position == len(buffer):
+                    buffer = self._read_more(
+                        stream, text_decoder, buffer, position)
+                    position = 0
+                    continue
+
+                if not list_opened:
+                    if buffer[position] != '[':
+                        raise ValueError("File does not contain a json list.")
+                    list_opened = True
+                    position += 1
+                    continue
+
+                if buffer[position] == ']':
+                    return
+
+                try:
+                    record, position_end = \
+                        decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # Record is incomplete, extend buffer and try again.
+                    buffer = self._read_more(
+                        stream, text_decoder, buffer, position)
+                    position = 0
+                    continue
+                position = position_end
+                yield record
+
+    def _read_more(self, stream, text_decoder, buffer, position):
+        """Drop the consumed part of the buffer and append a new chunk."""
+        start = time()
+        chunk = stream.read(self.chunk_size)
+        self.decompress_seconds += time() - start
+        if not chunk:
+            raise ValueError("Unexpected end of json file.")
+        return buffer[position:] + text_decoder.decode(chunk)
+
+
+def parse_stream(reader, data_map, station_class=Station):
+    """Parse all records of a SnapshotReader into data_map.
+
+    Records dropped by the reader are added to the parse statistics, so
+    these equal the statistics of parse_stations on the full file contents.
+    """
+    # Records are filtered on region by the reader.
+    with reader:
+        parse_stats = parse_stations(reader, data_map, None, station_class)
+    parse_stats['stations_in_file'] += reader.out_of_region
+    parse_stats['stations_out_of_region'] += reader.out_of_region
+    return parse_stats
+
+
 def ls_json(directory):
     """List json file objects in engine directory."""
     return_list = [
@@ -47,45 +210,182 @@ def ls_json(directory):
     return return_list
 
 
-def query(root_directory, request):
-    """Query the file system."""
+def query(root_directory, request, worker_count=None, cache=None,
+          manifest=None):
+    """Query the file system.
+
+    parameters
+    ----------
+    root_directory: str, directory containing the json files, with trailing
+        slash.
+    request: DataRequest object
+    worker_count: int (optional), number of worker processes used to parse
+        files. Overrides request.worker_count. None or 1 parses serially.
+    cache: ParseCache (optional), cache of parsed files.
+    manifest: ArchiveManifest (optional), index of root_directory.
+    """
     assert isinstance(request, DataRequest)
 
+    if worker_count is None:
+        worker_count = request.worker_count
+
     # Initialize data objects
     data_map = {}
 
+    file_paths = [
+        root_directory + file_name for file_name in
+        _existing_requested_files(root_directory, request, manifest)
+    ]
+
+    station_class = CompactStation if request.compact_stations else Station
+    if cache is None and (worker_count is None or worker_count <= 1):
+        for file_path in file_paths:
+            parse_stats = _parse_file(
+                file_path, data_map, request.region, station_class)
+            log_parse_stats(parse_stats)
+    else:
+        _merge_parsed_files(
+            file_paths, data_map, request.region, station_class,
+            worker_count, cache)
+        if cache is not None:
+            cache.log_stats()
+
+    utils.add_alias(data_map)
+
+    response = DataResponse()
+    response.data_map = data_map
+    return response
+
+
+def query_table(root_directory, request, manifest=None):
+    """Query the file system into a columnar StationTable.
+
+    The response data_map is a StationTable instead of a dictionary. Its
+    contents equal StationTable.from_data_map of the query result.
+
+    parameters
+    ----------
+    root_directory: str, directory containing the json files, with trailing
+        slash.
+    request: DataRequest object
+    manifest: ArchiveManifest (optional), index of root_directory.
+    """
+    assert isinstance(request, DataRequest)
+
+    tables = []
+    for file_name in _existing_requested_files(
+            root_directory, request, manifest):
+        reader = stream_file(root_directory + file_name, request.region)
+        with reader:
+            table, parse_stats = parse_stations_table(reader)
+        parse_stats['stations_in_file'] += reader.out_of_region
+        parse_stats['stations_out_of_region'] += reader.out_of_region
+        log_parse_stats(parse_stats)
+        tables.append(table)
+
+    # Observations of all files are merged at once.
+    table = concat_tables(tables, drop_duplicates=True)
+    utils.add_alias(table)
+
+    response = DataResponse()
+    response.data_map = table
+    return response
+
+
+def _existing_requested_files(root_directory, request, manifest=None):
+    """List the requested files that exist in root_directory.
+
+    With a manifest, missing files are skipped using its time index instead
+    of listing the directory.
+    """
+    if manifest is not None:
+        file_names = manifest.resolve(request)
+        print("Loading %d files in total, %d requested files are missing." %
+              (len(file_names), manifest.missing_count(request)))
+        return file_names
+
     request_file_names = list_requested_files(request)
-    existing_files = ls_json(root_directory)
+    existing_files = set(ls_json(root_directory))
 
     # Load request files
     print("Loading %d files in total." % (len(request_file_names)))
+    file_names = []
     for (count, file_name) in enumerate(request_file_names):
         print("File %d: %s" % (count + 1, file_name))
         # File does not exist.
         if file_name not in existing_files:
             print("File does not exist\n")
             continue
+        file_names.append(file_name)
+    return file_names
 
-        # Open file and parse json
-        json_data = load_file(root_directory + file_name)
-        if json_data is None:
-            raise RuntimeError()
 
-        # Extract and add data
-        parse_stats = \
-            parse_stations(json_data, data_map, request.region)
+def _parse_file(file_path, data_map, region, station_class):
+    """Stream a single file and add its stations to data_map."""
+    return parse_stream(
+        stream_file(file_path, region), data_map, station_class)
 
-        log_parse_stats(parse_stats)
 
-    utils.add_alias(data_map)
+def _parse_file_worker(args):
+    """Parse a single file into a new station mapping.
+
+    Returns the mapping, the parse statistics and whether it was read from
+    the cache.
+    """
+    file_path, region, station_class, cache = args
+    if cache is not None:
+        key = cache.file_key(file_path, region, station_class)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry + (True,)
+
+    partial_map = {}
+    parse_stats = _parse_file(file_path, partial_map, region, station_class)
+    if cache is not None:
+        cache.put(key, partial_map, parse_stats)
+    return partial_map, parse_stats, False
+
+
+def _merge_parsed_files(file_paths, data_map, region, station_class,
+                        worker_count, cache):
+    """Parse files into separate mappings and merge these into data_map.
+
+    Files are parsed in a process pool if worker_count is larger than one.
+    Partial mappings are merged in file order, which yields the same
+    data_map as parsing the files serially.
+    """
+    tasks = [
+        (file_path, region, station_class, cache) for file_path in file_paths
+    ]
+    if worker_count is None or worker_count <= 1:
+        _merge_partial_maps(map(_parse_file_worker, tasks), data_map)
+    else:
+        with mp.Pool(worker_count) as pool:
+            # Workers count on a copy of the cache, count here instead.
+            _merge_partial_maps(
+                pool.imap(_parse_file_worker, tasks), data_map, cache)
 
-    response = DataResponse()
-    response.data_map = data_map
-    return response
+
+def _merge_partial_maps(results, data_map, counting_cache=None):
+    for partial_map, parse_stats, cache_hit in results:
+        if counting_cache is not None:
+            if cache_hit:
+                counting_cache.hits += 1
+            else:
+                counting_cache.misses += 1
+        merge_stats = merge_data_maps(data_map, partial_map)
+        # Statistics were counted against an empty mapping.
+        parse_stats['new_stations'] = merge_stats['new_stations']
+        parse_stats['station_thermo_contributions'] -= \
+            merge_stats['thermo_duplicates']
+        parse_stats['station_count'] = len(data_map)
+        log_parse_stats(parse_stats)
 
 
 def list_requested_files(request):
     """List files to ingest to comply with the request."""
+    if request.file_names is not None:
+        return list(request.file_names)
     request_datetime_range = datetime_range(
         request.start_datetime,
         request.end_datetime,
@@ -133,3 +433,14 @@ def datetime_to_file_name(timestamp):
         str(timestamp.hour).zfill(2),
         str(timestamp.minute).zfill(2)
     )
+
+
+def file_name_to_datetime(file_name):
+    """Convert a file name to its timestamp, see datetime_to_file_name.
+
+    parameters
+    ----------
+    file_name: str, file name or path, e.g. netatmo_20160501_1200.json.gz
+    """
+    return datetime.strptime(
+        os.path.basename(file_name), "netatmo_%Y%m%d_%H%M.json.gz")
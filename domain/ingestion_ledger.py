@@ -0,0 +1,214 @@
+"""Module with a persistent journal of ingested NetAtmo data files."""
+import os
+import sqlite3
+from time import time
+
+QUEUED = 'queued'
+DOWNLOADED = 'downloaded'
+PARSED = 'parsed'
+WRITTEN = 'written'
+
+
+class IngestionLedger(object):
+    """SQLite journal of the ingestion state of every data file.
+
+    A file moves from queued to downloaded, parsed and finally written.
+    Parsed files are split into chunks and every chunk written to the
+    database is recorded, so a file counts as written once all its chunks
+    are. An interrupted run is resumed by running the same request with the
+    same ledger: written files are skipped and chunks that were already
+    written are not written again, which would duplicate observations.
+
+    Time buckets are recorded like files, together with the files they
+    hold. These files are written once their bucket is, so files that are
+    added to a time span later are written in a bucket of their own.
+
+    Every process opens its own connection to the ledger, so a ledger can be
+    handed to worker processes.
+    """
+
+    def __init__(self, ledger_path):
+        """Initialize a ledger, creating the database if it does not exist.
+
+        parameters
+        ----------
+        ledger_path: str, path of the SQLite database.
+        """
+        self.ledger_path = ledger_path
+        self._connection = None
+        self._pid = None
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "file_name TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                "chunk_count INTEGER, chunk_size INTEGER, updated REAL)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "file_name TEXT NOT NULL, chunk_index INTEGER NOT NULL, "
+                "PRIMARY KEY (file_name, chunk_index))")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "file_name TEXT PRIMARY KEY, bucket_name TEXT NOT NULL)")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    def queue(self, file_names):
+        """Record files as queued and return those not yet written.
+
+        The state of files that are already in the ledger is kept.
+        """
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO files (file_name, state, updated) "
+                "VALUES (?, ?, ?)",
+                [(file_name, QUEUED, time()) for file_name in file_names])
+            written = set(row[0] for row in connection.execute(
+                "SELECT file_name FROM files WHERE state = ?", (WRITTEN,)))
+        return [
+            file_name for file_name in file_names if file_name not in written
+        ]
+
+    def queue_bucket(self, bucket_name, file_names):
+        """Record a time bucket of files as queued.
+
+        A bucket that was written before with other files, of which these
+        files are not part, is queued anew.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO files (file_name, state, updated) "
+                "VALUES (?, ?, ?)", (bucket_name, QUEUED, time()))
+            if connection.execute(
+                    "UPDATE files SET state = ?, chunk_count = NULL, "
+                    "chunk_size = NULL, updated = ? "
+                    "WHERE file_name = ? AND state = ?",
+                    (QUEUED, time(), bucket_name, WRITTEN)).rowcount > 0:
+                connection.execute(
+                    "DELETE FROM chunks WHERE file_name = ?", (bucket_name,))
+            connection.executemany(
+                "INSERT OR REPLACE INTO buckets (file_name, bucket_name) "
+                "VALUES (?, ?)",
+                [(file_name, bucket_name) for file_name in file_names])
+
+    def unfinished_buckets(self, file_names):
+        """Mapping of the names of unwritten buckets to their files.
+
+        Only buckets that hold any of file_names are returned.
+        """
+        buckets = {}
+        for bucket_name, file_name in self._connect().execute(
+                "SELECT buckets.bucket_name, buckets.file_name "
+                "FROM buckets JOIN files "
+                "ON files.file_name = buckets.bucket_name "
+                "WHERE files.state != ? ORDER BY buckets.file_name",
+                (WRITTEN,)):
+            buckets.setdefault(bucket_name, []).append(file_name)
+        file_names = set(file_names)
+        return {
+            bucket_name: bucket_files
+            for bucket_name, bucket_files in buckets.items()
+            if not file_names.isdisjoint(bucket_files)
+        }
+
+    def drop_from_bucket(self, bucket_name, file_name):
+        """Record that a file was skipped in a bucket, it stays unwritten."""
+        with self._connect() as connection:
+            connection.execute(
+                "DELETE FROM buckets WHERE file_name = ? AND bucket_name = ?",
+                (file_name, bucket_name))
+
+    def mark_downloaded(self, file_name):
+        self._set_state(file_name, DOWNLOADED)
+
+    def mark_parsed(self, file_name, chunk_count, chunk_size):
+        """Record the number and size of the chunks of a parsed file.
+
+        A file without chunks is written right away.
+        """
+        state = PARSED if chunk_count > 0 else WRITTEN
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE files SET state = ?, chunk_count = ?, "
+                "chunk_size = ?, updated = ? "
+                "WHERE file_name = ? AND state != ?",
+                (state, chunk_count, chunk_size, time(), file_name, WRITTEN))
+            if state == WRITTEN:
+                self._mark_bucket_written(connection, file_name)
+
+    def mark_chunk_written(self, file_name, chunk_index):
+        """Record a written chunk, returns True if the file is written."""
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO chunks (file_name, chunk_index) "
+                "VALUES (?, ?)", (file_name, chunk_index))
+            connection.execute(
+                "UPDATE files SET state = ?, updated = ? "
+                "WHERE file_name = ? AND chunk_count <= "
+                "(SELECT COUNT(*) FROM chunks WHERE file_name = ?)",
+                (WRITTEN, time(), file_name, file_name))
+            state = connection.execute(
+                "SELECT state FROM files WHERE file_name = ?",
+                (file_name,)).fetchone()
+            written = state is not None and state[0] == WRITTEN
+            if written:
+                self._mark_bucket_written(connection, file_name)
+        return written
+
+    def chunk_size(self, file_name):
+        """Chunk size a file was split with before, None if not parsed."""
+        row = self._connect().execute(
+            "SELECT chunk_size FROM files WHERE file_name = ?",
+            (file_name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def written_chunks(self, file_name):
+        """Set of the indices of the written chunks of a file."""
+        return set(row[0] for row in self._connect().execute(
+            "SELECT chunk_index FROM chunks WHERE file_name = ?",
+            (file_name,)))
+
+    def state(self, file_name):
+        """State of a file, None if it is not in the ledger."""
+        row = self._connect().execute(
+            "SELECT state FROM files WHERE file_name = ?",
+            (file_name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def state_counts(self):
+        """Mapping of states to the number of files in that state."""
+        return dict(self._connect().execute(
+            "SELECT state, COUNT(*) FROM files GROUP BY state"))
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+    def _set_state(self, file_name, state):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE files SET state = ?, updated = ? "
+                "WHERE file_name = ? AND state != ?",
+                (state, time(), file_name, WRITTEN))
+
+    def _mark_bucket_written(self, connection, bucket_name):
+        """Mark the files of a written bucket as written."""
+        connection.execute(
+            "UPDATE files SET state = ?, updated = ? "
+            "WHERE file_name IN "
+            "(SELECT file_name FROM buckets WHERE bucket_name = ?)",
+            (WRITTEN, time(), bucket_name))
+
+    def _connect(self):
+        """Connection of the current process, opened on first use."""
+        if self._connection is None or self._pid != os.getpid():
+            # A connection inherited from a parent process is not usable.
+            self._connection = sqlite3.connect(
+                self.ledger_path, timeout=60)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._connection
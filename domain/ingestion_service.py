@@ -1,19 +1,54 @@
 """Module for ingesting NetAtmo data into MongoDB."""
+import asyncio
+import copy
+import heapq
 import logging
 import math
 import multiprocessing as mp
-from time import sleep
+from multiprocessing import resource_tracker
+import queue
+import random
+from collections import deque
+from datetime import timedelta
+from itertools import islice
+from io import BytesIO
+from time import sleep, time
 
 import botocore
 import botocore.exceptions
 import botocore.vendored.requests.packages
+import numpy as np
 import pymongo
 import pymongo.errors
 
-from domain.file_io import (list_requested_files, load_file_aws)
-from domain.json_parser import parse_stations, log_parse_stats
+from domain.file_io import (
+    file_name_to_datetime, list_requested_files, parse_stream, SnapshotReader)
+from domain.aws_engine import AsyncS3Reader, S3Prefetcher, StreamBuffer
+from domain.base import Station
+from domain.json_parser import log_parse_stats, parse_stations_table
 from domain.load_credentials import load_aws_keys
-from domain.mongodb_engine import MongoDBConnector
+from domain.merge import merge_data_maps
+from domain.mongodb_engine import (
+    MongoDBConnector, date_to_str, estimate_row_bytes, estimate_station_bytes)
+from domain.pipeline_metrics import MetricsRecorder, PipelineMetrics
+from domain.shared_table import SharedTable
+from domain.station_table import StationTable, concat_tables
+from helpers import utils
+
+# Errors after which a download is retried.
+CONNECTION_ERRORS = (
+    botocore.exceptions.EndpointConnectionError,
+    botocore.exceptions.ResponseStreamingError,
+    botocore.vendored.requests.packages.urllib3.exceptions.ReadTimeoutError
+)
+# S3 error codes after which a download is retried.
+RETRY_ERROR_CODES = (
+    'InternalError', 'RequestTimeout', 'ServiceUnavailable', 'SlowDown')
+# Minimum estimated size of the chunks a parsed file is split in, so that
+# small files are not spread over many small bulk writes.
+MINIMUM_CHUNK_BYTES = 1024 ** 2
+# Time spans of TimeBuckets.
+TIME_BUCKETS = ('hour', 'day')
 
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -21,7 +56,6 @@ logging.basicConfig(
 )
 
 
-# TODO TdR 09/12/16: limit the size of the JSONQueue. JSONConsumers get flooded.
 class IngestionService(object):
     """Module for ingesting files from S3 into a MongoDB.
 
@@ -40,10 +74,16 @@ class IngestionService(object):
     First an index is built of files to be downloaded from the remote resource.
     These are put in a file queue. This is the production phase.
 
-    The file queue is read by a pool of FileConsumer instances, who both
-    download the file and parses it to it's JSON constituents. The resulting
-    text is put in a JSON queue. This is the consumer phase, as well as the
-    production phase of the next part.
+    The file queue is read by a few DownloadConsumer processes. Each keeps a
+    single S3 client and has many downloads in flight with asyncio. The raw
+    file contents are put in a raw queue, bounded in bytes.
+
+    The raw queue is read by a pool of FileConsumer instances, who parse the
+    files to their JSON constituents. The resulting text is put in a JSON
+    queue. This is the consumer phase, as well as the production phase of the
+    next part. Without DownloadConsumer processes, FileConsumer instances read
+    the file queue and download files themselves. A file is parsed while it
+    streams in and the next prefetch_count files download in the background.
 
     Part 2: uploading JSON
     ----------------------
@@ -54,6 +94,34 @@ class IngestionService(object):
     The JSON queue is being consumed by a pool of JSONConsumer workers. Each
     JSON string is split into separate database entries and then uploaded to the
     database separately. A single JSON text represents many database objects.
+    By default chunks are StationTables in shared memory, so only a small
+    SharedTable descriptor is pickled through the JSON queue.
+
+    Metrics
+    -------
+    Every worker records counters and latencies of its stage and sends them
+    to the main thread, which aggregates them with sampled queue depths into
+    PipelineMetrics. These are written to metrics_path periodically and
+    reported at the end of a run.
+
+    Balancing
+    ---------
+    The JSON queue is bounded by the estimated size of its contents in bytes,
+    so downloading blocks when ingestion falls behind. While running, the main
+    thread watches the fill level of the JSON queue and the throughput of both
+    pools. It starts or retires FileConsumer and JSONConsumer workers within
+    the configured limits to keep both parts balanced.
+
+    Time buckets
+    ------------
+    With a time_bucket, the files of every hour or day are a single task.
+    A FileConsumer streams the files of a TimeBucket one after another and
+    combines their stations, so every station is written once per bucket
+    with all its observations, instead of once per file. This cuts the
+    number of database updates and in-place document growth by the number
+    of files per bucket, 6 for hours and 144 for days at a 10 minute
+    resolution. The stations of a whole bucket are held in the memory of
+    one FileConsumer though, and no DownloadConsumers are used.
     """
 
     def __init__(self):
@@ -64,107 +132,502 @@ class IngestionService(object):
         self.db_connections = 4
         # While concurrent writing is in theory not faster, a small number of
         # threads yield a small write performance increase.
+        # Maximum estimated BSON size of a single bulk write.
+        self.bulk_write_bytes = 16 * 1024 ** 2
 
+        # Number of asyncio download processes and the number of concurrent
+        # downloads of each. With no download processes, every FileConsumer
+        # downloads its own files.
+        self.download_consumer_count = 1
+        self.downloads_in_flight = 32
+        # Maximum size of downloaded files waiting to be parsed.
+        self.raw_queue_bytes = 256 * 1024 ** 2
+        # Without download processes, every FileConsumer streams the file it
+        # parses and downloads this many next files in the background.
+        self.prefetch_count = 2
+        # Optional url of an S3 compatible service to download from.
+        self.s3_endpoint_url = None
+        # Optional MongoDB host or connection string, localhost by default.
+        self.db_host = None
+        # Write observations packed in binary, see MongoDBConnector.
+        self.binary_stations = False
+        # Optional time span of TimeBuckets, 'hour' or 'day', to write the
+        # stations of all files in a span at once. With 'day', documents
+        # hold a day of observations. Packing them in binary pays off most
+        # with buckets.
+        self.time_bucket = None
+
+        # Initial worker counts and the limits for balancing.
         self.file_consumer_count = 2
         self.json_consumer_count = 4
+        self.min_file_consumers = 1
+        self.max_file_consumers = mp.cpu_count()
+        self.min_json_consumers = 1
+        self.max_json_consumers = mp.cpu_count()
+
+        # Parse files into StationTables and pass them to the JSONConsumers
+        # in shared memory. Only a small descriptor is pickled per task.
+        self.shared_memory = True
+        # Maximum estimated size of parsed stations waiting for ingestion.
+        self.json_queue_bytes = 512 * 1024 ** 2
+        # Seconds between balancing decisions and the JSON queue fill levels
+        # at which a part is considered too slow.
+        self.balance_interval = 10
+        self.high_watermark = 0.8
+        self.low_watermark = 0.2
+
+        # Optional ParseCache, shared by all FileConsumer processes.
+        self.parse_cache = None
+        # Optional S3ObjectCache of downloaded files, shared by all
+        # processes that download.
+        self.object_cache = None
+        # Optional space-filling curve, 'hilbert' or 'zorder', to order
+        # stations by before chunking, so every database write covers a
+        # compact area.
+        self.station_order = None
+        # Optional ArchiveManifest of the S3 data prefix. Requested files
+        # that are not on S3 are skipped before downloading.
+        self.manifest = None
+        # Optional IngestionLedger. Files it records as written are skipped,
+        # so an interrupted run is resumed by running it again.
+        self.ledger = None
+
+        # Failed downloads are retried up to max_attempts times in total,
+        # after an exponentially growing delay with random jitter.
+        self.max_attempts = 5
+        self.retry_base_delay = 2
+        self.retry_max_delay = 300
+        self.retry_scheduler = None
+
+        # Optional json file to which pipeline metrics are written every
+        # metrics_interval seconds. The metrics of the last run are kept in
+        # metrics and reported when it finishes.
+        self.metrics_path = None
+        self.metrics_interval = 10
+        self.metrics = None
 
         self._file_queue = None
+        self._raw_queue = None
         self._json_queue = None
         self._error_queue = None
+        self._metrics_queue = None
         self._s3_semaphore = None
         self._db_semaphore = None
+        self._files_done = None
+        self._chunks_done = None
+        self._download_consumers = []
+        self._file_consumers = []
+        self._json_consumers = []
+        # Workers retired by balancing, joined at the end of a run.
+        self._retired_consumers = []
+        self._last_balance = None
+        self._request = None
+        self._file_count = 0
+        # TimeBuckets of the last run by name.
+        self._buckets = {}
 
     def run(self, request):
         """Download, ingest and upload files from S3 to MongoDB."""
         logging.info("Main thread: initializing ingestion process.")
         # All files are queued at the same time. No limit required.
         self._file_queue = mp.JoinableQueue()
+        # Downloaded files wait in the raw queue until they are parsed.
+        # FileConsumers download the files of time buckets themselves.
+        download_consumer_count = self.download_consumer_count \
+            if self.time_bucket is None else 0
+        self._raw_queue = None
+        if download_consumer_count > 0:
+            self._raw_queue = ByteBoundedQueue(self.raw_queue_bytes)
         # Once a file is downloaded, it is split up and put on the json queue.
         # Limiting the json queue is required to match download speed with
         # ingestion speed.
-        self._json_queue = mp.JoinableQueue(mp.cpu_count() * 2)
-        self._error_queue = mp.SimpleQueue()
+        self._json_queue = ByteBoundedQueue(self.json_queue_bytes)
+        self._error_queue = mp.Queue()
+        self._metrics_queue = mp.Queue()
+        self.metrics = PipelineMetrics(
+            self.metrics_path, self.metrics_interval)
+        self.retry_scheduler = RetryScheduler(
+            self.max_attempts, self.retry_base_delay, self.retry_max_delay)
+        if self.shared_memory:
+            # Shared memory segments outlive the FileConsumer that creates
+            # them. All workers must share the resource tracker of the main
+            # process, a tracker of their own unlinks segments on exit.
+            resource_tracker.ensure_running()
 
         self._s3_semaphore = mp.BoundedSemaphore(self.s3_connections)
         self._db_semaphore = mp.BoundedSemaphore(self.db_connections)
+        self._files_done = mp.Value('q', 0)
+        self._chunks_done = mp.Value('q', 0)
+        self._download_consumers = []
+        self._file_consumers = []
+        self._json_consumers = []
+        self._retired_consumers = []
 
-        files_to_load = _get_request_file_paths(request)
+        files_to_load = _get_request_file_paths(request, self.manifest)
+        if self.ledger is not None:
+            requested_count = len(files_to_load)
+            files_to_load = self.ledger.queue(files_to_load)
+            logging.info(
+                "Main thread: skipping %d files already written." %
+                (requested_count - len(files_to_load)))
+        self._buckets = {}
+        if self.time_bucket is not None:
+            resumed = None
+            if self.ledger is not None:
+                # Buckets of an interrupted run are resumed as they were.
+                resumed = self.ledger.unfinished_buckets(files_to_load)
+            buckets = _bucket_files(files_to_load, self.time_bucket, resumed)
+            logging.info("Main thread: %d files in %d time buckets." %
+                         (len(files_to_load), len(buckets)))
+            self._buckets = {bucket.name: bucket for bucket in buckets}
+            # Chunks and the retries of buckets go by their names.
+            files_to_load = [bucket.name for bucket in buckets]
+            if self.ledger is not None:
+                for bucket in buckets:
+                    self.ledger.queue_bucket(bucket.name, bucket.file_names)
+        self._file_count = len(files_to_load)
         logging.info(
             "Main thread: %d files to download." %
             len(files_to_load))
         self._add_files_to_queue(files_to_load)
+        logging.info("Main thread: all tasks listed in file queue.")
+
+        logging.info(
+            "Main thread: starting %d download processes." %
+            download_consumer_count)
+        for _ in range(download_consumer_count):
+            self._start_download_consumer()
 
         logging.info(
             "Main thread: starting %d file loader processes." %
             self.file_consumer_count)
-        self._start_file_consumers(request)
-        logging.info("Main thread: all tasks listed in file queue.")
-        logging.info("Main thread: queueing poison pills for file loaders.")
-        self._close_file_queue()
+        self._request = request
+        for _ in range(self.file_consumer_count):
+            self._start_file_consumer()
 
         logging.info(
             "Main thread: starting %d database ingestion processes." %
             self.json_consumer_count)
-        self._start_json_consumers()
+        for _ in range(self.json_consumer_count):
+            self._start_json_consumer()
 
-        # Wait for file queue to be empty, so that all ingestion tasks are
+        # Wait for all files to be processed, so that all ingestion tasks are
         # queued.
-        self._file_queue.join()  # Block main thread
+        self._last_balance = (time(), 0, 0, None)
+        self._wait_while_balancing(
+            lambda: self._files_done.value < self._file_count)
+        self._file_queue.join()
+        if self._raw_queue is not None:
+            self._raw_queue.join()
         logging.info("Main thread: downloading complete.")
         logging.info("Main thread: all ingestion tasks posted.")
+        logging.info("Main thread: queueing poison pills for file loaders.")
+        self._close_file_queue()
 
         # Wait for existing json tasks to finish before closing the queue.
         # This ensures json consumers are not stopped prematurely.
-        self._json_queue.join()  # Blocking operation
+        self._wait_while_balancing(
+            lambda: self._json_queue.unfinished_tasks() > 0)
+        self._json_queue.join()
         logging.info("Main thread: queueing poison pills for database "
                      "ingesters.")
         # Shouldn't be called until the json_queue is completely empty.
         self._close_json_queue()
         logging.info("Main thread: database ingestion complete.")
+        if self.ledger is not None:
+            logging.info("Main thread: files per ledger state: %s." %
+                         self.ledger.state_counts())
+
+        # Workers report failures and metrics before exiting, retired ones
+        # after finishing their tasks. Keep reading both queues, so that no
+        # worker blocks on a full pipe.
+        for consumer in self._download_consumers + self._file_consumers + \
+                self._json_consumers + self._retired_consumers:
+            while consumer.is_alive():
+                consumer.join(timeout=1)
+                self._process_errors()
+                self.metrics.collect(self._metrics_queue)
+        self._process_errors()
+        self._error_queue.close()
+        self.retry_scheduler.log_summary()
+        self.metrics.collect(self._metrics_queue)
+        self._metrics_queue.close()
+        self.metrics.write(final=True, force=True)
+        self.metrics.report()
 
-        # TODO TdR 18/07/16: do something with error queue contents.
+    def failed_request(self):
+        """DataRequest for the files that failed in the last run.
+
+        Running it replays only these files. With a ledger, chunks that
+        were written before a file failed are not written again. A failed
+        time bucket replays all its files.
+        """
+        file_names = set()
+        for name in self.retry_scheduler.failed:
+            if name in self._buckets:
+                file_names.update(self._buckets[name].file_names)
+            else:
+                file_names.add(name)
+        request = copy.copy(self._request)
+        request.file_names = sorted(file_names)
+        return request
 
     def _add_files_to_queue(self, files_to_load):
-        """Submit a file listing to the FileConsumer worker queue."""
-        _add_to_queue(self._file_queue, files_to_load)
+        """Submit a file listing to the FileConsumer worker queue.
 
-    def _start_file_consumers(self, request):
-        """Start the FileConsumer worker pool."""
-        for _ in range(self.file_consumer_count):
-            FileConsumer(
-                self._s3_semaphore,
-                self._file_queue, self._json_queue, self._error_queue,
-                request, self.json_consumer_count
-            ).start()
+        Names of time buckets are queued as their TimeBucket.
+        """
+        _add_to_queue(self._file_queue, [
+            self._buckets.get(file_name, file_name)
+            for file_name in files_to_load])
+
+    def _start_download_consumer(self):
+        """Add a worker to the DownloadConsumer pool."""
+        consumer = DownloadConsumer(
+            self._file_queue, self._raw_queue, self._error_queue,
+            self.downloads_in_flight, self.s3_endpoint_url, self._files_done,
+            self.ledger, self._metrics_queue, self.object_cache)
+        consumer.start()
+        self._download_consumers.append(consumer)
+
+    def _start_file_consumer(self):
+        """Add a worker to the FileConsumer pool."""
+        if self._raw_queue is None:
+            input_queue, prefetch_count = self._file_queue, self.prefetch_count
+        else:
+            input_queue, prefetch_count = self._raw_queue, 0
+        consumer = FileConsumer(
+            self._s3_semaphore,
+            input_queue, self._json_queue, self._error_queue,
+            self._request, self.json_consumer_count, self.parse_cache,
+            self.station_order, self._files_done, self.shared_memory,
+            self.ledger, self._metrics_queue, self.s3_endpoint_url,
+            prefetch_count, self.object_cache, self.bulk_write_bytes
+        )
+        consumer.start()
+        self._file_consumers.append(consumer)
 
     def _close_file_queue(self):
-        """Peacefully stop FileConsumer workers."""
-        _add_to_queue(
-            self._file_queue,
-            [PoisonPill(x + 1000) for x in range(self.file_consumer_count)])
+        """Peacefully stop DownloadConsumer and FileConsumer workers."""
+        if self._raw_queue is None:
+            _add_to_queue(
+                self._file_queue,
+                [PoisonPill(x + 1000)
+                 for x in range(len(self._file_consumers))])
+        else:
+            _add_to_queue(
+                self._file_queue,
+                [PoisonPill(x + 2000)
+                 for x in range(len(self._download_consumers))])
+            _add_to_queue(
+                self._raw_queue,
+                [PoisonPill(x + 1000)
+                 for x in range(len(self._file_consumers))])
+            self._raw_queue.close()
+            self._raw_queue.join_thread()
         self._file_queue.close()
         self._file_queue.join_thread()
 
-    def _start_json_consumers(self):
-        """Start the JSONConsumer worker pool."""
-        for _ in range(self.json_consumer_count):
-            JSONConsumer(
-                self._db_semaphore, self._json_queue, self._error_queue).start()
+    def _start_json_consumer(self):
+        """Add a worker to the JSONConsumer pool."""
+        consumer = JSONConsumer(
+            self._db_semaphore, self._json_queue, self._error_queue,
+            self._chunks_done, self.bulk_write_bytes, self.ledger,
+            self._metrics_queue, self.db_host, self.binary_stations)
+        consumer.start()
+        self._json_consumers.append(consumer)
 
     def _close_json_queue(self):
         """Stop JSONConsumer worker pool"""
         _add_to_queue(
             self._json_queue,
-            [PoisonPill(x) for x in range(self.json_consumer_count)])
+            [PoisonPill(x) for x in range(len(self._json_consumers))])
         self._json_queue.close()
         self._json_queue.join_thread()
 
+    def _wait_while_balancing(self, condition):
+        """Block until condition is false, balancing the worker pools.
+
+        Meanwhile failed tasks are processed and due retries are queued.
+        """
+        while condition():
+            sleep(1)
+            self._process_errors()
+            for file_name in self.retry_scheduler.due():
+                logging.info("Main thread: retrying %s." % file_name)
+                self._add_files_to_queue([file_name])
+            if time() - self._last_balance[0] >= self.balance_interval:
+                self._balance_workers()
+            self._sample_metrics()
+
+    def _sample_metrics(self):
+        """Collect worker metrics, sample queue depths and write metrics."""
+        self.metrics.collect(self._metrics_queue)
+        try:
+            self.metrics.sample_queue('file_queue', self._file_queue.qsize())
+        except NotImplementedError:
+            # qsize is not available on every platform.
+            pass
+        if self._raw_queue is not None:
+            self.metrics.sample_queue('raw_queue_bytes',
+                                      self._raw_queue.bytes())
+        self.metrics.sample_queue('json_queue_bytes', self._json_queue.bytes())
+        self.metrics.sample_queue('json_queue_tasks',
+                                  self._json_queue.unfinished_tasks())
+        self.metrics.write()
+
+    def _process_errors(self):
+        """Schedule retries for failed tasks on the error queue.
+
+        A file that fails permanently is counted as done.
+        """
+        while True:
+            try:
+                error = self._error_queue.get_nowait()
+            except queue.Empty:
+                break
+            if error.chunk_index is not None or error.bucket is not None:
+                # The file was already counted as done by its FileConsumer,
+                # or it was skipped in a time bucket that continued.
+                self.retry_scheduler.fail(error.file_name, error.message)
+            elif not self.retry_scheduler.fail(
+                    error.file_name, error.message, error.retry):
+                with self._files_done.get_lock():
+                    self._files_done.value += 1
+
+    def _balance_workers(self):
+        """Start or retire workers based on queue fill and throughput.
+
+        A full JSON queue means database ingestion is the bottleneck, an
+        empty one means downloading and parsing is. The slow part gets an
+        extra worker, unless its throughput did not improve since it last got
+        one. Otherwise the fast part loses a worker.
+        """
+        now = time()
+        last_time, last_files, last_chunks, last_scaled = self._last_balance
+        files_done = self._files_done.value
+        chunks_done = self._chunks_done.value
+        file_rate = (files_done - last_files) / (now - last_time)
+        chunk_rate = (chunks_done - last_chunks) / (now - last_time)
+        fill = self._json_queue.fill()
+        logging.info(
+            "Main thread: %.2f files/s by %d file loaders, %.2f tasks/s by "
+            "%d database ingesters, json queue %.0f%% full." %
+            (file_rate, len(self._file_consumers), chunk_rate,
+             len(self._json_consumers), 100 * fill))
+
+        scaled = None
+        files_remaining = files_done < self._file_count
+        if fill >= self.high_watermark:
+            if len(self._json_consumers) < self.max_json_consumers and \
+               not _saturated(last_scaled, 'json', chunk_rate):
+                self._start_json_consumer()
+                scaled = ('json', chunk_rate)
+            elif len(self._file_consumers) > self.min_file_consumers:
+                self._retire(self._file_consumers)
+        elif fill <= self.low_watermark and files_remaining:
+            if len(self._file_consumers) < self.max_file_consumers and \
+               not _saturated(last_scaled, 'file', file_rate):
+                self._start_file_consumer()
+                scaled = ('file', file_rate)
+            elif len(self._json_consumers) > self.min_json_consumers:
+                self._retire(self._json_consumers)
+
+        if scaled is not None:
+            logging.info("Main thread: added a %s worker." % scaled[0])
+        else:
+            scaled = last_scaled
+        self._last_balance = (now, files_done, chunks_done, scaled)
+
+    def _retire(self, consumers):
+        """Let a worker of a pool exit after its current task."""
+        consumer = consumers.pop()
+        consumer.stop_event.set()
+        self._retired_consumers.append(consumer)
+        logging.info("Main thread: retiring %s." % consumer.name)
+
+
+class ByteBoundedQueue(object):
+    """Joinable queue bounded by the estimated size of its items in bytes.
+
+    put blocks while the queue holds more than max_bytes. An empty queue
+    always accepts an item, so an oversized item cannot block forever.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._queue = mp.JoinableQueue()
+        self._condition = mp.Condition()
+        self._bytes = mp.Value('q', 0, lock=False)
+        self._waiting = mp.Value('q', 0, lock=False)
+        self._unfinished = mp.Value('q', 0)
+
+    def put(self, item, size=0):
+        with self._condition:
+            self._waiting.value += 1
+            self._condition.wait_for(
+                lambda: self._bytes.value == 0 or
+                self._bytes.value + size <= self.max_bytes)
+            self._waiting.value -= 1
+            self._bytes.value += size
+        with self._unfinished.get_lock():
+            self._unfinished.value += 1
+        self._queue.put((size, item))
+
+    def get(self, timeout=None):
+        size, item = self._queue.get(timeout=timeout)
+        with self._condition:
+            self._bytes.value -= size
+            self._condition.notify_all()
+        return item
+
+    def task_done(self):
+        with self._unfinished.get_lock():
+            self._unfinished.value -= 1
+        self._queue.task_done()
+
+    def join(self):
+        self._queue.join()
+
+    def close(self):
+        self._queue.close()
+
+    def join_thread(self):
+        self._queue.join_thread()
+
+    def bytes(self):
+        """Estimated size of the queued items."""
+        return self._bytes.value
+
+    def fill(self):
+        """Fill level between 0 and 1, 1 if a producer is blocked."""
+        if self._waiting.value > 0:
+            return 1.0
+        return min(self._bytes.value / self.max_bytes, 1.0)
+
+    def unfinished_tasks(self):
+        """Number of items put for which task_done was not yet called."""
+        return self._unfinished.value
+
 
 class FileConsumer(mp.Process):
-    """Consumer process for downloading and parsing files from S3."""
+    """Consumer process for downloading and parsing files from S3.
+
+    Files from the file queue are streamed from S3 while they are parsed.
+    Up to prefetch_count further files are taken from the queue and
+    downloaded in the background meanwhile.
+
+    The files of a TimeBucket are streamed in order, up to prefetch_count
+    files ahead, and their stations are combined before they are queued
+    under the name of the bucket.
+    """
 
     def __init__(self, s3_semaphore, input_queue, output_queue, error_queue,
-                 request, worker_count):
+                 request, worker_count, parse_cache=None,
+                 station_order=None, files_done=None, shared_memory=False,
+                 ledger=None, metrics_queue=None, endpoint_url=None,
+                 prefetch_count=0, object_cache=None,
+                 chunk_bytes=16 * 1024 ** 2):
         super().__init__()
         self.s3_semaphore = s3_semaphore
         self.input_queue = input_queue
@@ -172,97 +635,502 @@ class FileConsumer(mp.Process):
         self.error_queue = error_queue
         self.request = request
         self.worker_count = worker_count
+        self.parse_cache = parse_cache
+        self.station_order = station_order
+        self.files_done = files_done
+        self.shared_memory = shared_memory
+        self.ledger = ledger
+        self.metrics_queue = metrics_queue
+        self.endpoint_url = endpoint_url
+        self.prefetch_count = prefetch_count
+        self.object_cache = object_cache
+        # Maximum estimated size of a chunk of stations.
+        self.chunk_bytes = chunk_bytes
+        # Set by the IngestionService to retire this worker.
+        self.stop_event = mp.Event()
+        self._metrics = None
+        self._prefetcher = None
+        # Tasks taken from the queue, as (file name, contents) tuples or
+        # (TimeBucket, generator of contents) tuples.
+        self._pending = deque()
+        self._stopping = False
 
     def run(self):
         logging.info("%s: starting." % self.name)
+        self._metrics = MetricsRecorder(self.metrics_queue)
+        cache_counts = _object_cache_counts(self.object_cache)
+        try:
+            self._consume()
+        finally:
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+        _record_object_cache(self._metrics, self.object_cache, cache_counts)
+        self._metrics.flush(force=True)
+
+    def _consume(self):
         while True:
-            next_task = self.input_queue.get()
+            next_task = self._next_task()
+            if next_task is None:
+                break
+            next_task, file_contents, etag = next_task
+            bucket, key = None, None
+            if isinstance(next_task, TimeBucket):
+                # Chunks and errors go by the name of the bucket and all
+                # stations are written to the document of the bucket.
+                bucket = next_task
+                next_task, key = bucket.name, bucket.key
+
+            try:
+                if bucket is not None:
+                    station_mapping = self._parse_bucket(bucket, file_contents)
+                else:
+                    station_mapping = self._parse(
+                        next_task, file_contents, etag)
+            except CONNECTION_ERRORS + (
+                    botocore.exceptions.ClientError,) as e:
+                # The streamed download failed. Retried or given up on by
+                # the IngestionService.
+                _report_download_error(
+                    self.name, self.error_queue, next_task, e)
+                self.input_queue.task_done()
+                continue
+            if isinstance(file_contents, StreamBuffer):
+                self._record_download(next_task, file_contents)
+            logging.info("%s: finished task." % self.name)
+
+            if self.station_order is not None:
+                station_mapping = utils.sort_by_location(
+                    station_mapping, self.station_order)
+
+            # Split stations in chunks of about equal estimated size for
+            # distributed ingestion, each within a single bulk write.
+            station_bytes = _station_bytes(station_mapping)
+            chunk_bytes = min(self.chunk_bytes, max(int(math.ceil(
+                station_bytes.sum() / self.worker_count)),
+                MINIMUM_CHUNK_BYTES))
+            written_chunks = set()
+            if self.ledger is not None and \
+               self.ledger.chunk_size(next_task) is not None:
+                # Resume with the chunks of the interrupted run.
+                chunk_bytes = self.ledger.chunk_size(next_task)
+                written_chunks = self.ledger.written_chunks(next_task)
+            bounds = _chunk_bounds(station_bytes, chunk_bytes)
+            if self.ledger is not None:
+                self.ledger.mark_parsed(next_task, len(bounds), chunk_bytes)
+            parts = _iter_chunks(station_mapping, bounds)
+            for chunk_index, ((start, end), part) in enumerate(
+                    zip(bounds, parts)):
+                if chunk_index in written_chunks:
+                    continue
+                size = int(station_bytes[start:end].sum())
+                if self.shared_memory:
+                    part = SharedTable.create(part)
+                with self._metrics.timer('json_queue_wait'):
+                    self.output_queue.put(
+                        (next_task, chunk_index, part, key), size)
+            logging.info('%s: placed %d stations in %d tasks on output queue.' %
+                         (self.name, len(station_mapping),
+                          len(bounds)))
+            # The file is done once its stations are queued.
+            self._task_done()
+            self._metrics.flush()
+
+    def _next_task(self):
+        """Next (file name, contents) tuple to parse, None when stopping.
+
+        Tasks taken from the queue before stopping are finished first.
+        """
+        while len(self._pending) == 0 and not self._stopping:
+            self._take_tasks(1, block=True)
+        if len(self._pending) == 0:
+            return None
+        next_task = self._pending.popleft()
+        if not isinstance(next_task[0], TimeBucket):
+            # Keep prefetch_count downloads ahead of the parsed file. The
+            # files of a bucket are prefetched while it is parsed.
+            self._take_tasks(self.prefetch_count, block=False)
+        return next_task
+
+    def _take_tasks(self, count, block):
+        """Take tasks from the queue until count tasks are pending."""
+        while not self._stopping and len(self._pending) < count:
+            if self.stop_event.is_set():
+                logging.info("%s: retired. Exiting." % self.name)
+                self._stopping = True
+                return
+            try:
+                if block:
+                    next_task = self.input_queue.get(timeout=1)
+                else:
+                    next_task = self.input_queue.get_nowait()
+            except queue.Empty:
+                return
             if isinstance(next_task, PoisonPill):
                 logging.info("%s: encountered %s. Exiting." %
                              (self.name, next_task))
+                if self.parse_cache is not None:
+                    self.parse_cache.log_stats()
                 self.input_queue.task_done()
-                break
+                self._stopping = True
+                return
 
-            with self.s3_semaphore:
-                logging.info("%s: downloading file S3://%s" %
-                             (self.name, next_task))
-                try:
-                    file_contents = _download_from_s3(next_task)
-                except botocore.exceptions.EndpointConnectionError as e:
-                    error_msg = "%s: network error. " \
-                                "Could not download file %s." % \
-                                (self.name, next_task)
-                    logging.error(error_msg)
-                    self.error_queue.put((error_msg, e, next_task))
+            if isinstance(next_task, tuple):
+                # Downloaded by a DownloadConsumer.
+                self._pending.append(next_task)
+            elif isinstance(next_task, TimeBucket):
+                logging.info("%s: downloading %d files of %s" %
+                             (self.name, len(next_task.file_names),
+                              next_task.name))
+                # Downloads start when parsing the bucket starts.
+                buffers = self._get_prefetcher().prefetch([
+                    'data/' + file_name for file_name in next_task.file_names
+                ])
+                self._pending.append((next_task, buffers, None))
+            else:
+                self._pending.append((next_task, self._fetch(next_task), None))
+
+    def _fetch(self, file_name):
+        """Start streaming a file from S3, returns its StreamBuffer."""
+        logging.info("%s: downloading file S3://%s" % (self.name, file_name))
+        return self._get_prefetcher().fetch('data/' + file_name)
+
+    def _get_prefetcher(self):
+        if self._prefetcher is None:
+            self._prefetcher = S3Prefetcher(
+                *load_aws_keys(), prefetch_count=self.prefetch_count,
+                endpoint_url=self.endpoint_url, semaphore=self.s3_semaphore,
+                cache=self.object_cache)
+        return self._prefetcher
+
+    def _parse(self, file_name, file_contents, etag=None):
+        """Parse a file into a StationTable or a mapping of Stations."""
+        if self.shared_memory:
+            return _json_to_station_table(
+                file_contents, self.request.region, file_name,
+                self.parse_cache, self._metrics, etag)
+        return _json_to_station_objects(
+            file_contents, self.request.region, file_name,
+            self.parse_cache, self._metrics, etag)
+
+    def _parse_bucket(self, bucket, buffers):
+        """Parse the files of a TimeBucket and combine their stations.
+
+        A thermo observation a station repeats from the previous file is
+        dropped. A file that does not exist is reported and skipped, other
+        download errors are raised and fail the whole bucket.
+        """
+        tables = []
+        data_map = {}
+        for file_name, buffer in zip(bucket.file_names, buffers):
+            try:
+                station_mapping = self._parse(file_name, buffer)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchKey':
+                    raise
+                _report_download_error(
+                    self.name, self.error_queue, file_name, e, bucket.name)
+                if self.ledger is not None:
+                    self.ledger.drop_from_bucket(bucket.name, file_name)
+                continue
+            self._record_download(file_name, buffer)
+            if self.shared_memory:
+                tables.append(station_mapping)
+            else:
+                merge_data_maps(data_map, station_mapping)
+        if self.shared_memory:
+            return concat_tables(tables, drop_duplicates=True)
+        return data_map
+
+    def _record_download(self, file_name, buffer):
+        self._metrics.observe(
+            's3_semaphore_wait', buffer.connection_wait_seconds)
+        self._metrics.observe('download', buffer.download_seconds)
+        self._metrics.count('download.files')
+        self._metrics.count('download.bytes', buffer.size)
+        if self.ledger is not None:
+            self.ledger.mark_downloaded(file_name)
+
+    def _task_done(self):
+        if self.files_done is not None:
+            with self.files_done.get_lock():
+                self.files_done.value += 1
+        self.input_queue.task_done()
+
+
+class DownloadConsumer(mp.Process):
+    """Consumer process for downloading files from S3 concurrently.
+
+    A single S3 client is reused for all files. Up to max_in_flight
+    downloads run at the same time on an asyncio event loop and the raw
+    contents are put on the output queue for a pool of FileConsumers.
+    """
+
+    def __init__(self, input_queue, output_queue, error_queue,
+                 max_in_flight=32, endpoint_url=None, files_done=None,
+                 ledger=None, metrics_queue=None, object_cache=None):
+        super().__init__()
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.error_queue = error_queue
+        self.max_in_flight = max_in_flight
+        self.endpoint_url = endpoint_url
+        self.files_done = files_done
+        self.ledger = ledger
+        self.metrics_queue = metrics_queue
+        self.object_cache = object_cache
+        self._metrics = None
+
+    def run(self):
+        logging.info("%s: starting." % self.name)
+        self._metrics = MetricsRecorder(self.metrics_queue)
+        cache_counts = _object_cache_counts(self.object_cache)
+        asyncio.run(self._download_all())
+        _record_object_cache(self._metrics, self.object_cache, cache_counts)
+        self._metrics.flush(force=True)
+
+    async def _download_all(self):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        downloads = set()
+        with AsyncS3Reader(*load_aws_keys(),
+                           max_in_flight=self.max_in_flight,
+                           endpoint_url=self.endpoint_url,
+                           cache=self.object_cache) as reader:
+            while True:
+                await slots.acquire()
+                # Queue operations block, keep them off the event loop.
+                next_task = await loop.run_in_executor(
+                    None, self.input_queue.get)
+                if isinstance(next_task, PoisonPill):
+                    logging.info("%s: encountered %s. Exiting." %
+                                 (self.name, next_task))
                     self.input_queue.task_done()
-                    continue
-                except botocore.exceptions.ClientError as e:
-                    if e.response['Error']['Code'] == 'NoSuchKey':
-                        # File does not exist on Amazon side.
-                        error_msg = "%s: file '%s' does not exist. " \
-                                    "Continuing." % \
-                                    (self.name, next_task)
-                        logging.error(error_msg)
-                        self.error_queue.put((error_msg, e, next_task))
-                        self.input_queue.task_done()
-                        continue
-                    else:
-                        raise
-
-            station_mapping = _json_to_station_objects(
-                file_contents, self.request.region)
-            logging.info("%s: finished task." % self.name)
-            self.input_queue.task_done()
+                    break
+                download = loop.create_task(
+                    self._download(reader, next_task, slots))
+                downloads.add(download)
+                download.add_done_callback(downloads.discard)
+            await asyncio.gather(*downloads)
 
-            # Split dictionary in chunks for distributed ingestion
-            minimum_chunk_size = 3000
-            chunk_size = max(int(math.ceil(
-                len(station_mapping) / self.worker_count)), minimum_chunk_size)
-            station_mapping_parts = \
-                _split_dictionary(station_mapping, chunk_size)
-            # TODO TdR 06/07/16: Debug _split_dictionary.
-            _add_to_queue(self.output_queue, station_mapping_parts)
-            logging.info('%s: placed %d stations in %d tasks on output queue.' %
-                         (self.name, len(station_mapping),
-                          len(station_mapping_parts)))
-        return
+    async def _download(self, reader, file_name, slots):
+        loop = asyncio.get_running_loop()
+        try:
+            logging.info("%s: downloading file S3://%s" %
+                         (self.name, file_name))
+            start = time()
+            file_contents, etag = await reader.read('data/' + file_name)
+            self._metrics.observe('download', time() - start)
+        except CONNECTION_ERRORS + (botocore.exceptions.ClientError,) as e:
+            # Retried or given up on by the IngestionService.
+            _report_download_error(self.name, self.error_queue, file_name, e)
+        else:
+            self._metrics.count('download.files')
+            self._metrics.count('download.bytes', len(file_contents))
+            if self.ledger is not None:
+                self.ledger.mark_downloaded(file_name)
+            # Blocks while the parsers fall behind.
+            start = time()
+            await loop.run_in_executor(
+                None, self.output_queue.put,
+                (file_name, file_contents, etag), len(file_contents))
+            self._metrics.observe('raw_queue_wait', time() - start)
+        finally:
+            self._metrics.flush()
+            self.input_queue.task_done()
+            slots.release()
 
 
 class JSONConsumer(mp.Process):
     """Consumer process for pushing station objects into MongoDB."""
 
-    def __init__(self, db_semaphore, input_queue, error_queue):
+    def __init__(self, db_semaphore, input_queue, error_queue,
+                 chunks_done=None, batch_bytes=16 * 1024 ** 2, ledger=None,
+                 metrics_queue=None, db_host=None, binary_stations=False):
         super().__init__()
         self.db_semaphore = db_semaphore
         self.input_queue = input_queue
         self.error_queue = error_queue
+        self.chunks_done = chunks_done
+        self.batch_bytes = batch_bytes
+        self.ledger = ledger
+        self.metrics_queue = metrics_queue
+        self.db_host = db_host
+        self.binary_stations = binary_stations
+        self._metrics = None
+        # Set by the IngestionService to retire this worker.
+        self.stop_event = mp.Event()
+        # (station count, estimated bytes, seconds) of every bulk write.
+        self.write_stats = []
 
     def run(self):
         """Push object mapping into MongoDB."""
         logging.info("%s: starting." % self.name)
+        self._metrics = MetricsRecorder(self.metrics_queue)
+        # A single pooled connection is reused for all tasks.
+        db_connector = MongoDBConnector(
+            host=self.db_host, binary=self.binary_stations)
+        try:
+            self._consume(db_connector)
+        finally:
+            db_connector.close()
+            self._log_write_stats()
+            self._metrics.flush(force=True)
+
+    def _consume(self, db_connector):
         while True:
-            next_task = self.input_queue.get()
+            if self.stop_event.is_set():
+                logging.info("%s: retired. Exiting." % self.name)
+                break
+            try:
+                next_task = self.input_queue.get(timeout=1)
+            except queue.Empty:
+                continue
             if isinstance(next_task, PoisonPill):
                 logging.info("%s: encountered %s. Exiting." %
                              (self.name, next_task))
                 self.input_queue.task_done()
                 break
 
+            file_name, chunk_index, next_task, key = next_task
+            wait_start = time()
             with self.db_semaphore:
-                logging.info("%s: opening database connection." % self.name)
+                self._metrics.observe(
+                    'db_semaphore_wait', time() - wait_start)
                 logging.info("%s: bulk update for %d stations." %
                              (self.name, len(next_task)))
-                # TODO TdR 19/07/16: bulk write error can occur sometimes.
-                try:
-                    _store_stations_in_database(next_task)
-                    logging.info("%s: finished task." % self.name)
-                except pymongo.errors.BulkWriteError as e:
-                    error_msg = "%s: BulkWriteError .." % self.name
-                    logging.error(error_msg)
-                    self.error_queue.put((error_msg, e, next_task))
+                if isinstance(next_task, SharedTable):
+                    with next_task.attach() as table:
+                        stored = self._store(table, db_connector, key)
+                    del table
+                else:
+                    stored = self._store(next_task, db_connector, key)
+
+            if stored:
+                self._metrics.count('write.chunks')
+            if stored and self.ledger is not None:
+                self.ledger.mark_chunk_written(file_name, chunk_index)
+            elif not stored:
+                self.error_queue.put(TaskError(
+                    file_name, "BulkWriteError in chunk %d" % chunk_index,
+                    chunk_index=chunk_index))
 
+            if self.chunks_done is not None:
+                with self.chunks_done.get_lock():
+                    self.chunks_done.value += 1
             self.input_queue.task_done()
-        return
+            self._metrics.flush()
+
+    def _store(self, station_dict, db_connector, key=None):
+        """Write stations to the database, returns True on success."""
+        # TODO TdR 19/07/16: bulk write error can occur sometimes.
+        try:
+            batches = _store_stations_in_database(
+                station_dict, db_connector, self.batch_bytes, key)
+            self.write_stats.extend(batches)
+            for count, size, seconds in batches:
+                self._metrics.observe('write', seconds)
+                self._metrics.count('write.batches')
+                self._metrics.count('write.stations', count)
+                self._metrics.count('write.bytes', size)
+            logging.info("%s: finished task." % self.name)
+            return True
+        except pymongo.errors.BulkWriteError as e:
+            logging.error("%s: BulkWriteError: %s" % (self.name, e))
+            return False
+
+    def _log_write_stats(self):
+        if len(self.write_stats) == 0:
+            return
+        counts, sizes, latencies = zip(*self.write_stats)
+        latencies = sorted(latencies)
+        logging.info(
+            "%s: %d bulk writes of on average %.0f stations (%.0f kB), "
+            "latency median %.3f s, max %.3f s, total %.1f s." %
+            (self.name, len(counts), sum(counts) / len(counts),
+             sum(sizes) / len(sizes) / 1024, latencies[len(latencies) // 2],
+             latencies[-1], sum(latencies)))
+
+
+class RetryScheduler(object):
+    """Schedule of failed files to retry.
+
+    The n-th retry of a file is due after a random delay between zero and
+    base_delay * 2 ** (n - 1) seconds, at most max_delay. The jitter spreads
+    retries of files that failed at the same time. Files that fail
+    max_attempts times in total, or with an error that is not worth
+    retrying, are given up on.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=2, max_delay=300):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Map from file names to the number of failed attempts.
+        self.attempts = {}
+        # Map from file names that are given up on to their last error.
+        self.failed = {}
+        self._schedule = []
+
+    def fail(self, file_name, message, retry=False):
+        """Register a failed attempt, returns True if a retry is scheduled."""
+        attempts = self.attempts.get(file_name, 0) + 1
+        self.attempts[file_name] = attempts
+        if retry and attempts < self.max_attempts:
+            delay = random.uniform(0, min(
+                self.max_delay, self.base_delay * 2 ** (attempts - 1)))
+            heapq.heappush(self._schedule, (time() + delay, file_name))
+            return True
+        self.failed[file_name] = message
+        return False
+
+    def due(self):
+        """Remove and return the files whose retry is due."""
+        now = time()
+        due = []
+        while len(self._schedule) > 0 and self._schedule[0][0] <= now:
+            due.append(heapq.heappop(self._schedule)[1])
+        return due
+
+    def pending(self):
+        """Number of scheduled retries."""
+        return len(self._schedule)
+
+    def log_summary(self):
+        retried = sum(1 for attempts in self.attempts.values()
+                      if attempts > 1)
+        logging.info("Main thread: %d files retried, %d files failed." %
+                     (retried, len(self.failed)))
+        for file_name in sorted(self.failed):
+            logging.error("Main thread: %s failed after %d attempts: %s." %
+                          (file_name, self.attempts[file_name],
+                           self.failed[file_name]))
+
+
+class TaskError(object):
+    """Report of a failed task, put on the error queue by workers."""
+    def __init__(self, file_name, message, retry=False, chunk_index=None,
+                 bucket=None):
+        self.file_name = file_name
+        self.message = message
+        # Whether the task is worth retrying.
+        self.retry = retry
+        # Index of the chunk that failed to be written, None for a file.
+        self.chunk_index = chunk_index
+        # Name of the TimeBucket a failed file was skipped in.
+        self.bucket = bucket
+
+
+class TimeBucket(object):
+    """Task of the files of a time span, written to the database at once."""
+    def __init__(self, name, file_names, key):
+        self.name = name
+        self.file_names = file_names
+        # Date string and hour of the documents of the bucket, with an hour
+        # of None for a day.
+        self.key = key
+
+    def __str__(self):
+        return self.name
 
 
 class PoisonPill(object):
@@ -274,59 +1142,266 @@ class PoisonPill(object):
         return 'PoisonPill-%d' % self.identifier
 
 
-def _get_request_file_paths(request):
+def _bucket_files(file_names, time_bucket, resumed=None):
+    """Group files in a TimeBucket per hour or day, in order of time.
+
+    A snapshot holds the observations of the minutes before its time, so a
+    file on the hour belongs to the previous bucket. Buckets are named
+    after their span and the time of their first file.
+
+    resumed maps the names of buckets that a previous run did not write
+    completely to their files. These files stay in their bucket, so chunks
+    that were written already are not written again, and other files of
+    the same span form a bucket of their own.
+
+    Documents are keyed by the start of their bucket rather than by the
+    first observation of a station, which may be an older observation a
+    station repeats while it does not report.
+    """
+    if time_bucket not in TIME_BUCKETS:
+        raise ValueError("Unknown time bucket %r, use one of %s." %
+                         (time_bucket, ', '.join(TIME_BUCKETS)))
+    resumed = resumed or {}
+    resumed_files = set(
+        file_name for files in resumed.values() for file_name in files)
+    spans = {}
+    for file_name in file_names:
+        if file_name not in resumed_files:
+            spans.setdefault(_bucket_start(file_name, time_bucket), []).append(
+                file_name)
+    time_buckets = [
+        _time_bucket(None, files, time_bucket) for files in spans.values()
+    ] + [
+        _time_bucket(name, files, time_bucket)
+        for name, files in resumed.items()
+    ]
+    time_buckets.sort(key=lambda bucket: (bucket.key, bucket.name))
+    return time_buckets
+
+
+def _bucket_start(file_name, time_bucket):
+    """Start of the hour or day a file belongs to."""
+    start = (file_name_to_datetime(file_name) - timedelta(seconds=1)).replace(
+        minute=0, second=0, microsecond=0)
+    if time_bucket == 'day':
+        start = start.replace(hour=0)
+    return start
+
+
+def _time_bucket(name, file_names, time_bucket):
+    """TimeBucket of files of a single span, named after the first file."""
+    files = sorted(
+        (file_name_to_datetime(file_name), file_name)
+        for file_name in file_names)
+    start = _bucket_start(files[0][1], time_bucket)
+    if name is None:
+        name = '%s_%s' % (time_bucket, files[0][0].strftime('%Y%m%d_%H%M'))
+    return TimeBucket(
+        name, [file_name for _, file_name in files],
+        (date_to_str(start), start.hour if time_bucket == 'hour' else None))
+
+
+def _get_request_file_paths(request, manifest=None):
     """List file objects to be downloaded in the remote file resource."""
-    return list_requested_files(request)
+    if manifest is None:
+        return list_requested_files(request)
+    logging.info("Main thread: skipping %d files missing from manifest." %
+                 manifest.missing_count(request))
+    return manifest.resolve(request)
 
 
-def _add_to_queue(queue, tasks):
+def _add_to_queue(task_queue, tasks):
     for task in tasks:
-        queue.put(task)
+        task_queue.put(task)
 
 
-def _download_from_s3(file_path):
-    aws_keys = load_aws_keys()
-    file_path = 'data/' + file_path
-    while True:
-        try:
-            file_contents = load_file_aws(file_path, aws_keys)
-            return file_contents
-        except (
-            botocore.exceptions.EndpointConnectionError,
-            botocore.vendored.requests.packages.urllib3
-                    .exceptions.ReadTimeoutError
-        ) as e:
-            if hasattr(e, 'msg'):
-                e_msg = e.msg
-            else:
-                e_msg = str(e)
+def _saturated(last_scaled, stage, rate):
+    """Whether the rate of a stage did not improve since it got a worker."""
+    return last_scaled is not None and last_scaled[0] == stage and \
+        rate <= last_scaled[1]
 
-            error_msg = "Connection failure while downloading %s: %s. " \
-                        "Trying again in 10 seconds." % (file_path, e_msg)
-            logging.error(error_msg)
-            sleep(10)
 
+def _report_download_error(worker_name, error_queue, file_name, error,
+                           bucket=None):
+    """Log a failed download and put it on the error queue.
+
+    Network errors and temporary S3 errors are marked for retrying. Errors
+    other than these or a missing file are raised. bucket is the name of
+    the TimeBucket in which a missing file is skipped.
+    """
+    if isinstance(error, CONNECTION_ERRORS):
+        error_msg = "network error: %s" % getattr(error, 'msg', str(error))
+        retry = True
+    elif isinstance(error, botocore.exceptions.ClientError) and \
+            error.response['Error']['Code'] in RETRY_ERROR_CODES:
+        error_msg = "S3 error: %s" % error.response['Error']['Code']
+        retry = True
+    elif isinstance(error, botocore.exceptions.ClientError) and \
+            error.response['Error']['Code'] == 'NoSuchKey':
+        # File does not exist on Amazon side.
+        error_msg = "file does not exist"
+        retry = False
+    else:
+        raise error
+    logging.error("%s: could not download file %s, %s." %
+                  (worker_name, file_name, error_msg))
+    error_queue.put(TaskError(file_name, error_msg, retry, bucket=bucket))
+
+
+def _json_to_station_objects(file_contents, region, file_name=None,
+                             parse_cache=None, metrics=None, etag=None):
+    """Stream compressed file contents into a mapping of Station objects.
+
+    file_contents are the downloaded bytes or a StreamBuffer. etag is the
+    ETag of the S3 object of downloaded bytes, a StreamBuffer has its own.
+    """
+    fp, size, etag = _open_contents(file_contents, etag)
+    if parse_cache is not None:
+        # Objects on S3 have no local modification time, their ETag
+        # changes with their contents instead.
+        key = parse_cache.key(file_name, etag, size, region, Station)
+        entry = parse_cache.get(key)
+        if entry is not None:
+            fp.close()
+            data_map, parse_stats = entry
+            log_parse_stats(parse_stats)
+            _record_parse(metrics, len(data_map))
+            return data_map
 
-def _json_to_station_objects(json_object, region):
     data_map = {}
-    parse_stats = parse_stations(json_object, data_map, region)
+    start = time()
+    reader = SnapshotReader(fp, region)
+    parse_stats = parse_stream(reader, data_map)
+    _record_parse(metrics, len(data_map), time() - start, reader)
     log_parse_stats(parse_stats)
+    if parse_cache is not None:
+        parse_cache.put(key, data_map, parse_stats)
     return data_map
 
 
-def _store_stations_in_database(station_dict):
-    db_connector = MongoDBConnector()
-    db_connector.upsert_stations(station_dict)
-    db_connector.close()
+def _json_to_station_table(file_contents, region, file_name=None,
+                           parse_cache=None, metrics=None, etag=None):
+    """Stream compressed file contents into a StationTable.
 
+    file_contents are the downloaded bytes or a StreamBuffer. etag is the
+    ETag of the S3 object of downloaded bytes, a StreamBuffer has its own.
+    """
+    fp, size, etag = _open_contents(file_contents, etag)
+    if parse_cache is not None:
+        key = parse_cache.key(file_name, etag, size, region, StationTable)
+        entry = parse_cache.get(key)
+        if entry is not None:
+            fp.close()
+            table, parse_stats = entry
+            log_parse_stats(parse_stats)
+            _record_parse(metrics, len(table))
+            return table
+
+    start = time()
+    with SnapshotReader(fp, region) as reader:
+        table, parse_stats = parse_stations_table(reader)
+    parse_stats['stations_in_file'] += reader.out_of_region
+    parse_stats['stations_out_of_region'] += reader.out_of_region
+    _record_parse(metrics, len(table), time() - start, reader)
+    log_parse_stats(parse_stats)
+    if parse_cache is not None:
+        parse_cache.put(key, table, parse_stats)
+    return table
 
-# TODO TdR 06/07/16: Test
-def _split_dictionary(whole_dict, chunk_size=2500):
-    chunk_generator = _chunks(list(whole_dict.items()), chunk_size)
-    return [dict(chunk) for chunk in chunk_generator]
 
+def _object_cache_counts(cache):
+    """Hits and misses of an S3ObjectCache so far, None without a cache."""
+    return None if cache is None else (cache.hits, cache.misses)
 
-def _chunks(l, n):
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(l), n):
-        yield l[i:i+n]
+
+def _record_object_cache(metrics, cache, counts):
+    """Log and record the lookups of a cache since counts were taken."""
+    if cache is None:
+        return
+    cache.log_stats()
+    metrics.count('download.cache_hits', cache.hits - counts[0])
+    metrics.count('download.cache_misses', cache.misses - counts[1])
+
+
+def _open_contents(file_contents, etag=None):
+    """File object, size and ETag of downloaded or streamed contents."""
+    if isinstance(file_contents, StreamBuffer):
+        size = file_contents.wait_for_size()
+        return file_contents, size, file_contents.etag
+    return BytesIO(file_contents), len(file_contents), etag
+
+
+def _record_parse(metrics, station_count, seconds=None, reader=None):
+    """Record a parsed file, without timings if it came from the cache."""
+    if metrics is None:
+        return
+    metrics.count('parse.files')
+    metrics.count('parse.stations', station_count)
+    if seconds is None:
+        metrics.count('parse.cache_hits')
+        return
+    stream_wait = 0.0
+    if isinstance(reader.fp, StreamBuffer):
+        # Reads of a streamed file also wait for the download.
+        stream_wait = reader.fp.wait_seconds
+        metrics.observe('stream_wait', stream_wait)
+    metrics.observe('decompress', reader.decompress_seconds - stream_wait)
+    metrics.observe('parse', seconds - reader.decompress_seconds)
+
+
+def _store_stations_in_database(station_dict, db_connector,
+                                batch_bytes=16 * 1024 ** 2, key=None):
+    """Upsert stations, returning statistics of the bulk writes."""
+    return db_connector.upsert_stations(station_dict, batch_bytes, key)
+
+
+def _station_bytes(station_mapping):
+    """Estimated upsert query sizes of the stations of a mapping, in order."""
+    if isinstance(station_mapping, StationTable):
+        return estimate_row_bytes(station_mapping)
+    return np.fromiter(
+        (estimate_station_bytes(station)
+         for station in station_mapping.values()),
+        dtype=np.int64, count=len(station_mapping))
+
+
+def _chunk_bounds(station_bytes, max_bytes):
+    """Split consecutive stations in chunks of at most max_bytes.
+
+    Chunks are filled greedily in order. A station larger than max_bytes
+    forms a chunk of its own.
+
+    parameters
+    ----------
+    station_bytes: array-like, estimated size of every station in bytes.
+    max_bytes: int, maximum estimated size of a chunk.
+
+    returns
+    -------
+    list of (start, end) station index tuples.
+    """
+    ends = np.cumsum(station_bytes)
+    bounds = []
+    start = 0
+    while start < len(ends):
+        offset = ends[start - 1] if start > 0 else 0
+        end = int(np.searchsorted(ends, offset + max_bytes, side='right'))
+        end = max(end, start + 1)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def _iter_chunks(station_mapping, bounds):
+    """Lazily yield the chunks of a station mapping.
+
+    A dictionary is split in dictionaries and a StationTable in tables, in
+    the order of the mapping.
+    """
+    if isinstance(station_mapping, StationTable):
+        for start, end in bounds:
+            yield station_mapping.take(np.arange(start, end))
+        return
+    items = iter(station_mapping.items())
+    for start, end in bounds:
+        yield dict(islice(items, end - start))
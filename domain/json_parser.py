@@ -1,18 +1,38 @@
 import logging
 from datetime import datetime
 
+import numpy as np
 from numpy import nan
 
-from domain.base import Station
+from domain.base import Station, CompactStation
+from domain.station_table import StationTable
 
+# Mapping of StationTable columns to json record fields.
+THERMO_FIELDS = {
+    'valid_datetime': 'time_utc',
+    'temperature': 'Temperature',
+    'humidity': 'Humidity',
+    'pressure': 'Pressure'
+}
+HYDRO_FIELDS = {
+    'time_day_rain': 'time_day_rain',
+    'time_hour_rain': 'time_hour_rain',
+    'daily_rain_sum': 'Rain',
+    'hourly_rain_sum': 'sum_rain_1'
+}
 
-def parse_stations(station_list, data_map, region=None):
+
+def parse_stations(station_list, data_map, region=None,
+                   station_class=Station):
     """Given contents of a single data file, update the given data objects.
 
     parameters
     ----------
-    station_list: list, list of all station ids included in data_map
+    station_list: iterable, station records from a single data file
     data_map: dict, mapping of station ids to Station objects
+    region: tuple (optional), bounding box as used in DataRequest
+    station_class: class (optional), Station or CompactStation, used for
+        new stations
     """
     # new_stations = 0
     # station_contributions = 0
@@ -23,9 +43,11 @@ def parse_stations(station_list, data_map, region=None):
     statistics['station_hydro_contributions'] = 0
     statistics['stations_out_of_region'] = 0
     statistics['station_count'] = 0
-    statistics['stations_in_file'] = len(station_list)
+    statistics['stations_in_file'] = 0
 
     for point in station_list:
+        statistics['stations_in_file'] += 1
+
         # Data sanitization
         if 'location' not in point:
             continue
@@ -35,12 +57,7 @@ def parse_stations(station_list, data_map, region=None):
             continue
 
         # Extract data
-        if 'station_id' in point:
-            station_id = point['station_id']
-        elif isinstance(point['_id'], dict) and 'station_id' in point['_id']:
-            station_id = point['_id']['station_id']
-        else:
-            station_id = point['_id']
+        station_id = _get_station_id(point)
         lon, lat = point['location']
 
         #   See if station is in requested region
@@ -51,7 +68,7 @@ def parse_stations(station_list, data_map, region=None):
         # Add station to map
         if station_id not in data_map:
             statistics['new_stations'] += 1
-            data_map[station_id] = Station(station_id, lat, lon)
+            data_map[station_id] = station_class(station_id, lat, lon)
 
         thermo_success = \
             parse_station_thermo_data(point['data'], data_map[station_id])
@@ -67,6 +84,138 @@ def parse_stations(station_list, data_map, region=None):
     return statistics
 
 
+def parse_stations_batch(station_list, data_map, region=None,
+                         station_class=Station):
+    """Variant of parse_stations with vectorized region filtering.
+
+    The locations of all records are collected into arrays and tested
+    against the region at once. Only records inside the region are parsed.
+    The statistics equal those of parse_stations.
+
+    parameters
+    ----------
+    station_list: list, station records from a single data file
+    data_map: dict, mapping of station ids to Station objects
+    region: tuple (optional), bounding box as used in DataRequest
+    station_class: class (optional), Station or CompactStation
+    """
+    if region is None:
+        return parse_stations(station_list, data_map, None, station_class)
+
+    complete, in_region = region_mask(station_list, region)
+    statistics = parse_stations(
+        [point for point, keep in zip(station_list, in_region) if keep],
+        data_map, None, station_class)
+    statistics['stations_in_file'] = len(station_list)
+    statistics['stations_out_of_region'] = \
+        int(np.count_nonzero(complete & ~in_region))
+    return statistics
+
+
+def region_mask(station_list, region):
+    """Vectorized region test for a list of station records.
+
+    Incomplete records, which parse_stations skips, are never in region.
+
+    returns
+    -------
+    tuple of boolean arrays, whether records are complete and whether
+    records are complete and inside the region.
+    """
+    complete = np.fromiter(
+        (('location' in point and '_id' in point and 'data' in point)
+         for point in station_list),
+        dtype=bool, count=len(station_list))
+    locations = np.array(
+        [point['location'] for point, keep in zip(station_list, complete)
+         if keep],
+        dtype=np.float64).reshape(-1, 2)
+
+    in_region = np.zeros(len(station_list), dtype=bool)
+    in_region[complete] = _is_inside_box(
+        locations[:, 1], locations[:, 0], *region)
+    return complete, in_region
+
+
+def parse_stations_table(station_list, region=None):
+    """Given contents of a single data file, create a StationTable.
+
+    Records are collected into observation columns, which are grouped by
+    station in a single pass. The statistics equal those of parse_stations
+    on an empty data_map.
+
+    parameters
+    ----------
+    station_list: iterable, station records from a single data file
+    region: tuple (optional), bounding box as used in DataRequest
+    """
+    statistics = {}
+    statistics['new_stations'] = 0
+    statistics['station_thermo_contributions'] = 0
+    statistics['station_hydro_contributions'] = 0
+    statistics['stations_out_of_region'] = 0
+    statistics['station_count'] = 0
+    statistics['stations_in_file'] = 0
+
+    station_rows = {}
+    station_ids, latitudes, longitudes = [], [], []
+    thermo_station, hydro_station = [], []
+    thermo = {column: [] for column in THERMO_FIELDS}
+    hydro = {column: [] for column in HYDRO_FIELDS}
+
+    for point in station_list:
+        statistics['stations_in_file'] += 1
+
+        # Data sanitization
+        if 'location' not in point:
+            continue
+        if '_id' not in point:
+            continue
+        if 'data' not in point:
+            continue
+
+        station_id = _get_station_id(point)
+        lon, lat = point['location']
+
+        #   See if station is in requested region
+        if region is not None and not _is_inside_box(lat, lon, *region):
+            statistics['stations_out_of_region'] += 1
+            continue
+
+        row = station_rows.get(station_id)
+        if row is None:
+            row = len(station_ids)
+            station_rows[station_id] = row
+            station_ids.append(station_id)
+            latitudes.append(lat)
+            longitudes.append(lon)
+
+        station_data = point['data']
+        if 'time_utc' in station_data:
+            thermo_station.append(row)
+            for column, field in THERMO_FIELDS.items():
+                thermo[column].append(station_data.get(field, nan))
+        if 'time_day_rain' in station_data and \
+           'time_hour_rain' in station_data:
+            hydro_station.append(row)
+            for column, field in HYDRO_FIELDS.items():
+                hydro[column].append(station_data.get(field, nan))
+
+    table = StationTable.from_rows(
+        station_ids, latitudes, longitudes,
+        np.array(thermo_station, dtype=np.int64), thermo,
+        np.array(hydro_station, dtype=np.int64), hydro
+    )
+    table.drop_thermo_duplicates()
+
+    statistics['new_stations'] = len(table)
+    statistics['station_thermo_contributions'] = \
+        len(table.thermo['valid_datetime'])
+    statistics['station_hydro_contributions'] = len(hydro_station)
+    statistics['station_count'] = len(table)
+    return table, statistics
+
+
 def parse_station_hydro_data(station_data, station):
     """Parse precipitation data from a single json record.
 
@@ -79,6 +228,14 @@ def parse_station_hydro_data(station_data, station):
        ('time_hour_rain' not in station_data):
         return False
 
+    if isinstance(station, CompactStation):
+        station.add_hydro(
+            station_data['time_day_rain'],
+            station_data['time_hour_rain'],
+            station_data.get('Rain', nan),
+            station_data.get('sum_rain_1', nan))
+        return True
+
     time_day_rain = datetime.utcfromtimestamp(station_data['time_day_rain'])
     time_hour_rain = datetime.utcfromtimestamp(station_data['time_hour_rain'])
 
@@ -104,6 +261,13 @@ def parse_station_thermo_data(station_data, station):
     if 'time_utc' not in station_data:
         return False
 
+    if isinstance(station, CompactStation):
+        return station.add_thermo(
+            station_data['time_utc'],
+            station_data.get('Temperature', nan),
+            station_data.get('Humidity', nan),
+            station_data.get('Pressure', nan))
+
     valid_datetime = datetime.utcfromtimestamp(station_data['time_utc'])
 
     # Simple duplicate detection
@@ -119,6 +283,14 @@ def parse_station_thermo_data(station_data, station):
     return True
 
 
+def _get_station_id(point):
+    if 'station_id' in point:
+        return point['station_id']
+    elif isinstance(point['_id'], dict) and 'station_id' in point['_id']:
+        return point['_id']['station_id']
+    return point['_id']
+
+
 def _add_value(input_dict, input_name, output_dict, output_name):
     value = nan
     if input_name in input_dict:
@@ -127,7 +299,13 @@ def _add_value(input_dict, input_name, output_dict, output_name):
 
 
 def _is_inside_box(lat, lon, tl_lat, tl_lon, br_lat, br_lon):
-    """Whether a coordinate is inside a bounding box. """
+    """Whether a coordinate is inside a bounding box.
+
+    Also accepts arrays of coordinates, returning a boolean array.
+    """
+    if isinstance(lat, np.ndarray):
+        return (br_lat <= lat) & (lat <= tl_lat) & \
+            (tl_lon <= lon) & (lon <= br_lon)
     return (br_lat <= lat <= tl_lat) and (tl_lon <= lon <= br_lon)
 
 
@@ -0,0 +1,165 @@
+"""Module with a persistent index of archived NetAtmo data files."""
+import json
+import logging
+import os
+from bisect import bisect_left, bisect_right
+
+from domain.base import _to_epoch
+from domain.file_io import SnapshotReader, file_name_to_datetime
+
+
+class ArchiveManifest(object):
+    """Index of the data files in a local directory or S3 prefix.
+
+    For every file the manifest records its timestamp, size and optionally
+    its number of station records. Files are kept sorted by timestamp, so a
+    DataRequest is resolved with binary search instead of testing every
+    requested name against a directory listing. The manifest is stored as
+    json and refreshed incrementally: only new or changed files are
+    inspected.
+    """
+
+    def __init__(self, manifest_path=None):
+        """Initialize a manifest, loading it if manifest_path exists.
+
+        parameters
+        ----------
+        manifest_path: str (optional), json file to persist the manifest.
+        """
+        self.manifest_path = manifest_path
+        # Map from file names to dictionaries with timestamp (UTC epoch
+        # seconds), size (bytes) and record_count (None if not counted).
+        self.files = {}
+        self._timestamps = []
+        self._file_names = []
+
+        if manifest_path is not None and os.path.exists(manifest_path):
+            self.load()
+
+    def load(self):
+        with open(self.manifest_path, "r") as fp:
+            self.files = json.load(fp)['files']
+        self._build_index()
+
+    def save(self):
+        """Atomically write the manifest to manifest_path."""
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, "w") as fp:
+            json.dump({'files': self.files}, fp)
+        os.replace(temp_path, self.manifest_path)
+
+    def refresh_local(self, directory, count_records=False):
+        """Update the manifest with the data files in a local directory.
+
+        parameters
+        ----------
+        directory: str, directory containing the json files.
+        count_records: bool (optional), count station records of new files.
+        """
+        listing = {}
+        for file_name in os.listdir(directory):
+            if file_name.endswith(".json.gz"):
+                listing[file_name] = os.path.getsize(
+                    os.path.join(directory, file_name))
+
+        def open_file(file_name):
+            return open(os.path.join(directory, file_name), "rb")
+
+        return self._refresh(listing, open_file, count_records)
+
+    def refresh_s3(self, bucket_engine, prefix='data/', count_records=False):
+        """Update the manifest with the data files in an S3 prefix.
+
+        parameters
+        ----------
+        bucket_engine: S3Bucket object
+        prefix: str (optional), key prefix of the data files.
+        count_records: bool (optional), count station records of new files.
+            This downloads every new file.
+        """
+        listing = {}
+        for key, size in bucket_engine.list(prefix):
+            if key.endswith(".json.gz"):
+                listing[key[len(prefix):]] = size
+
+        def open_file(file_name):
+            return bucket_engine.open(prefix + file_name)
+
+        return self._refresh(listing, open_file, count_records)
+
+    def resolve(self, request):
+        """List the file names in the manifest that match a DataRequest.
+
+        Files are matched on timestamps from start_datetime up to and
+        including end_datetime, in steps of time_resolution minutes. If
+        the request lists file names, these are matched instead.
+        """
+        if request.file_names is not None:
+            return [file_name for file_name in request.file_names
+                    if file_name in self.files]
+        start = _to_epoch(request.start_datetime)
+        step = request.time_resolution * 60
+        first = bisect_left(self._timestamps, start)
+        last = bisect_right(
+            self._timestamps, _to_epoch(request.end_datetime))
+        return [
+            self._file_names[index] for index in range(first, last)
+            if (self._timestamps[index] - start) % step == 0
+        ]
+
+    def missing_count(self, request):
+        """Number of requested files that are not in the manifest."""
+        if request.file_names is not None:
+            return len(request.file_names) - len(self.resolve(request))
+        start = _to_epoch(request.start_datetime)
+        end = _to_epoch(request.end_datetime)
+        step = request.time_resolution * 60
+        requested = (end - start) // step + 1 if end >= start else 0
+        return requested - len(self.resolve(request))
+
+    def _refresh(self, listing, open_file, count_records):
+        """Synchronize the manifest with a listing of file names to sizes."""
+        removed = [name for name in self.files if name not in listing]
+        for file_name in removed:
+            del self.files[file_name]
+
+        updated = 0
+        for file_name, size in listing.items():
+            entry = self.files.get(file_name)
+            if entry is not None and entry['size'] == size and \
+               (entry['record_count'] is not None or not count_records):
+                continue
+
+            try:
+                timestamp = _to_epoch(file_name_to_datetime(file_name))
+            except ValueError:
+                logging.warning("Manifest: skipping unknown file %s." %
+                                file_name)
+                continue
+
+            record_count = None
+            if count_records:
+                with SnapshotReader(open_file(file_name)) as reader:
+                    record_count = sum(1 for _ in reader)
+
+            self.files[file_name] = {
+                'timestamp': timestamp,
+                'size': size,
+                'record_count': record_count
+            }
+            updated += 1
+
+        self._build_index()
+        logging.info("Manifest: %d files, %d updated, %d removed." %
+                     (len(self.files), updated, len(removed)))
+        if self.manifest_path is not None:
+            self.save()
+        return updated
+
+    def _build_index(self):
+        index = sorted(
+            (entry['timestamp'], file_name)
+            for file_name, entry in self.files.items()
+        )
+        self._timestamps = [timestamp for timestamp, _ in index]
+        self._file_names = [file_name for _, file_name in index]
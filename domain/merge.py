@@ -1,4 +1,5 @@
-from domain.base import Station
+from domain.base import Station, CompactStation
+from domain.station_table import concat_tables
 
 
 def merge_documents(documents):
@@ -22,13 +23,18 @@ def clean_id(station):
 
 # TODO Move to base class
 def merge_stations(station_1, station_2):
-    assert isinstance(station_1, Station)
-    assert isinstance(station_2, Station)
-
     clean_id(station_1)
     clean_id(station_2)
     assert station_1.station_id == station_2.station_id
 
+    if isinstance(station_1, CompactStation):
+        assert isinstance(station_2, CompactStation)
+        station_1.extend(station_2)
+        return station_1
+
+    assert isinstance(station_1, Station)
+    assert isinstance(station_2, Station)
+
     merge_location(station_1, station_2)
     merge_thermo_module(station_1, station_2)
     merge_hydro_module(station_1, station_2)
@@ -55,3 +61,53 @@ def merge_dict_of_lists(d1, d2):
         assert isinstance(d1[attr], list)
         assert isinstance(d2[attr], list)
         d1[attr] += d2[attr]
+
+
+def merge_data_maps(data_map, partial_map):
+    """Merge a partial station mapping into data_map, in place.
+
+    Observations of partial_map are appended after those of data_map. As in
+    json_parser.parse_station_thermo_data, a thermo record carrying the same
+    valid datetime as the last known record of the station is dropped.
+
+    parameters
+    ----------
+    data_map: dict, mapping of station ids to Station objects
+    partial_map: dict, mapping of station ids to Station objects
+
+    returns
+    -------
+    dict, with the number of new stations and dropped thermo duplicates.
+    """
+    statistics = {'new_stations': 0, 'thermo_duplicates': 0}
+    for station_id, station in partial_map.items():
+        if station_id not in data_map:
+            statistics['new_stations'] += 1
+            data_map[station_id] = station
+            continue
+
+        stack = data_map[station_id]
+        if isinstance(stack, CompactStation):
+            if stack.extend(station, drop_duplicate=True):
+                statistics['thermo_duplicates'] += 1
+            continue
+
+        thermo = station.thermo_module
+        if stack.thermo_module['valid_datetime'] != [] and \
+           thermo['valid_datetime'] != [] and \
+           stack.thermo_module['valid_datetime'][-1] == \
+                thermo['valid_datetime'][0]:
+            statistics['thermo_duplicates'] += 1
+            thermo = {key: values[1:] for key, values in thermo.items()}
+        merge_dict_of_lists(stack.thermo_module, thermo)
+        merge_dict_of_lists(stack.hydro_module, station.hydro_module)
+    return statistics
+
+
+def merge_tables(tables):
+    """Merge StationTable objects into a single table.
+
+    The columnar equivalent of merge_documents, observations of equal
+    station ids are appended in table order.
+    """
+    return concat_tables(tables)
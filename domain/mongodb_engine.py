@@ -1,52 +1,245 @@
 """Module for communicating with MongoDB."""
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from time import time
 
+import numpy as np
 import pymongo
 import pymongo.son_manipulator
 from bson.binary import Binary
 
-from domain.base import Station
+from domain.base import (
+    Station, CompactStation, _to_epoch, unpack_binaries)
+from domain.station_table import (
+    HYDRO_COLUMNS, THERMO_COLUMNS, TIME_COLUMNS, StationTable)
+
+# Fields of station documents read by queries.
+QUERY_PROJECTION = {
+    '_id': 0, 'station_id': 1, 'latitude': 1, 'longitude': 1,
+    'elevation': 1, 'thermo_module': 1, 'hydro_module': 1, 'series': 1
+}
+# Indexes for queries on time and region, as (name, keys) tuples. Station
+# documents hold latitude and longitude as separate fields, which geo
+# indexes do not cover, so bounding boxes use range scans.
+QUERY_INDEXES = [
+    ('time_region', [('_id.date', pymongo.ASCENDING),
+                     ('_id.hour', pymongo.ASCENDING),
+                     ('latitude', pymongo.ASCENDING),
+                     ('longitude', pymongo.ASCENDING)]),
+    ('region', [('latitude', pymongo.ASCENDING),
+                ('longitude', pymongo.ASCENDING)])
+]
+# Order of query results, so that documents of a station come in order of
+# time. Day documents, without an hour, come first on their date.
+QUERY_SORT = [('_id.date', pymongo.ASCENDING), ('_id.hour', pymongo.ASCENDING)]
 
 
 class MongoDBConnector(object):
     """Connector class for reading and writing NetAtmo data."""
 
-    def __init__(self):
+    def __init__(self, max_pool_size=100, host=None, binary=False):
+        """Initialize a connector.
+
+        parameters
+        ----------
+        max_pool_size: int (optional), maximum number of connections the
+            client keeps open. A connector is meant to be long-lived, so
+            connections are reused between writes.
+        host: str (optional), MongoDB host or connection string. By default
+            the server on localhost is used.
+        binary: bool (optional), write observations packed with
+            Station.to_binary instead of as array elements. Every write
+            appends a Binary to the series field of a document, which
+            Station.from_binary_document decodes. Packing pays off most when
+            writes carry several observations per station, many single
+            observation writes decode slower than arrays. Do not mix both
+            layouts in a database.
+        """
         # Write concern describes the level of acknowledgement
         # requested from MongoDB for write operations. Turning it
         # off may result in performance increase for write operations.
         # This comes at the cost of error reporting.
         write_concern = 1
         # TODO TdR 08/12/16: configure database.
-        self._client = pymongo.MongoClient(w=write_concern)
+        self._client = pymongo.MongoClient(
+            host, w=write_concern, maxPoolSize=max_pool_size)
         self.db = self._client.netatmo  # Database name
+        self.binary = binary
+        self._indexed = False
         # TODO TdR 08/07/16: Objects are not yet pushed in as stations.
         self.db.add_son_manipulator(BinaryTransformer())
+        # Executes one bulk operation while the next one is built.
+        self._writer = ThreadPoolExecutor(1)
 
     def close(self):
+        self._writer.shutdown()
         self._client.close()
 
-    def upsert_stations(self, station_dict):
-        """Update station records or insert them otherwise."""
+    def create_query_indexes(self):
+        """Create the QUERY_INDEXES, if they do not exist yet."""
+        for name, keys in QUERY_INDEXES:
+            self.db.stations.create_index(keys, name=name)
+        self._indexed = True
+
+    def query(self, request, batch_size=1000):
+        """Stream the stations of a DataRequest from the database.
+
+        The time range and region of the request are evaluated by the
+        server, on the date and hour of the document keys and on the
+        latitude and longitude of stations. Observations outside the time
+        range are dropped from the results. The time resolution of the
+        request is ignored. The query indexes are created on first use.
+
+        Documents of both the array and the binary layout are read, see
+        __init__. To load all stations at once, use
+        station_table.concat_tables(connector.query(request)).
+
+        parameters
+        ----------
+        request: DataRequest object
+        batch_size: int (optional), number of documents per batch.
+
+        returns
+        -------
+        generator of StationTable objects, one per batch of documents. The
+        observations of a station can be spread over several batches, which
+        come in order of time.
+        """
+        if not self._indexed:
+            self.create_query_indexes()
+        cursor = self.db.stations.find(
+            _request_filter(request), QUERY_PROJECTION,
+            batch_size=batch_size).sort(QUERY_SORT)
+        start = _epoch_or_none(request.start_datetime)
+        end = _epoch_or_none(request.end_datetime)
+        while True:
+            documents = list(islice(cursor, batch_size))
+            if len(documents) == 0:
+                break
+            yield _documents_to_table(documents, start, end)
+
+    def upsert_stations(self, station_dict, batch_bytes=16 * 1024 ** 2,
+                        key=None):
+        """Update station records or insert them otherwise.
+
+        station_dict is a mapping of station ids to Station objects or a
+        StationTable. Stations are written in unordered bulk operations of at
+        most batch_bytes, as estimated by estimate_station_bytes or from the
+        packed size of binary writes. The next bulk operation is built while
+        the previous one executes.
+
+        Documents are keyed by the date and hour of the first observation of
+        a station, unless a (date, hour) key is given for all stations, such
+        as that of an IngestionService time bucket. Documents with an hour of
+        None hold the observations of a whole day.
+
+        returns
+        -------
+        list of (station count, estimated bytes, seconds) tuples, one for
+        every bulk operation.
+        """
         skipped = 0
-        bulk = self.db.stations.initialize_unordered_bulk_op()
-        for station_id in station_dict:
+        batches = []
+        in_flight = None
+        bulk, count, size = None, 0, 0
+        for station in _stations(station_dict):
             try:
-                station = station_dict[station_id]
-
-                query = {'_id': _get_primary_key(station)}
-                update = _construct_station_upsert_query(station)
-                bulk.find(query).upsert().update(update)
-                # self.db.stations.update(query, update, True)
+                query = {'_id': _get_primary_key(station, key)}
+                if self.binary:
+                    update = _construct_binary_upsert_query(station, key)
+                    station_bytes = BSON_STATION_BYTES + \
+                        len(update['$push']['series'])
+                else:
+                    update = _construct_station_upsert_query(station, key)
+                    station_bytes = estimate_station_bytes(station)
             except RuntimeError:
                 skipped += 1
                 continue
-        bulk.execute()
+
+            if bulk is not None and size + station_bytes > batch_bytes:
+                if in_flight is not None:
+                    batches.append(in_flight.result())
+                in_flight = self._writer.submit(
+                    _execute_bulk, bulk, count, size)
+                bulk = None
+            if bulk is None:
+                bulk = self.db.stations.initialize_unordered_bulk_op()
+                count, size = 0, 0
+            bulk.find(query).upsert().update(update)
+            count += 1
+            size += station_bytes
+
+        if in_flight is not None:
+            batches.append(in_flight.result())
+        if bulk is not None:
+            batches.append(_execute_bulk(bulk, count, size))
         logging.info("%d records were skipped due to missing data." % skipped)
+        return batches
+
 
+def _stations(station_dict):
+    """Iterate over the stations of a dict or StationTable."""
+    if isinstance(station_dict, StationTable):
+        return station_dict.iter_stations()
+    return station_dict.values()
 
-def _get_primary_key(station):
-    date, hour = _get_current_date(station)
+
+def _execute_bulk(bulk, count, size):
+    """Execute a bulk operation, returning its count, size and latency."""
+    start = time()
+    bulk.execute()
+    return count, size, time() - start
+
+
+# Estimated BSON sizes in bytes of a station document without observations,
+# and of a single array element: type, array index key and 8 byte value.
+BSON_STATION_BYTES = 256
+BSON_ELEMENT_BYTES = 14
+
+
+def estimate_station_bytes(station):
+    """Estimate the BSON size of the upsert query of a station.
+
+    For a StationTable, the total size of the upsert queries of all its
+    stations is estimated.
+    """
+    if isinstance(station, StationTable):
+        return BSON_STATION_BYTES * len(station) + 4 * BSON_ELEMENT_BYTES * \
+            int(station.thermo_offsets[-1] + station.hydro_offsets[-1])
+    elif isinstance(station, CompactStation):
+        thermo_count = len(station.thermo_epochs())
+        hydro_count = len(station.hydro_epochs())
+    else:
+        thermo_count = len(station.thermo_module['valid_datetime']) \
+            if station.thermo_module is not None else 0
+        hydro_count = len(station.hydro_module['time_hour_rain']) \
+            if station.hydro_module is not None else 0
+    # Both modules hold four values per observation.
+    return BSON_STATION_BYTES + \
+        4 * BSON_ELEMENT_BYTES * (thermo_count + hydro_count)
+
+
+def estimate_row_bytes(table):
+    """Estimate the BSON size of the upsert query of every StationTable row.
+
+    returns
+    -------
+    numpy.ndarray of sizes in bytes, one for every station of the table.
+    """
+    thermo_counts = table.thermo_offsets[1:] - table.thermo_offsets[:-1]
+    hydro_counts = table.hydro_offsets[1:] - table.hydro_offsets[:-1]
+    return BSON_STATION_BYTES + \
+        4 * BSON_ELEMENT_BYTES * (thermo_counts + hydro_counts)
+
+
+def _get_primary_key(station, key=None):
+    if key is None:
+        date, hour = _get_current_date(station)
+    else:
+        # Stations without data are skipped, as for the default key.
+        _get_current_date(station)
+        date, hour = key
     return {
         'station_id': station.station_id,
         'date': date,
@@ -73,10 +266,10 @@ def date_to_str(datetime):
     return datetime.date().strftime(date_str)
 
 
-def _construct_station_upsert_query(station):
+def _construct_station_upsert_query(station, key=None):
     update = {
         '$setOnInsert': {
-            '_id': _get_primary_key(station),
+            '_id': _get_primary_key(station, key),
             'station_id': station.station_id,
             'elevation': station.elevation,
             'latitude': station.latitude,
@@ -115,12 +308,31 @@ def _construct_station_upsert_query(station):
     return update
 
 
+def _construct_binary_upsert_query(station, key=None):
+    """Upsert query appending the packed observations of a station."""
+    return {
+        '$setOnInsert': {
+            '_id': _get_primary_key(station, key),
+            'station_id': station.station_id,
+            'elevation': station.elevation,
+            'latitude': station.latitude,
+            'longitude': station.longitude
+        },
+        '$push': {'series': _to_bson_binary(station)}
+    }
+
+
+def _to_bson_binary(station):
+    """Packed observations of a station as a BSON Binary."""
+    return Binary(station.to_binary(), Station.binary_subtype)
+
+
 class BinaryTransformer(pymongo.son_manipulator.SONManipulator):
 
     def transform_incoming(self, son, collection):
         for (key, value) in son.items():
             if isinstance(value, Station):
-                son[key] = value.to_binary()
+                son[key] = _to_bson_binary(value)
             elif isinstance(value, dict):
                 son[key] = self.transform_incoming(value, collection)
         return son
@@ -133,3 +345,149 @@ class BinaryTransformer(pymongo.son_manipulator.SONManipulator):
             elif isinstance(value, dict):
                 son[key] = self.transform_outgoing(value, collection)
         return son
+
+
+def _request_filter(request):
+    """Query filter on the time range and region of a DataRequest."""
+    conditions = []
+    if request.start_datetime is not None or \
+       request.end_datetime is not None:
+        conditions.append(
+            _time_filter(request.start_datetime, request.end_datetime))
+    if request.region is not None:
+        tl_lat, tl_lon, br_lat, br_lon = request.region
+        conditions.append({
+            'latitude': {'$gte': br_lat, '$lte': tl_lat},
+            'longitude': {'$gte': tl_lon, '$lte': br_lon}
+        })
+    if len(conditions) == 0:
+        return {}
+    elif len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
+
+
+def _time_filter(start_datetime, end_datetime):
+    """Filter on the date and hour keys of documents in a time range.
+
+    Either end of the range can be None. Dates are compared as strings,
+    which sort in order of time. Documents of a whole day, without an hour,
+    match on their date.
+    """
+    days = {}
+    if start_datetime is not None:
+        days['$gte'] = date_to_str(start_datetime)
+    if end_datetime is not None:
+        days['$lte'] = date_to_str(end_datetime)
+    day_documents = {'_id.date': days, '_id.hour': None}
+
+    if start_datetime is not None and end_datetime is not None and \
+       start_datetime.date() == end_datetime.date():
+        return {'$or': [
+            {'_id.date': date_to_str(start_datetime),
+             '_id.hour': {'$gte': start_datetime.hour,
+                          '$lte': end_datetime.hour}},
+            day_documents
+        ]}
+
+    # The hours of the first and last day and all days in between.
+    branches = []
+    dates = {}
+    if start_datetime is not None:
+        branches.append({'_id.date': date_to_str(start_datetime),
+                         '_id.hour': {'$gte': start_datetime.hour}})
+        dates['$gt'] = date_to_str(start_datetime)
+    if end_datetime is not None:
+        branches.append({'_id.date': date_to_str(end_datetime),
+                         '_id.hour': {'$lte': end_datetime.hour}})
+        dates['$lt'] = date_to_str(end_datetime)
+    branches.append({'_id.date': dates})
+    branches.append(day_documents)
+    return {'$or': branches}
+
+
+def _documents_to_table(documents, start=None, end=None):
+    """Convert station documents to a StationTable.
+
+    Documents of the same station are merged into one row and its
+    observations are sorted by time. Observations with a time outside start
+    and end, in epoch seconds, are dropped.
+    """
+    rows = {}
+    latitude, longitude, elevation = [], [], []
+    segments, segment_rows = [], []
+    thermo_rows, hydro_rows = [], []
+    thermo_lists = {column: [] for column in THERMO_COLUMNS}
+    hydro_lists = {column: [] for column in HYDRO_COLUMNS}
+    for document in documents:
+        station_id = document['station_id']
+        row = rows.get(station_id)
+        if row is None:
+            row = rows[station_id] = len(rows)
+            latitude.append(document['latitude'])
+            longitude.append(document['longitude'])
+            station_elevation = document.get('elevation')
+            elevation.append(
+                np.nan if station_elevation is None else station_elevation)
+
+        if 'series' in document:
+            segments.extend(document['series'])
+            segment_rows.extend([row] * len(document['series']))
+            continue
+        for module, lists, module_rows, time_column in (
+                (document.get('thermo_module'), thermo_lists, thermo_rows,
+                 'valid_datetime'),
+                (document.get('hydro_module'), hydro_lists, hydro_rows,
+                 'time_hour_rain')):
+            if module is None:
+                continue
+            for column, values in lists.items():
+                values.extend(module[column])
+            module_rows.extend([row] * len(module[time_column]))
+
+    thermo, hydro, thermo_counts, hydro_counts = unpack_binaries(segments)
+    segment_rows = np.array(segment_rows, dtype=np.int64)
+    modules = []
+    for lists, module_rows, binary_module, counts, time_column in (
+            (thermo_lists, thermo_rows, thermo, thermo_counts,
+             'valid_datetime'),
+            (hydro_lists, hydro_rows, hydro, hydro_counts,
+             'time_hour_rain')):
+        module = {
+            column: np.concatenate([
+                _column_array(column, values), binary_module[column]])
+            for column, values in lists.items()
+        }
+        station = np.concatenate([
+            np.array(module_rows, dtype=np.int64),
+            np.repeat(segment_rows, counts)])
+        keep = np.ones(len(station), dtype=bool)
+        if start is not None:
+            keep &= module[time_column] >= start
+        if end is not None:
+            keep &= module[time_column] <= end
+        selected = np.flatnonzero(keep)
+        # Documents do not have to come in order of time, the rows of every
+        # station are grouped in the order of their times.
+        selected = selected[np.argsort(
+            module[time_column][selected], kind='stable')]
+        modules.append((
+            station[selected],
+            {column: values[selected] for column, values in module.items()}))
+
+    return StationTable.from_rows(
+        list(rows), latitude, longitude, modules[0][0], modules[0][1],
+        modules[1][0], modules[1][1], elevation)
+
+
+def _column_array(column, values):
+    """Convert the values of a document column to a table column."""
+    if column in TIME_COLUMNS:
+        return np.array(values, dtype='datetime64[s]').astype(np.int64)
+    return np.array(values, dtype=np.float32)
+
+
+def _epoch_or_none(timestamp):
+    if timestamp is None:
+        return None
+    return _to_epoch(timestamp)
@@ -0,0 +1,59 @@
+"""Module for caching S3 objects on local disk."""
+import hashlib
+
+from domain.disk_cache import DiskCache
+
+
+class S3ObjectCache(DiskCache):
+    """Size bounded on-disk cache of S3 objects.
+
+    Every entry holds the contents of a single object, keyed by bucket, key
+    and ETag. The ETag of an object is requested before reading it, so a
+    changed object never hits a stale entry.
+
+    Least recently used entries are evicted when the cache is full, see
+    DiskCache. Objects are read from several threads of a process.
+    """
+
+    suffix = '.object'
+    name = 'Object cache'
+
+    def __init__(self, directory, max_bytes=20 * 1024 ** 3):
+        """Initialize a cache.
+
+        parameters
+        ----------
+        directory: str, cache directory, created if it does not exist.
+        max_bytes: int (optional), maximum total size of cache entries.
+        """
+        super().__init__(directory, max_bytes)
+
+    @staticmethod
+    def key(bucket, object_key, etag):
+        """Create a cache key for an object."""
+        description = repr((bucket, object_key, etag))
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def read(self, client, bucket, object_key):
+        """Read an object with a boto3 client, from the cache if possible.
+
+        Returns the contents and ETag of the object.
+        """
+        etag = client.head_object(Bucket=bucket, Key=object_key)['ETag']
+        data = self.get(bucket, object_key, etag)
+        if data is None:
+            response = client.get_object(Bucket=bucket, Key=object_key)
+            data = response['Body'].read()
+            etag = response['ETag']
+            self.put(bucket, object_key, etag, data)
+        return data, etag
+
+    def get(self, bucket, object_key, etag):
+        """Return the cached contents of an object or None."""
+        return self._read_entry(
+            self.key(bucket, object_key, etag), lambda fp: fp.read())
+
+    def put(self, bucket, object_key, etag, data):
+        """Store an object and evict entries if the cache is full."""
+        self._write_entry(
+            self.key(bucket, object_key, etag), lambda fp: fp.write(data))
@@ -0,0 +1,69 @@
+"""Module for caching parsed NetAtmo data files on disk."""
+import hashlib
+import os
+import pickle
+
+from domain.disk_cache import DiskCache
+
+
+class ParseCache(DiskCache):
+    """Size bounded on-disk cache of parsed data files.
+
+    Every entry holds the station mapping and parse statistics of a single
+    file, stored as a pickle. Entries are keyed by file name, modification
+    time of a local file or ETag of an S3 object, size, requested region and
+    station class, so a changed file or a different request never hits a
+    stale entry.
+
+    Least recently used entries are evicted when the cache is full, see
+    DiskCache.
+    """
+
+    suffix = '.pickle'
+    name = 'Parse cache'
+    read_errors = (EOFError, pickle.UnpicklingError)
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        """Initialize a cache.
+
+        parameters
+        ----------
+        directory: str, cache directory, created if it does not exist.
+        max_bytes: int (optional), maximum total size of cache entries.
+        """
+        super().__init__(directory, max_bytes)
+
+    @staticmethod
+    def key(file_name, mtime, size, region, station_class):
+        """Create a cache key for a data file.
+
+        parameters
+        ----------
+        file_name: str, name or path of the data file.
+        mtime: float or str, modification time or ETag, None if unknown.
+        size: int, size of the file in bytes.
+        region: tuple, requested bounding box or None.
+        station_class: class, Station or CompactStation.
+        """
+        description = repr((
+            os.path.basename(file_name), mtime, size,
+            None if region is None else tuple(region),
+            station_class.__name__
+        ))
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def file_key(cls, file_path, region, station_class):
+        """Create a cache key for a data file on disk."""
+        stat = os.stat(file_path)
+        return cls.key(
+            file_path, stat.st_mtime, stat.st_size, region, station_class)
+
+    def get(self, key):
+        """Return the cached (data_map, parse_stats) tuple or None."""
+        return self._read_entry(key, pickle.load)
+
+    def put(self, key, data_map, parse_stats):
+        """Store a parsed file and evict entries if the cache is full."""
+        self._write_entry(key, lambda fp: pickle.dump(
+            (data_map, parse_stats), fp, protocol=pickle.HIGHEST_PROTOCOL))
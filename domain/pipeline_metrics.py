@@ -0,0 +1,236 @@
+"""Module for collecting performance metrics of the ingestion pipeline."""
+import json
+import logging
+import math
+import os
+import queue
+from collections import defaultdict
+from contextlib import contextmanager
+from time import time
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, math.inf
+)
+
+# Stages with their task counter and unit and their station counter, used
+# to compute rates. Files are written in chunks.
+STAGES = (
+    ('download', 'download.files', 'files', None),
+    ('parse', 'parse.files', 'files', 'parse.stations'),
+    ('write', 'write.chunks', 'chunks', 'write.stations')
+)
+# Caches with their hit and miss counters.
+CACHES = (
+    ('object_cache', 'download.cache_hits', 'download.cache_misses'),
+)
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets, see LATENCY_BUCKETS."""
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for bucket, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                self.counts[bucket] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bucket, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(LATENCY_BUCKETS[bucket], self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count > 0 else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+            'total': self.total
+        }
+
+
+class MetricsRecorder(object):
+    """Metrics of a single worker process.
+
+    Counters and latencies are accumulated locally and sent to the
+    IngestionService through a queue at most every flush_interval seconds,
+    so recording is cheap. Without a queue nothing is sent.
+    """
+
+    def __init__(self, metrics_queue=None, flush_interval=5):
+        self.metrics_queue = metrics_queue
+        self.flush_interval = flush_interval
+        self._last_flush = time()
+        self._reset()
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, seconds):
+        self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Observe the duration of a with block."""
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - start)
+
+    def flush(self, force=False):
+        """Send the metrics recorded since the last flush."""
+        if self.metrics_queue is None or \
+           not force and time() - self._last_flush < self.flush_interval:
+            return
+        if len(self.counters) > 0 or len(self.histograms) > 0:
+            self.metrics_queue.put(
+                (dict(self.counters), dict(self.histograms)))
+        self._reset()
+        self._last_flush = time()
+
+    def _reset(self):
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+
+
+class PipelineMetrics(object):
+    """Metrics of an ingestion run, aggregated over all worker processes.
+
+    Worker metrics are collected from a queue. Queue depths are sampled by
+    the IngestionService. A snapshot is written as json to metrics_path
+    every write_interval seconds and at the end of the run.
+    """
+
+    def __init__(self, metrics_path=None, write_interval=10):
+        """Initialize the metrics of a run.
+
+        parameters
+        ----------
+        metrics_path: str (optional), json file for metric snapshots.
+        write_interval: float (optional), seconds between snapshots.
+        """
+        self.metrics_path = metrics_path
+        self.write_interval = write_interval
+        self.start_time = time()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        # Map from queue names to (last, max, sum, samples) of its depth.
+        self.queues = {}
+        self._last_write = self.start_time
+
+    def collect(self, metrics_queue):
+        """Merge all worker metrics waiting on the queue."""
+        while True:
+            try:
+                counters, histograms = metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            for name, value in counters.items():
+                self.counters[name] += value
+            for name, histogram in histograms.items():
+                self.histograms[name].merge(histogram)
+
+    def sample_queue(self, name, depth):
+        last, maximum, total, samples = self.queues.get(name, (0, 0, 0, 0))
+        self.queues[name] = (
+            depth, max(maximum, depth), total + depth, samples + 1)
+
+    def snapshot(self, final=False):
+        """Dictionary with the current state of all metrics."""
+        elapsed = time() - self.start_time
+        rates = {}
+        for stage, tasks, unit, stations in STAGES:
+            rates[stage] = {
+                unit + '_per_second': self.counters[tasks] / elapsed}
+            if stations is not None:
+                rates[stage]['stations_per_second'] = \
+                    self.counters[stations] / elapsed
+        caches = {}
+        for cache, hits, misses in CACHES:
+            lookups = self.counters[hits] + self.counters[misses]
+            if lookups > 0:
+                caches[cache] = {
+                    'hits': self.counters[hits],
+                    'misses': self.counters[misses],
+                    'hit_ratio': self.counters[hits] / lookups
+                }
+        return {
+            'time': time(),
+            'elapsed': elapsed,
+            'final': final,
+            'counters': dict(self.counters),
+            'rates': rates,
+            'caches': caches,
+            'latency': {
+                name: histogram.summary()
+                for name, histogram in self.histograms.items()
+            },
+            'queues': {
+                name: {'last': last, 'max': maximum,
+                       'mean': total / samples if samples > 0 else 0}
+                for name, (last, maximum, total, samples)
+                in self.queues.items()
+            }
+        }
+
+    def write(self, final=False, force=False):
+        """Atomically write a snapshot, at most every write_interval."""
+        if self.metrics_path is None or \
+           not force and time() - self._last_write < self.write_interval:
+            return
+        temp_path = self.metrics_path + '.tmp'
+        with open(temp_path, "w") as fp:
+            json.dump(self.snapshot(final), fp, indent=2)
+        os.replace(temp_path, self.metrics_path)
+        self._last_write = time()
+
+    def report(self):
+        """Log a summary of the run."""
+        snapshot = self.snapshot(final=True)
+        logging.info("Run report after %.1f s:" % snapshot['elapsed'])
+        for stage, _, unit, _ in STAGES:
+            rates = snapshot['rates'][stage]
+            logging.info("  %s: %.2f %s/s%s" % (
+                stage, rates[unit + '_per_second'], unit,
+                ", %.1f stations/s" % rates['stations_per_second']
+                if 'stations_per_second' in rates else ""))
+        for name, summary in sorted(snapshot['latency'].items()):
+            logging.info(
+                "  %s latency: %d samples, mean %.3f s, p50 %.3f s, "
+                "p95 %.3f s, max %.3f s, total %.1f s" %
+                (name, summary['count'], summary['mean'], summary['p50'],
+                 summary['p95'], summary['max'], summary['total']))
+        for name, cache in sorted(snapshot['caches'].items()):
+            logging.info("  %s: %d hits, %d misses (%.1f%% hit ratio)" %
+                         (name, cache['hits'], cache['misses'],
+                          100 * cache['hit_ratio']))
+        for name, depth in sorted(snapshot['queues'].items()):
+            logging.info("  %s depth: mean %.1f, max %d" %
+                         (name, depth['mean'], depth['max']))
@@ -1,5 +1,9 @@
+import numpy as np
 import pandas as pd
 
+from domain.base import CompactStation
+from domain.station_table import to_datetime64
+
 
 # TODO Really really slow. Works well for large amounts per station.
 def resample_and_interpolate(data_map, resolution=10):
@@ -9,13 +13,16 @@ def resample_and_interpolate(data_map, resolution=10):
             print("%d / %d stations processed.." % (count + 1, len(data_map)))
 
         station = data_map[station_id]
+        if isinstance(station, CompactStation):
+            station = station.to_station()
+            data_map[station_id] = station
 
         if station.thermo_module is not None and \
            type(station.thermo_module) is dict:
             df = pd.DataFrame(station.thermo_module)
             df.set_index('valid_datetime', drop=True, inplace=True)
             interpolation_limit = 3 if resolution <= 20 else 0
-            df = df.resample(str(resolution) + 'T').bfill().interpolate(
+            df = df.resample(str(resolution) + 'min').bfill().interpolate(
                 method='time',
                 limit=interpolation_limit
             )
@@ -23,3 +30,66 @@ def resample_and_interpolate(data_map, resolution=10):
             df = pd.DataFrame()
         station.thermo_module = df
     print("Done.")
+
+
+def resample_and_interpolate_table(table, resolution=10):
+    """Resample and interpolate the thermo data of a StationTable.
+
+    Equivalent to resample_and_interpolate, applied to all stations at once.
+    Returns a single dataframe indexed by station_id and valid_datetime.
+    """
+    step = resolution * 60
+    times = table.thermo['valid_datetime']
+    station = table.thermo_station_index()
+
+    # Sort observations by station and time, so a single search on a
+    # combined key finds observations of all stations at once.
+    order = np.lexsort((times, station))
+    times = times[order]
+    station = station[order]
+    # The origin is rounded down to the step, as the first bins of stations
+    # are, so the keys of a station never overlap those of the previous one.
+    time_origin = times.min() // step * step if len(times) else 0
+    time_span = int(times.max() - time_origin) + 1 if len(times) else 1
+    observation_keys = station * time_span + (times - time_origin)
+
+    # Regular grid per station, from the first to the last bin with data.
+    has_data = np.diff(table.thermo_offsets) > 0
+    rows = np.flatnonzero(has_data)
+    first_bin = times[table.thermo_offsets[rows]] // step * step
+    last_bin = times[table.thermo_offsets[rows + 1] - 1] // step * step
+    bin_counts = (last_bin - first_bin) // step + 1
+    grid_station = np.repeat(rows, bin_counts)
+    grid_start = np.cumsum(bin_counts) - bin_counts
+    grid_times = np.repeat(first_bin, bin_counts) + step * (
+        np.arange(bin_counts.sum()) - np.repeat(grid_start, bin_counts))
+
+    # Backward fill: take the first observation at or after every bin.
+    grid_keys = grid_station * time_span + (grid_times - time_origin)
+    source = order[np.searchsorted(observation_keys, grid_keys)]
+
+    df = pd.DataFrame({
+        column: values[source].astype(np.float64)
+        for column, values in table.thermo.items()
+        if column != 'valid_datetime'
+    })
+    df.index = pd.MultiIndex.from_arrays(
+        [table.station_id[grid_station], to_datetime64(grid_times)],
+        names=['station_id', 'valid_datetime'])
+
+    interpolation_limit = 3 if resolution <= 20 else 0
+    if interpolation_limit == 0:
+        return df
+
+    # Gaps enclosed by data of a single station are interpolated linearly,
+    # which equals time interpolation on the regular grid. Trailing gaps are
+    # padded as pandas does and leading gaps are kept, so no values leak
+    # between stations.
+    valid = df.notna()
+    after_first = valid.groupby(grid_station, sort=False).cummax()
+    before_last = valid[::-1].groupby(
+        grid_station[::-1], sort=False).cummax()[::-1]
+    interpolated = df.interpolate(method='linear', limit=interpolation_limit)
+    padded = df.groupby(grid_station, sort=False).ffill(
+        limit=interpolation_limit)
+    return interpolated.where(before_last, padded).where(after_first)
@@ -0,0 +1,103 @@
+"""Module for passing StationTables between processes in shared memory."""
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from domain.station_table import StationTable, THERMO_COLUMNS, HYDRO_COLUMNS
+
+# Byte alignment of every array in a segment.
+ALIGNMENT = 64
+
+
+class SharedTable(object):
+    """Descriptor of a StationTable stored in a shared memory segment.
+
+    The producer copies all columns of a table into a single segment once.
+    Only this small descriptor is pickled and sent to a consumer, which maps
+    the columns without copying. The consumer unlinks the segment after use,
+    so every descriptor is attached exactly once.
+    """
+
+    def __init__(self, name, layout, station_count):
+        """Initialize a descriptor, see SharedTable.create."""
+        self.name = name
+        # List of (column key, dtype string, shape, byte offset) tuples.
+        self.layout = layout
+        self.station_count = station_count
+
+    def __len__(self):
+        return self.station_count
+
+    @classmethod
+    def create(cls, table):
+        """Copy a StationTable into a new shared memory segment."""
+        arrays = _table_arrays(table)
+        layout = []
+        size = 0
+        for key, array in arrays:
+            size = -(-size // ALIGNMENT) * ALIGNMENT
+            layout.append((key, array.dtype.str, array.shape, size))
+            size += array.nbytes
+
+        segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for (_, dtype, shape, offset), (_, array) in zip(layout, arrays):
+            np.ndarray(shape, dtype, segment.buf, offset)[...] = array
+        segment.close()
+        return cls(segment.name, layout, len(table))
+
+    @contextmanager
+    def attach(self):
+        """Map the segment as a StationTable and unlink it afterwards.
+
+        The table and its arrays must not be used after the with block.
+        """
+        segment = shared_memory.SharedMemory(self.name)
+        try:
+            columns = {
+                key: np.ndarray(shape, dtype, segment.buf, offset)
+                for key, dtype, shape, offset in self.layout
+            }
+            table = StationTable(
+                columns['station_id'].tolist(), columns['latitude'],
+                columns['longitude'], columns['elevation'],
+                {column: columns['thermo.' + column]
+                 for column in THERMO_COLUMNS},
+                columns['thermo_offsets'],
+                {column: columns['hydro.' + column]
+                 for column in HYDRO_COLUMNS},
+                columns['hydro_offsets']
+            )
+            table.alias = columns.get('alias')
+            del columns
+            yield table
+        finally:
+            table = None
+            try:
+                segment.close()
+            except BufferError:
+                # Arrays are still referenced, the mapping is released once
+                # they are garbage collected.
+                pass
+            segment.unlink()
+
+
+def _table_arrays(table):
+    """List (column key, array) tuples of all columns of a table."""
+    arrays = [
+        ('station_id', np.asarray(table.station_id.tolist(), dtype=str)),
+        ('latitude', table.latitude),
+        ('longitude', table.longitude),
+        ('elevation', table.elevation),
+        ('thermo_offsets', table.thermo_offsets),
+        ('hydro_offsets', table.hydro_offsets)
+    ]
+    if table.alias is not None:
+        arrays.append(('alias', np.asarray(table.alias)))
+    arrays.extend(
+        ('thermo.' + column, table.thermo[column])
+        for column in THERMO_COLUMNS)
+    arrays.extend(
+        ('hydro.' + column, table.hydro[column])
+        for column in HYDRO_COLUMNS)
+    return arrays
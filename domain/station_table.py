@@ -0,0 +1,381 @@
+"""Module with a columnar storage of NetAtmo station data."""
+import numpy as np
+
+from domain.base import Station
+
+# Observation columns per module. The first column holds the observation
+# times in UTC epoch seconds, the remaining columns hold values.
+THERMO_COLUMNS = ('valid_datetime', 'temperature', 'humidity', 'pressure')
+HYDRO_COLUMNS = (
+    'time_day_rain', 'time_hour_rain', 'daily_rain_sum', 'hourly_rain_sum')
+TIME_COLUMNS = ('valid_datetime', 'time_day_rain', 'time_hour_rain')
+
+
+class StationTable(object):
+    """Struct-of-arrays storage for a collection of stations.
+
+    Station metadata is stored in arrays with one entry per station.
+    Observations of all stations are stored contiguously per column and
+    grouped by station. The thermo observations of station i are located at
+    thermo_offsets[i]:thermo_offsets[i + 1], likewise for hydro observations.
+    Times are stored as int64 epoch seconds and values as float32.
+    """
+
+    def __init__(self, station_id, latitude, longitude, elevation=None,
+                 thermo=None, thermo_offsets=None, hydro=None,
+                 hydro_offsets=None):
+        """Initialize a table from its columns.
+
+        parameters
+        ----------
+        station_id: array-like, station ids.
+        latitude: array-like, station latitudes.
+        longitude: array-like, station longitudes.
+        elevation: array-like (optional), station elevations, nan if unknown.
+        thermo: dict (optional), mapping of THERMO_COLUMNS to arrays.
+        thermo_offsets: array-like (optional), n + 1 observation offsets.
+        hydro: dict (optional), mapping of HYDRO_COLUMNS to arrays.
+        hydro_offsets: array-like (optional), n + 1 observation offsets.
+        """
+        self.station_id = _object_array(station_id)
+        count = len(self.station_id)
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        if elevation is None:
+            elevation = np.full(count, np.nan)
+        self.elevation = np.asarray(elevation, dtype=np.float64)
+        self.alias = None
+
+        self.thermo = _module_arrays(THERMO_COLUMNS, thermo)
+        self.thermo_offsets = _offsets(thermo_offsets, count)
+        self.hydro = _module_arrays(HYDRO_COLUMNS, hydro)
+        self.hydro_offsets = _offsets(hydro_offsets, count)
+        self._index = None
+
+    def __len__(self):
+        return len(self.station_id)
+
+    @classmethod
+    def from_rows(cls, station_id, latitude, longitude, thermo_station,
+                  thermo, hydro_station, hydro, elevation=None):
+        """Create a table from unordered observation rows.
+
+        Observations are grouped by station, keeping their relative order.
+
+        parameters
+        ----------
+        station_id, latitude, longitude, elevation: see __init__.
+        thermo_station: array-like, station index of every thermo row.
+        thermo: dict, mapping of THERMO_COLUMNS to arrays of rows.
+        hydro_station: array-like, station index of every hydro row.
+        hydro: dict, mapping of HYDRO_COLUMNS to arrays of rows.
+        """
+        count = len(station_id)
+        thermo, thermo_offsets = _group_rows(
+            THERMO_COLUMNS, thermo_station, thermo, count)
+        hydro, hydro_offsets = _group_rows(
+            HYDRO_COLUMNS, hydro_station, hydro, count)
+        return cls(station_id, latitude, longitude, elevation,
+                   thermo, thermo_offsets, hydro, hydro_offsets)
+
+    @classmethod
+    def from_data_map(cls, data_map):
+        """Convert a mapping of station ids to Station objects."""
+        stations = list(data_map.values())
+        thermo_sizes = [
+            len(s.thermo_module['valid_datetime']) for s in stations]
+        hydro_sizes = [
+            len(s.hydro_module['time_hour_rain']) for s in stations]
+        thermo = {
+            column: np.array(
+                [_epoch_seconds(v) if column in TIME_COLUMNS else v
+                 for s in stations for v in s.thermo_module[column]],
+                dtype=_column_dtype(column))
+            for column in THERMO_COLUMNS
+        }
+        hydro = {
+            column: np.array(
+                [_epoch_seconds(v) if column in TIME_COLUMNS else v
+                 for s in stations for v in s.hydro_module[column]],
+                dtype=_column_dtype(column))
+            for column in HYDRO_COLUMNS
+        }
+        return cls(
+            [s.station_id for s in stations],
+            [s.latitude for s in stations],
+            [s.longitude for s in stations],
+            [np.nan if s.elevation is None else s.elevation
+             for s in stations],
+            thermo, _sizes_to_offsets(thermo_sizes),
+            hydro, _sizes_to_offsets(hydro_sizes)
+        )
+
+    def to_data_map(self):
+        """Convert to a mapping of station ids to Station objects."""
+        return {
+            station.station_id: station for station in self.iter_stations()
+        }
+
+    def iter_stations(self):
+        """Iterate over all stations as Station objects.
+
+        Every column is converted to a list once, which is much faster than
+        calling station for every row.
+        """
+        latitude = self.latitude.tolist()
+        longitude = self.longitude.tolist()
+        elevation = self.elevation.tolist()
+        alias = self.alias.tolist() if self.alias is not None else None
+        thermo = _module_lists(self.thermo)
+        thermo_offsets = self.thermo_offsets.tolist()
+        hydro = _module_lists(self.hydro)
+        hydro_offsets = self.hydro_offsets.tolist()
+        for row, station_id in enumerate(self.station_id):
+            station = Station(station_id, latitude[row], longitude[row])
+            if not np.isnan(elevation[row]):
+                station.elevation = elevation[row]
+            if alias is not None:
+                station.alias = int(alias[row])
+            start, end = thermo_offsets[row], thermo_offsets[row + 1]
+            station.thermo_module = {
+                column: values[start:end] for column, values in thermo.items()
+            }
+            start, end = hydro_offsets[row], hydro_offsets[row + 1]
+            station.hydro_module = {
+                column: values[start:end] for column, values in hydro.items()
+            }
+            yield station
+
+    def station(self, row):
+        """Return the station at a row as a Station object."""
+        station = Station(
+            self.station_id[row],
+            float(self.latitude[row]),
+            float(self.longitude[row])
+        )
+        if not np.isnan(self.elevation[row]):
+            station.elevation = float(self.elevation[row])
+        if self.alias is not None:
+            station.alias = int(self.alias[row])
+        start, end = self.thermo_offsets[row], self.thermo_offsets[row + 1]
+        station.thermo_module = _module_lists(self.thermo, start, end)
+        start, end = self.hydro_offsets[row], self.hydro_offsets[row + 1]
+        station.hydro_module = _module_lists(self.hydro, start, end)
+        return station
+
+    def rows(self, station_ids):
+        """Return the rows of station ids, -1 for unknown stations."""
+        if self._index is None:
+            self._index = {
+                station_id: row
+                for row, station_id in enumerate(self.station_id)
+            }
+        return np.array(
+            [self._index.get(station_id, -1) for station_id in station_ids],
+            dtype=np.int64
+        )
+
+    def thermo_station_index(self):
+        """Return the station row of every thermo observation."""
+        return _station_index(self.thermo_offsets)
+
+    def hydro_station_index(self):
+        """Return the station row of every hydro observation."""
+        return _station_index(self.hydro_offsets)
+
+    def take(self, rows):
+        """Return a new table with a subset of stations.
+
+        parameters
+        ----------
+        rows: array-like, station rows or boolean mask.
+        """
+        rows = np.arange(len(self))[np.asarray(rows)]
+        thermo, thermo_offsets = _take_observations(
+            self.thermo, self.thermo_offsets, rows)
+        hydro, hydro_offsets = _take_observations(
+            self.hydro, self.hydro_offsets, rows)
+        table = StationTable(
+            self.station_id[rows], self.latitude[rows], self.longitude[rows],
+            self.elevation[rows],
+            thermo, thermo_offsets, hydro, hydro_offsets)
+        if self.alias is not None:
+            table.alias = self.alias[rows]
+        return table
+
+    def drop_thermo_duplicates(self):
+        """Drop consecutive thermo observations with equal valid datetimes."""
+        times = self.thermo['valid_datetime']
+        station = self.thermo_station_index()
+        keep = np.ones(len(times), dtype=bool)
+        keep[1:] = (times[1:] != times[:-1]) | (station[1:] != station[:-1])
+        self.thermo = {
+            column: values[keep] for column, values in self.thermo.items()}
+        self.thermo_offsets = _sizes_to_offsets(
+            np.bincount(station[keep], minlength=len(self)))
+
+
+def concat_tables(tables, drop_duplicates=False):
+    """Combine tables, merging the observations of equal station ids.
+
+    Station metadata is taken from the first table a station occurs in.
+    Observations are appended in table order.
+
+    parameters
+    ----------
+    tables: list, StationTable objects.
+    drop_duplicates: bool (optional), drop a thermo observation with the
+        same valid datetime as the previous observation of the station, as
+        json_parser.parse_station_thermo_data does.
+    """
+    tables = list(tables)
+    if len(tables) == 0:
+        return StationTable([], [], [])
+
+    station_id = np.concatenate([t.station_id for t in tables])
+    station_rows, first_rows = _first_occurrence(station_id)
+
+    # Translate per-table station rows into rows of the combined table.
+    table_starts = np.cumsum([0] + [len(t) for t in tables])
+    thermo_station = np.concatenate([
+        station_rows[start + t.thermo_station_index()]
+        for start, t in zip(table_starts, tables)
+    ])
+    hydro_station = np.concatenate([
+        station_rows[start + t.hydro_station_index()]
+        for start, t in zip(table_starts, tables)
+    ])
+    thermo = {
+        column: np.concatenate([t.thermo[column] for t in tables])
+        for column in THERMO_COLUMNS
+    }
+    hydro = {
+        column: np.concatenate([t.hydro[column] for t in tables])
+        for column in HYDRO_COLUMNS
+    }
+
+    table = StationTable.from_rows(
+        station_id[first_rows],
+        np.concatenate([t.latitude for t in tables])[first_rows],
+        np.concatenate([t.longitude for t in tables])[first_rows],
+        thermo_station, thermo, hydro_station, hydro,
+        elevation=np.concatenate([t.elevation for t in tables])[first_rows]
+    )
+    if drop_duplicates:
+        table.drop_thermo_duplicates()
+    return table
+
+
+def to_datetime64(epoch_seconds):
+    """Convert epoch seconds to a numpy datetime64 array."""
+    return np.asarray(epoch_seconds, dtype=np.int64).astype('datetime64[s]')
+
+
+def _first_occurrence(station_id):
+    """Return the unique row of every entry, ordered by first occurrence."""
+    if len(station_id) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    _, first_rows, inverse = np.unique(
+        station_id, return_index=True, return_inverse=True)
+    order = np.argsort(first_rows, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.ravel()], first_rows[order]
+
+
+def _group_rows(columns, station, rows, count):
+    station = np.asarray(station, dtype=np.int64)
+    order = np.argsort(station, kind='stable')
+    grouped = {column: np.asarray(rows[column])[order] for column in columns}
+    offsets = _sizes_to_offsets(np.bincount(station, minlength=count))
+    return grouped, offsets
+
+
+def _take_observations(module, offsets, rows):
+    starts = offsets[rows]
+    sizes = offsets[rows + 1] - starts
+    new_offsets = _sizes_to_offsets(sizes)
+    # Index of every selected observation in the original columns.
+    index = np.repeat(starts - new_offsets[:-1], sizes) + \
+        np.arange(new_offsets[-1])
+    return {column: values[index] for column, values in module.items()}, \
+        new_offsets
+
+
+def _station_index(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def _sizes_to_offsets(sizes):
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets
+
+
+def _offsets(offsets, count):
+    if offsets is None:
+        return np.zeros(count + 1, dtype=np.int64)
+    return np.asarray(offsets, dtype=np.int64)
+
+
+def _module_arrays(columns, module):
+    if module is None:
+        module = {}
+    return {
+        column: np.asarray(module.get(column, []),
+                           dtype=_column_dtype(column))
+        for column in columns
+    }
+
+
+def _module_lists(module, start=0, end=None):
+    lists = {}
+    for column, values in module.items():
+        if column in TIME_COLUMNS:
+            lists[column] = to_datetime64(values[start:end]).astype(
+                object).tolist()
+        else:
+            lists[column] = _float32_to_float64(values[start:end]).tolist()
+    return lists
+
+
+def _float32_to_float64(values):
+    """Float64 values of the shortest decimals that round to values.
+
+    A parsed 21.3 is stored as float32 21.299999237..., this recovers 21.3
+    as parsed into a Station. Values are rounded to 7 significant digits,
+    the precision of float32, or to 8 or 9 digits if that does not round to
+    the same float32.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    result = values.astype(np.float64)
+    remaining = np.flatnonzero(np.isfinite(values) & (values != 0))
+    for digits in (7, 8, 9):
+        rounded = _round_significant(result[remaining], digits)
+        exact = rounded.astype(np.float32) == values[remaining]
+        result[remaining[exact]] = rounded[exact]
+        remaining = remaining[~exact]
+    return result
+
+
+def _round_significant(values, digits):
+    exponent = digits - 1 - np.floor(np.log10(np.abs(values)))
+    scale = 10.0 ** np.abs(exponent)
+    # Powers of ten are exact, their reciprocals are not.
+    return np.where(exponent >= 0, np.round(values * scale) / scale,
+                    np.round(values / scale) * scale)
+
+
+def _column_dtype(column):
+    return np.int64 if column in TIME_COLUMNS else np.float32
+
+
+def _epoch_seconds(timestamp):
+    return int((np.datetime64(timestamp, 's') -
+                np.datetime64(0, 's')).astype(np.int64))
+
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = list(values)
+    return array
@@ -0,0 +1,167 @@
+"""Spatial index for radius and nearest neighbour searches over stations."""
+import numpy as np
+
+from domain.station_table import StationTable
+from helpers.utils import distance_to_many
+
+R = 6371000  # Radius of the earth in meters
+
+
+class StationIndex(object):
+    """Grid bucket index over station coordinates on the unit sphere.
+
+    Stations are converted to 3d unit vectors and bucketed in a regular grid
+    of cubes. A search only inspects stations in the cubes around a query
+    point. Candidates are checked with helpers.utils.distance_to_many, so
+    results equal those of select_near.
+    """
+
+    def __init__(self, data_map, cell_size=10000):
+        """Build an index.
+
+        parameters
+        ----------
+        data_map: dict, list or StationTable, collection of stations.
+        cell_size: float (optional), edge of a grid cube in meters.
+        """
+        self.data_map = data_map
+        if isinstance(data_map, StationTable):
+            self.keys = None
+            latitudes, longitudes = data_map.latitude, data_map.longitude
+        else:
+            if isinstance(data_map, dict):
+                self.keys = list(data_map.keys())
+                stations = [data_map[key] for key in self.keys]
+            else:
+                self.keys = None
+                stations = list(data_map)
+            latitudes = [station.latitude for station in stations]
+            longitudes = [station.longitude for station in stations]
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+
+        self.cell_size = cell_size / R
+        self._cells_per_axis = int(np.ceil(2 / self.cell_size)) + 1
+        self._xyz = _unit_vectors(self.latitudes, self.longitudes)
+
+        keys = self._cell_keys(self._cell_coordinates(self._xyz))
+        self._order = np.argsort(keys, kind='stable')
+        self._cell_key, self._cell_start = np.unique(
+            keys[self._order], return_index=True)
+        self._cell_end = np.append(self._cell_start[1:], len(keys))
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def query_radius(self, latitude, longitude, radius=5000):
+        """Rows of stations within radius meters of a point, in order."""
+        candidates = np.sort(self._candidates(latitude, longitude, radius + 1))
+        distances = distance_to_many(
+            latitude, longitude,
+            self.latitudes[candidates], self.longitudes[candidates])
+        return candidates[distances <= radius]
+
+    def query_radius_batch(self, latitudes, longitudes, radius=5000):
+        """List of query_radius results for a batch of points."""
+        return [
+            self.query_radius(latitude, longitude, radius)
+            for latitude, longitude in zip(latitudes, longitudes)
+        ]
+
+    def query_nearest(self, latitude, longitude, k=1):
+        """Rows and distances of the k nearest stations, nearest first.
+
+        Distances are in whole meters as computed by distance_to_many.
+        """
+        k = min(k, len(self))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        point = _unit_vectors(np.array([latitude]), np.array([longitude]))[0]
+        reach = 1
+        while True:
+            rows = self._cells_around(point, reach)
+            if len(rows) >= k:
+                chords = np.linalg.norm(self._xyz[rows] - point, axis=1)
+                order = np.argsort(chords, kind='stable')[:k]
+                # Stations outside the searched cubes are at least reach
+                # cubes away, so the result is final if it is within that.
+                if len(rows) == len(self) or \
+                   chords[order[-1]] <= reach * self.cell_size:
+                    nearest = rows[order]
+                    break
+            reach *= 2
+
+        distances = distance_to_many(
+            latitude, longitude,
+            self.latitudes[nearest], self.longitudes[nearest])
+        order = np.argsort(distances, kind='stable')
+        return nearest[order], distances[order]
+
+    def query_nearest_batch(self, latitudes, longitudes, k=1):
+        """List of query_nearest results for a batch of points."""
+        return [
+            self.query_nearest(latitude, longitude, k)
+            for latitude, longitude in zip(latitudes, longitudes)
+        ]
+
+    def select_near(self, latitude, longitude, radius=5000):
+        """Equivalent of helpers.utils.select_near on the indexed stations."""
+        rows = self.query_radius(latitude, longitude, radius)
+        if isinstance(self.data_map, StationTable):
+            return self.data_map.take(rows)
+        elif self.keys is not None:
+            return {self.keys[row]: self.data_map[self.keys[row]]
+                    for row in rows}
+        else:
+            return [self.data_map[row] for row in rows]
+
+    def _candidates(self, latitude, longitude, radius):
+        """Rows of stations within a chord distance matching radius."""
+        point = _unit_vectors(np.array([latitude]), np.array([longitude]))[0]
+        chord = 2 * np.sin(min(radius / (2 * R), np.pi / 2))
+        reach = int(np.ceil(chord / self.cell_size))
+        rows = self._cells_around(point, reach)
+        chords = np.linalg.norm(self._xyz[rows] - point, axis=1)
+        # Small tolerance for floating point differences with haversine.
+        return rows[chords <= chord * (1 + 1e-9)]
+
+    def _cells_around(self, point, reach):
+        """Rows of stations in all cubes within reach cubes of point."""
+        if (2 * reach + 1) ** 3 >= len(self._cell_key):
+            # Cheaper to inspect all stations than all surrounding cubes.
+            return np.arange(len(self))
+
+        center = self._cell_coordinates(point[np.newaxis, :])[0]
+        steps = np.arange(-reach, reach + 1)
+        neighbours = np.stack(np.meshgrid(steps, steps, steps), axis=-1)
+        cells = center + neighbours.reshape(-1, 3)
+        valid = np.all((cells >= 0) & (cells < self._cells_per_axis), axis=1)
+        keys = self._cell_keys(cells[valid])
+
+        positions = np.minimum(
+            np.searchsorted(self._cell_key, keys), len(self._cell_key) - 1)
+        positions = positions[self._cell_key[positions] == keys]
+        if len(positions) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([
+            self._order[self._cell_start[p]:self._cell_end[p]]
+            for p in positions
+        ])
+
+    def _cell_coordinates(self, xyz):
+        return np.floor((xyz + 1) / self.cell_size).astype(np.int64)
+
+    def _cell_keys(self, cells):
+        n = self._cells_per_axis
+        return (cells[:, 0] * n + cells[:, 1]) * n + cells[:, 2]
+
+
+def _unit_vectors(latitudes, longitudes):
+    phi = np.radians(latitudes)
+    lam = np.radians(longitudes)
+    return np.column_stack((
+        np.cos(phi) * np.cos(lam),
+        np.cos(phi) * np.sin(lam),
+        np.sin(phi)
+    ))
@@ -7,19 +7,136 @@ from math import (
     sqrt
 )
 
+import numpy as np
+
+from domain.station_table import StationTable
+
+
+def add_alias(data_map, curve=None):
+    """Add an alias station_id to every Station object.
+
+    parameters
+    ----------
+    data_map: dict or StationTable, mapping of station id to Station objects.
+    curve: str (optional), 'hilbert' or 'zorder' to hand out aliases along
+        a space-filling curve, so nearby stations get nearby aliases. By
+        default aliases follow the order of data_map.
+    """
+    if curve is None:
+        aliases = np.arange(1, len(data_map) + 1)
+    else:
+        latitudes, longitudes = _coordinate_arrays(data_map)
+        aliases = np.empty(len(data_map), dtype=np.int64)
+        aliases[spatial_order(latitudes, longitudes, curve)] = \
+            np.arange(1, len(data_map) + 1)
+
+    if isinstance(data_map, StationTable):
+        data_map.alias = aliases
+        return
+
+    for station_id, alias_id in zip(data_map, aliases):
+        data_map[station_id].alias = int(alias_id)
+
+
+def spatial_order(latitudes, longitudes, curve='hilbert', bits=16):
+    """Order of coordinates along a space-filling curve.
+
+    parameters
+    ----------
+    latitudes: array-like, latitudes in degrees.
+    longitudes: array-like, longitudes in degrees.
+    curve: str (optional), 'hilbert' or 'zorder'.
+    bits: int (optional), resolution of the curve per axis.
+
+    returns
+    -------
+    numpy array, permutation that sorts the coordinates along the curve.
+    """
+    cells = (1 << bits) - 1
+    x = np.round((np.asarray(longitudes, dtype=np.float64) + 180) / 360 *
+                 cells).astype(np.int64)
+    y = np.round((np.asarray(latitudes, dtype=np.float64) + 90) / 180 *
+                 cells).astype(np.int64)
+    x = np.clip(x, 0, cells)
+    y = np.clip(y, 0, cells)
+
+    if curve == 'hilbert':
+        key = _hilbert_key(x, y, bits)
+    elif curve == 'zorder':
+        key = _zorder_key(x, y, bits)
+    else:
+        raise ValueError("Unknown space-filling curve '%s'." % curve)
+    return np.argsort(key, kind='stable')
+
+
+def sort_by_location(data_map, curve='hilbert'):
+    """Reorder stations along a space-filling curve.
+
+    Returns a new dict, list or StationTable in which nearby stations are
+    adjacent.
+    """
+    latitudes, longitudes = _coordinate_arrays(data_map)
+    order = spatial_order(latitudes, longitudes, curve)
+    if isinstance(data_map, StationTable):
+        return data_map.take(order)
+    elif isinstance(data_map, dict):
+        keys = list(data_map.keys())
+        return {keys[row]: data_map[keys[row]] for row in order}
+    stations = list(data_map)
+    return [stations[row] for row in order]
+
+
+def _coordinate_arrays(data_map):
+    """Latitude and longitude arrays of a dict, list or StationTable."""
+    if isinstance(data_map, StationTable):
+        return data_map.latitude, data_map.longitude
+    stations = list(data_map.values()) \
+        if isinstance(data_map, dict) else list(data_map)
+    return (
+        np.array([station.latitude for station in stations], dtype=float),
+        np.array([station.longitude for station in stations], dtype=float)
+    )
 
-def add_alias(data_map):
-    """Add an alias station_id to every Station object."""
-    # TODO TdR 28-4-2016 Closeby stations should have closeby aliases.
-    alias_id = 1
-    for station_id in data_map:
-        station = data_map[station_id]
-        station.alias = alias_id
-        alias_id += 1
+
+def _hilbert_key(x, y, bits):
+    """Position on a Hilbert curve of integer grid coordinates."""
+    n = 1 << bits
+    x = x.copy()
+    y = y.copy()
+    key = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        key += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant.
+        flip = (ry == 0) & (rx == 1)
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ry == 0
+        x[swap], y[swap] = y[swap], x[swap]
+        s >>= 1
+    return key
+
+
+def _zorder_key(x, y, bits):
+    """Position on a Z-order curve of integer grid coordinates."""
+    key = np.zeros(len(x), dtype=np.int64)
+    for bit in range(bits):
+        key |= ((x >> bit) & 1) << (2 * bit)
+        key |= ((y >> bit) & 1) << (2 * bit + 1)
+    return key
 
 
 def get_station_coordinates(data_map):
     """Return station coordinates for every station in data_map."""
+    if isinstance(data_map, StationTable):
+        return np.column_stack((
+            data_map.latitude.astype(object),
+            data_map.longitude.astype(object),
+            data_map.station_id
+        )).tolist()
+
     station_coords = []
     for station_id in data_map:
         station = data_map[station_id]
@@ -29,6 +146,13 @@ def get_station_coordinates(data_map):
 
 
 def add_station_elevations(data_map, station_ids, elevations):
+    if isinstance(data_map, StationTable):
+        rows = data_map.rows(station_ids)
+        elevations = np.array(elevations, dtype=np.float64)
+        known = rows >= 0
+        data_map.elevation[rows[known]] = elevations[known]
+        return
+
     for count, station_id in enumerate(station_ids):
         if station_id not in data_map:
             continue
@@ -63,35 +187,110 @@ def _distance(point1, point2):
     return int(round(d))
 
 
-def select_near(data_map, latitude, longitude, radius=5000):
+def haversine(latitudes_1, longitudes_1, latitudes_2, longitudes_2):
+    """Vectorized haversine distance in meters, see _distance.
+
+    Arguments are scalars or arrays of degrees and are broadcast against
+    each other. Distances are not rounded.
+    """
+    R = 6371000  # Radius of the earth in meters
+
+    phi_1 = np.radians(latitudes_1)
+    phi_2 = np.radians(latitudes_2)
+    delta_phi = np.radians(np.subtract(latitudes_2, latitudes_1))
+    delta_lambda = np.radians(np.subtract(longitudes_2, longitudes_1))
+
+    a = np.sin(delta_phi / 2) ** 2 + \
+        np.cos(phi_1) * np.cos(phi_2) * np.sin(delta_lambda / 2) ** 2
+
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+
+def distance_to_many(latitude, longitude, latitudes, longitudes):
+    """Distances in whole meters from a point to arrays of coordinates."""
+    return np.round(
+        haversine(latitudes, longitudes, latitude, longitude)
+    ).astype(np.int64)
+
+
+def iter_distance_matrix(latitudes_1, longitudes_1, latitudes_2,
+                         longitudes_2, chunk_size=1024):
+    """Yield the rows of a distance matrix in chunks.
+
+    Only a chunk_size x M block is computed at a time, so memory stays
+    bounded for large N x M.
+
+    returns
+    -------
+    generator of (start row, block of distances in whole meters) tuples.
+    """
+    latitudes_1 = np.asarray(latitudes_1, dtype=np.float64)
+    longitudes_1 = np.asarray(longitudes_1, dtype=np.float64)
+    latitudes_2 = np.asarray(latitudes_2, dtype=np.float64)[np.newaxis, :]
+    longitudes_2 = np.asarray(longitudes_2, dtype=np.float64)[np.newaxis, :]
+    for start in range(0, len(latitudes_1), chunk_size):
+        end = start + chunk_size
+        block = haversine(
+            latitudes_1[start:end, np.newaxis],
+            longitudes_1[start:end, np.newaxis],
+            latitudes_2, longitudes_2)
+        yield start, np.round(block).astype(np.int64)
+
+
+def distance_matrix(latitudes_1, longitudes_1, latitudes_2, longitudes_2,
+                    chunk_size=1024):
+    """N x M matrix of distances in whole meters between two sets."""
+    matrix = np.empty((len(latitudes_1), len(latitudes_2)), dtype=np.int64)
+    for start, block in iter_distance_matrix(
+            latitudes_1, longitudes_1, latitudes_2, longitudes_2,
+            chunk_size):
+        matrix[start:start + len(block)] = block
+    return matrix
+
+
+def pairwise_distances(latitudes, longitudes, chunk_size=1024):
+    """N x N matrix of distances in whole meters within a set."""
+    return distance_matrix(
+        latitudes, longitudes, latitudes, longitudes, chunk_size)
+
+
+def select_near(data_map, latitude, longitude, radius=5000, index=None):
     """Filter data_map by selecting a region of interest.
 
     parameters
     ----------
-    data_map: dict or list, mapping of station id to Station objects.
+    data_map: dict, list or StationTable, mapping of station id to Station
+        objects.
     latitude: float, latitude of interest.
     longitude: float, longitude of interest.
     radius: float (optional), maximum search radius in meters.
+    index: StationIndex (optional), spatial index built over data_map.
     """
 
+    if index is not None:
+        return index.select_near(latitude, longitude, radius)
+
+    if isinstance(data_map, StationTable):
+        station_dist = distance_to_many(
+            latitude, longitude, data_map.latitude, data_map.longitude)
+        return data_map.take(station_dist <= radius)
+
+    stations = list(data_map.values()) \
+        if isinstance(data_map, dict) else list(data_map)
+    station_dist = distance_to_many(
+        latitude, longitude,
+        [station.latitude for station in stations],
+        [station.longitude for station in stations]
+    )
     if isinstance(data_map, dict):
-        filtered_map = {}
-        for station_id in data_map:
-            station = data_map[station_id]
-            station_dist = _distance(
-                (station.latitude, station.longitude),
-                (latitude, longitude)
-            )
-            if station_dist <= radius:
-                filtered_map[station_id] = station
-        return filtered_map
-    else:
-        filtered_map = []
-        for station in data_map:
-            station_dist = _distance(
-                (station.latitude, station.longitude),
-                (latitude, longitude)
-            )
-            if station_dist <= radius:
-                filtered_map.append(station)
-        return filtered_map
+        return {
+            station_id: station
+            for station_id, station, dist in
+            zip(data_map.keys(), stations, station_dist)
+            if dist <= radius
+        }
+    return [
+        station for station, dist in zip(stations, station_dist)
+        if dist <= radius
+    ]
@@ -3,6 +3,7 @@ from time import time
 from datetime import datetime
 from domain.base import DataRequest
 from domain.ingestion_service import IngestionService
+from domain.ingestion_ledger import IngestionLedger
 
 if __name__ == "__main__":
     logging.basicConfig(
@@ -19,6 +20,8 @@ if __name__ == "__main__":
     test_request.time_resolution = 10
     test_request.region = (53.680, 2.865, 50.740, 7.323)  # The Netherlands
     main_thread = IngestionService()
+    # Rerunning after an interruption resumes the unfinished files.
+    main_thread.ledger = IngestionLedger('ingestion_ledger.sqlite')
     main_thread.run(test_request)
     program_end = time()
 
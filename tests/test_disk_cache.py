@@ -0,0 +1,63 @@
+import os
+
+from domain import disk_cache
+from domain.object_cache import S3ObjectCache
+
+
+def _put(cache, index, size=100):
+    cache.put('bucket', 'data/%d' % index, '"etag"', b'x' * size)
+
+
+def _cached(cache, count):
+    return [index for index in range(count)
+            if cache.get('bucket', 'data/%d' % index, '"etag"') is not None]
+
+
+def _total_bytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for name in os.listdir(directory))
+
+
+def test_evicts_least_recently_used_down_to_low_water(tmp_path):
+    cache = S3ObjectCache(str(tmp_path), max_bytes=1000)
+    for index in range(10):
+        _put(cache, index)
+        # Entries written in the same clock tick have the same mtime.
+        os.utime(cache._entry_path(cache.key(
+            'bucket', 'data/%d' % index, '"etag"')), (index, index))
+
+    _put(cache, 10)
+
+    assert _total_bytes(str(tmp_path)) == 800
+    assert _cached(cache, 11) == [3, 4, 5, 6, 7, 8, 9, 10]
+
+
+def test_scans_only_when_full(tmp_path, monkeypatch):
+    scans = []
+    listdir = os.listdir
+
+    def counting_listdir(path):
+        scans.append(path)
+        return listdir(path)
+
+    monkeypatch.setattr(disk_cache.os, 'listdir', counting_listdir)
+    cache = S3ObjectCache(str(tmp_path), max_bytes=1000)
+
+    for index in range(50):
+        _put(cache, index)
+
+    # A scan on the first put and on every put that overfills the cache.
+    # Eviction to 800 bytes leaves room for two more entries, so from the
+    # eleventh put on every third put scans.
+    assert len(scans) == 1 + len(range(11, 51, 3))
+    assert _total_bytes(str(tmp_path)) <= 1000
+
+
+def test_replaced_entry_is_not_counted_twice(tmp_path):
+    cache = S3ObjectCache(str(tmp_path), max_bytes=1000)
+
+    for _ in range(20):
+        _put(cache, 0, 600)
+
+    assert _cached(cache, 1) == [0]
+    assert cache._total_bytes == 600
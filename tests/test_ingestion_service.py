@@ -0,0 +1,216 @@
+import gzip
+import json
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_snapshots import SnapshotConfig, snapshot_records
+from domain.aws_engine import StreamBuffer
+from domain.ingestion_ledger import IngestionLedger
+from domain.ingestion_service import (
+    _bucket_files, _chunk_bounds, _iter_chunks, _json_to_station_objects,
+    _json_to_station_table, _station_bytes)
+from domain.json_parser import parse_stations
+from domain.parse_cache import ParseCache
+from domain.station_table import StationTable
+
+
+@pytest.fixture(scope='module')
+def data_map():
+    config = SnapshotConfig()
+    config.station_count = 300
+    data_map = {}
+    for _, records in snapshot_records(datetime(2016, 5, 1), 6, config):
+        parse_stations(records, data_map)
+    return data_map
+
+
+def _snapshot(temperature):
+    """Uncompressed gzip contents, whose size does not depend on values."""
+    records = [{
+        '_id': 'station', 'location': [5.2, 52.1], 'altitude': 3,
+        'data': {'time_utc': 1462060800, 'Temperature': temperature,
+                 'Humidity': 50, 'Pressure': 1013.0}
+    }]
+    return gzip.compress(
+        json.dumps(records).encode('utf-8'), compresslevel=0, mtime=0)
+
+
+def _streamed(contents, etag):
+    buffer = StreamBuffer('data/netatmo_20160501_0010.json.gz')
+    buffer._start(len(contents), etag)
+    buffer._append(contents)
+    buffer._finish()
+    return buffer
+
+
+def _temperatures(parsed):
+    if isinstance(parsed, StationTable):
+        return parsed.thermo['temperature'].tolist()
+    return list(parsed['station'].thermo_module['temperature'])
+
+
+@pytest.mark.parametrize('stream', [False, True])
+@pytest.mark.parametrize(
+    'parse', [_json_to_station_objects, _json_to_station_table])
+def test_parse_cache_misses_changed_object_of_same_size(
+        tmp_path, stream, parse):
+    parse_cache = ParseCache(str(tmp_path))
+    old, new = _snapshot(10.0), _snapshot(20.0)
+    assert len(old) == len(new)
+
+    def parse_object(contents, etag):
+        # A streamed object carries its ETag, downloaded bytes come with it.
+        if stream:
+            contents, etag = _streamed(contents, etag), None
+        return parse(contents, None, 'netatmo_20160501_0010.json.gz',
+                     parse_cache, etag=etag)
+
+    parse_object(old, '"old"')
+    parsed = parse_object(new, '"new"')
+
+    assert _temperatures(parsed) == [20.0]
+    assert (parse_cache.hits, parse_cache.misses) == (0, 2)
+    assert _temperatures(parse_object(new, '"new"')) == [20.0]
+    assert parse_cache.hits == 1
+
+
+def _file_names(*times):
+    return ['netatmo_20160501_%s.json.gz' % time for time in times]
+
+
+def _write_buckets(ledger, file_names, time_bucket='hour', chunks=(0, 1)):
+    """Bucket the unwritten files and write chunks of 2 of every bucket."""
+    file_names = ledger.queue(file_names)
+    buckets = _bucket_files(
+        file_names, time_bucket, ledger.unfinished_buckets(file_names))
+    for bucket in buckets:
+        ledger.queue_bucket(bucket.name, bucket.file_names)
+        ledger.mark_parsed(bucket.name, 2, 100)
+        for chunk_index in chunks:
+            ledger.mark_chunk_written(bucket.name, chunk_index)
+    return buckets
+
+
+def test_bucket_files_per_span():
+    file_names = _file_names('0150', '0110', '0100', '0200', '0210')
+
+    hours = _bucket_files(file_names, 'hour')
+    days = _bucket_files(file_names, 'day')
+
+    # A file on the hour belongs to the previous hour.
+    assert [(b.name, b.file_names, b.key) for b in hours] == [
+        ('hour_20160501_0100', _file_names('0100'), ('20160501', 0)),
+        ('hour_20160501_0110', _file_names('0110', '0150', '0200'),
+         ('20160501', 1)),
+        ('hour_20160501_0210', _file_names('0210'), ('20160501', 2))]
+    assert [(b.name, b.file_names, b.key) for b in days] == [
+        ('day_20160501_0100', sorted(file_names), ('20160501', None))]
+
+
+def test_bucket_files_unknown_span():
+    with pytest.raises(ValueError):
+        _bucket_files(_file_names('0110'), 'week')
+
+
+def test_late_files_are_bucketed_alone(tmp_path):
+    ledger = IngestionLedger(str(tmp_path / 'ledger.sqlite'))
+    _write_buckets(ledger, _file_names('0110', '0130', '0150'))
+
+    buckets = _write_buckets(
+        ledger, _file_names('0110', '0120', '0130', '0150'))
+
+    # Only the late file is written again, in a bucket of the same hour.
+    assert [(b.name, b.file_names, b.key) for b in buckets] == [
+        ('hour_20160501_0120', _file_names('0120'), ('20160501', 1))]
+    assert ledger.queue(_file_names('0110', '0120', '0130', '0150')) == []
+
+
+def test_interrupted_bucket_is_resumed(tmp_path):
+    ledger = IngestionLedger(str(tmp_path / 'ledger.sqlite'))
+    _write_buckets(ledger, _file_names('0110', '0130'), chunks=(0,))
+    ledger.drop_from_bucket('hour_20160501_0110', _file_names('0130')[0])
+
+    file_names = ledger.queue(_file_names('0110', '0120', '0130'))
+    buckets = _bucket_files(
+        file_names, 'hour', ledger.unfinished_buckets(file_names))
+
+    # The interrupted bucket keeps its files and chunks, the late file and
+    # the file that was skipped in it form a new bucket.
+    assert [(b.name, b.file_names) for b in buckets] == [
+        ('hour_20160501_0110', _file_names('0110')),
+        ('hour_20160501_0120', _file_names('0120', '0130'))]
+    assert ledger.written_chunks('hour_20160501_0110') == {0}
+    assert ledger.mark_chunk_written('hour_20160501_0110', 1)
+    assert ledger.queue(_file_names('0110', '0120', '0130')) == \
+        _file_names('0120', '0130')
+
+
+def test_chunk_bounds_empty():
+    assert _chunk_bounds(np.array([], dtype=np.int64), 100) == []
+
+
+def test_chunk_bounds_single_station():
+    assert _chunk_bounds(np.array([40]), 100) == [(0, 1)]
+
+
+def test_chunk_bounds_oversized_station_gets_own_chunk():
+    bounds = _chunk_bounds(np.array([30, 250, 30, 30, 500]), 100)
+
+    assert bounds == [(0, 1), (1, 2), (2, 4), (4, 5)]
+
+
+def test_chunk_bounds_uneven_sizes_within_bound():
+    station_bytes = np.random.default_rng(0).integers(1, 400, size=1000)
+    max_bytes = 1000
+
+    bounds = _chunk_bounds(station_bytes, max_bytes)
+
+    # Chunks cover all stations in order.
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(station_bytes)
+    assert all(end == start for (_, end), (start, _) in
+               zip(bounds, bounds[1:]))
+    for start, end in bounds:
+        assert station_bytes[start:end].sum() <= max_bytes
+        # Greedy: the next station would not have fit.
+        if end < len(station_bytes):
+            assert station_bytes[start:end + 1].sum() > max_bytes
+
+
+def test_iter_chunks_dictionary(data_map):
+    station_bytes = _station_bytes(data_map)
+    bounds = _chunk_bounds(station_bytes, station_bytes.sum() // 7)
+    station_ids = list(data_map)
+
+    chunks = list(_iter_chunks(data_map, bounds))
+
+    assert len(chunks) == len(bounds)
+    for (start, end), chunk in zip(bounds, chunks):
+        assert list(chunk) == station_ids[start:end]
+        assert all(chunk[station_id] is data_map[station_id]
+                   for station_id in chunk)
+
+
+def test_iter_chunks_table(data_map):
+    table = StationTable.from_data_map(data_map)
+    station_bytes = _station_bytes(table)
+    bounds = _chunk_bounds(station_bytes, station_bytes.sum() // 7)
+
+    chunks = list(_iter_chunks(table, bounds))
+
+    assert len(chunks) == len(bounds)
+    for (start, end), chunk in zip(bounds, chunks):
+        assert chunk.station_id.tolist() == \
+            table.station_id[start:end].tolist()
+        # Rows are consecutive, so are their observations.
+        for module, offsets, chunk_module, chunk_offsets in (
+                (table.thermo, table.thermo_offsets, chunk.thermo,
+                 chunk.thermo_offsets),
+                (table.hydro, table.hydro_offsets, chunk.hydro,
+                 chunk.hydro_offsets)):
+            np.testing.assert_array_equal(
+                chunk_offsets, offsets[start:end + 1] - offsets[start])
+            for column, values in chunk_module.items():
+                np.testing.assert_array_equal(
+                    values, module[column][offsets[start]:offsets[end]])
@@ -0,0 +1,144 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_snapshots import SnapshotConfig, snapshot_records
+from domain.base import DataRequest, unpack_binaries
+from domain.json_parser import parse_stations
+from domain.mongodb_engine import (
+    MongoDBConnector, _documents_to_table, _epoch_or_none, _get_primary_key,
+    _to_bson_binary)
+from domain.station_table import concat_tables
+
+START = datetime(2016, 5, 1)
+
+
+class _Cursor(object):
+    """Cursor over documents in a fixed order, sorted as MongoDB does."""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, keys):
+        def sort_key(document):
+            # Null sorts before numbers.
+            values = [_field(document, key) for key, _ in keys]
+            return [(value is not None, value) for value in values]
+        self.documents = sorted(self.documents, key=sort_key)
+        return self
+
+    def __iter__(self):
+        # Like a MongoDB cursor, documents are iterated once.
+        self.documents = iter(self.documents)
+        return self.documents
+
+
+class _Collection(object):
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query, projection, batch_size=None):
+        return _Cursor(self.documents)
+
+
+class _Database(object):
+    def __init__(self, documents):
+        self.stations = _Collection(documents)
+
+
+def _field(document, key):
+    for part in key.split('.'):
+        document = document[part]
+    return document
+
+
+def _documents(binary):
+    """Station documents of snapshots over three days, newest first."""
+    config = SnapshotConfig()
+    config.station_count = 50
+    documents = []
+    for _, records in snapshot_records(START, 8, config, 8 * 60):
+        data_map = {}
+        parse_stations(records, data_map)
+        for station in data_map.values():
+            if len(station.thermo_module['valid_datetime']) == 0:
+                continue
+            document = {
+                '_id': _get_primary_key(station),
+                'station_id': station.station_id,
+                'latitude': station.latitude,
+                'longitude': station.longitude,
+                'elevation': station.elevation
+            }
+            if binary:
+                document['series'] = [_to_bson_binary(station)]
+            else:
+                document['thermo_module'] = station.thermo_module
+                document['hydro_module'] = station.hydro_module
+            documents.append(document)
+    # The filter branches of a query return the first and last day before
+    # the days in between.
+    return documents[::-1]
+
+
+def _thermo_times(documents, start=None, end=None):
+    """Sorted thermo epochs per station in documents."""
+    times = {}
+    for document in documents:
+        station_times = times.setdefault(document['station_id'], [])
+        if 'series' in document:
+            epochs = [int(t) for t in _unpacked_times(document)]
+        else:
+            epochs = [_epoch_or_none(t) for t in
+                      document['thermo_module']['valid_datetime']]
+        station_times.extend(
+            t for t in epochs if (start is None or t >= start) and
+            (end is None or t <= end))
+    return {station_id: sorted(station_times)
+            for station_id, station_times in times.items()
+            if len(station_times) > 0}
+
+
+def _unpacked_times(document):
+    thermo, _, _, _ = unpack_binaries(document['series'])
+    return thermo['valid_datetime']
+
+
+def _table_times(table):
+    offsets = table.thermo_offsets
+    times = table.thermo['valid_datetime']
+    return {
+        station_id: times[offsets[row]:offsets[row + 1]].tolist()
+        for row, station_id in enumerate(table.station_id)
+        if offsets[row + 1] > offsets[row]
+    }
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_documents_to_table_sorts_observations(binary):
+    documents = _documents(binary)
+
+    table = _documents_to_table(documents)
+
+    assert _table_times(table) == _thermo_times(documents)
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_query_spanning_several_days(binary):
+    documents = _documents(binary)
+    connector = MongoDBConnector.__new__(MongoDBConnector)
+    connector.db = _Database(documents)
+    connector._indexed = True
+    request = DataRequest()
+    request.start_datetime = datetime(2016, 5, 1, 3)
+    request.end_datetime = datetime(2016, 5, 3, 10)
+
+    table = concat_tables(connector.query(request, batch_size=40))
+
+    expected = _thermo_times(
+        documents, _epoch_or_none(request.start_datetime),
+        _epoch_or_none(request.end_datetime))
+    actual = _table_times(table)
+    assert actual == expected
+    assert all(np.all(np.diff(times) >= 0) for times in actual.values())
@@ -0,0 +1,77 @@
+import copy
+import contextlib
+import io
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.synthetic_snapshots import SnapshotConfig, snapshot_records
+from domain.json_parser import parse_stations
+from domain.preprocessing import (
+    resample_and_interpolate, resample_and_interpolate_table)
+from domain.station_table import StationTable
+
+
+def _record(station_id, time_utc, temperature):
+    return {
+        '_id': station_id,
+        'location': [5.2, 52.1],
+        'altitude': 3,
+        'data': {'time_utc': time_utc, 'Temperature': temperature,
+                 'Humidity': 50, 'Pressure': 1013.0}
+    }
+
+
+def _epoch(*args):
+    return int((datetime(*args) - datetime(1970, 1, 1)).total_seconds())
+
+
+def _assert_parity(data_map, resolution):
+    """Compare the table version with resample_and_interpolate."""
+    table = StationTable.from_data_map(data_map)
+    expected = copy.deepcopy(data_map)
+    with contextlib.redirect_stdout(io.StringIO()):
+        resample_and_interpolate(expected, resolution)
+    result = resample_and_interpolate_table(table, resolution)
+
+    for station_id, station in expected.items():
+        frame = station.thermo_module
+        actual = result.loc[station_id]
+        np.testing.assert_array_equal(
+            actual.index.values, frame.index.values.astype(
+                actual.index.values.dtype), err_msg=station_id)
+        for column in frame.columns:
+            np.testing.assert_allclose(
+                actual[column].values, frame[column].values.astype(float),
+                rtol=1e-6, atol=1e-4, equal_nan=True, err_msg=station_id)
+
+
+def test_stations_do_not_share_observations():
+    # The earliest observation is not on a bin boundary and belongs to the
+    # second station, whose first bin comes before it.
+    data_map = {}
+    parse_stations([_record('a', _epoch(2016, 5, 1, 0, 7), 10.0)], data_map)
+    parse_stations([_record('b', _epoch(2016, 5, 1, 0, 5), 20.0)], data_map)
+    parse_stations([_record('a', _epoch(2016, 5, 1, 0, 17), 11.0),
+                    _record('b', _epoch(2016, 5, 1, 0, 15), 21.0)], data_map)
+
+    result = resample_and_interpolate_table(
+        StationTable.from_data_map(data_map))
+
+    assert result.loc['b']['temperature'].tolist() == [20.0, 21.0]
+    _assert_parity(data_map, 10)
+
+
+def test_parity_with_resample_and_interpolate():
+    config = SnapshotConfig()
+    config.station_count = 600
+    data_map = {}
+    for _, records in snapshot_records(datetime(2016, 5, 1), 12, config):
+        parse_stations(records, data_map)
+    # resample_and_interpolate requires thermo observations.
+    data_map = {
+        station_id: station for station_id, station in data_map.items()
+        if len(station.thermo_module['valid_datetime']) > 0
+    }
+
+    _assert_parity(data_map, 10)
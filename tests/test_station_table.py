@@ -0,0 +1,39 @@
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.synthetic_snapshots import SnapshotConfig, snapshot_records
+from domain.json_parser import parse_stations, parse_stations_table
+from domain.station_table import _float32_to_float64
+
+
+def test_iter_stations_equals_parsed_stations():
+    config = SnapshotConfig()
+    config.station_count = 200
+    (_, records), = snapshot_records(datetime(2016, 5, 1), 1, config)
+    data_map = {}
+    parse_stations(records, data_map)
+
+    table, _ = parse_stations_table(records)
+
+    # Missing values are nan in both.
+    for row, station in enumerate(table.iter_stations()):
+        expected = data_map[station.station_id]
+        np.testing.assert_equal(station.thermo_module, expected.thermo_module)
+        np.testing.assert_equal(station.hydro_module, expected.hydro_module)
+        np.testing.assert_equal(
+            table.station(row).thermo_module, expected.thermo_module)
+
+
+def test_float32_to_float64_shortest_decimals():
+    values = np.array([21.3, 1013.2, 0.101, -4.5, 12345678.0, 0.0, np.nan],
+                      dtype=np.float32)
+
+    result = _float32_to_float64(values)
+
+    assert result[:6].tolist() == [21.3, 1013.2, 0.101, -4.5, 12345678.0, 0.0]
+    assert np.isnan(result[6])
+    random = (np.random.default_rng(0).standard_normal(10000) * 100).astype(
+        np.float32)
+    np.testing.assert_array_equal(
+        _float32_to_float64(random), random.astype(str).astype(np.float64))